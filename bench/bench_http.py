@@ -0,0 +1,166 @@
+#
+# Load test of the HTTP front ends.
+#
+# Serves a trivial endpoint table from the branchweb server and from
+# the asyncio front end (each in its own process) and reports
+# requests per second and latency percentiles, optionally while
+# holding a number of idle keep-alive connections open.
+#
+# Usage: python3 bench/bench_http.py [--requests N] [--concurrency C]
+#                                    [--idle I] [--server branchweb|asyncio]
+#
+import os
+import sys
+import time
+import json
+import socket
+import asyncio
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+PORT_BASE = 18400
+
+def ping_endpoint(httphandler, form_data, post_data):
+    from branchweb import webserver
+    httphandler.send_web_response(webserver.webstatus.SUCCESS, "pong")
+
+def slow_endpoint(httphandler, form_data, post_data):
+    from branchweb import webserver
+
+    # stands in for an endpoint waiting on QMP
+    time.sleep(0.005)
+    httphandler.send_web_response(webserver.webstatus.SUCCESS, "done")
+
+PROVIDERS = {
+    "ping": ping_endpoint,
+    "slow": slow_endpoint
+}
+
+def serve(kind: str, port: int):
+    from branchweb import webserver
+    from log import log
+
+    log.CONFIG_OPTIONS["NO_TERM"] = True
+    webserver.WEB_CONFIG["logger_function_debug"] = lambda msg: None
+    webserver.WEB_CONFIG["logger_function_info"] = lambda msg: None
+
+    if(kind == "asyncio"):
+        from web.aioserver import AsyncWebServer
+        log.web_log = lambda msg: None
+        AsyncWebServer({ }, PROVIDERS).serve("127.0.0.1", port)
+    else:
+        webserver.web_server.register_post_endpoints(PROVIDERS)
+        webserver.start_web_server("127.0.0.1", port)
+
+async def open_connection(port: int):
+    return await asyncio.open_connection("127.0.0.1", port)
+
+async def request(conn, port: int, endpoint: str):
+    """
+    POST one request on a keep-alive connection, reconnects if the
+    server closed it. Returns (connection, latency in seconds)
+    """
+    body = json.dumps({ }).encode()
+    req = (f"POST /{endpoint} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+    start = time.perf_counter()
+    if(conn is None):
+        conn = await open_connection(port)
+
+    reader, writer = conn
+    writer.write(req)
+    await writer.drain()
+
+    head = await reader.readuntil(b"\r\n\r\n")
+    headers = head.decode("latin-1").lower()
+    length = int(headers.split("content-length:", 1)[1].split("\r\n", 1)[0]) if "content-length:" in headers else None
+
+    if(length is not None):
+        await reader.readexactly(length)
+    else:
+        await reader.read()
+
+    if(length is None or "connection: close" in headers or "http/1.0" in headers.split("\r\n", 1)[0]):
+        writer.close()
+        conn = None
+
+    return conn, time.perf_counter() - start
+
+async def load(port: int, endpoint: str, total: int, concurrency: int, idle: int):
+    idle_conns = [ await open_connection(port) for i in range(idle) ]
+    latencies = [ ]
+    remaining = [ total ]
+
+    async def worker():
+        conn = None
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            conn, latency = await request(conn, port, endpoint)
+            latencies.append(latency)
+
+        if(conn is not None):
+            conn[1].close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[ worker() for i in range(concurrency) ])
+    elapsed = time.perf_counter() - start
+
+    for reader, writer in idle_conns:
+        writer.close()
+
+    latencies.sort()
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000
+    }
+
+def wait_port(port: int, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+
+    return False
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--idle", type=int, default=0)
+    parser.add_argument("--server", action="append", choices=[ "branchweb", "asyncio" ])
+    parser.add_argument("--serve", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if(args.serve is not None):
+        serve(args.serve[0], int(args.serve[1]))
+        return
+
+    servers = args.server or [ "branchweb", "asyncio" ]
+
+    print("{:<10} {:<6} {:>6} {:>10} {:>10} {:>10}".format("server", "call", "idle", "req/s", "p50 ms", "p99 ms"))
+    for i, kind in enumerate(servers):
+        port = PORT_BASE + i
+        proc = subprocess.Popen([ sys.executable, os.path.abspath(__file__), "--serve", kind, str(port) ])
+
+        try:
+            if(not wait_port(port)):
+                print(f"{kind}: server did not come up")
+                continue
+
+            for endpoint in PROVIDERS.keys():
+                result = asyncio.run(load(port, endpoint, args.requests, args.concurrency, args.idle))
+                print("{:<10} {:<6} {:>6} {:>10.0f} {:>10.2f} {:>10.2f}".format(
+                        kind, endpoint, args.idle, result["rps"], result["p50_ms"], result["p99_ms"]))
+        finally:
+            proc.kill()
+            proc.wait()
+
+if(__name__ == "__main__"):
+    main()
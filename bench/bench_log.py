@@ -0,0 +1,71 @@
+#
+# Benchmark of the log functions.
+#
+# Compares calls per second of the old inspect.stack() based
+# implementation with the current log module. Output goes to
+# /dev/null so only the logger itself is measured. CALLS stays
+# below log.QUEUE_SIZE, so no record is dropped.
+#
+# Usage: python3 bench/bench_log.py
+#
+import os
+import sys
+import time
+import inspect
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from log import log
+
+CALLS = 5000
+
+def legacy_info(msg):
+    frame = inspect.stack()[1]
+    module = inspect.getmodule(frame[0]).__name__
+
+    for output_prov in log.OUTPUT_PROVIDERS:
+        output_prov(module, "INFO", msg)
+
+    print("[INFO] {}: {} ".format(module, msg))
+
+def legacy_debug(msg):
+    frame = inspect.stack()[1]
+    module = inspect.getmodule(frame[0]).__name__
+
+    for output_prov in log.OUTPUT_PROVIDERS:
+        output_prov(module, "DEBUG", msg)
+
+    if(log.CONFIG_OPTIONS["DEBUG_LOG"]):
+        print("[DEBUG] {}: {} ".format(module, msg))
+
+def measure(func, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        func("GET /vminfo 200")
+
+    return calls / (time.perf_counter() - start)
+
+def main():
+    log.CONFIG_OPTIONS["NO_TERM"] = True
+    log.disable_debug_level()
+
+    cases = [
+        ("info", legacy_info, log.info, CALLS // 20),
+        ("debug (disabled)", legacy_debug, log.debug, CALLS // 20),
+    ]
+
+    results = [ ]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name, legacy, current, legacy_calls in cases:
+            results.append((name, measure(legacy, legacy_calls), measure(current, CALLS)))
+
+            # let the background writer finish before stdout is restored
+            log.flush()
+
+    print("{:<18} {:>16} {:>16} {:>10}".format("call", "legacy calls/s", "current calls/s", "speedup"))
+    for name, legacy, current in results:
+        print("{:<18} {:>16.0f} {:>16.0f} {:>9.1f}x".format(name, legacy, current, current / legacy))
+
+if(__name__ == "__main__"):
+    main()
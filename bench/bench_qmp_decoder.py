@@ -0,0 +1,86 @@
+#
+# Micro-benchmark for the QMP stream decoder.
+#
+# Compares the old "append and json.loads the whole buffer after
+# every recv" approach with QMPStreamDecoder for growing reply sizes.
+#
+# Usage: python3 bench/bench_qmp_decoder.py
+#
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from qmp.qmp import QMPStreamDecoder
+
+CHUNK_SIZE = 4096
+
+def make_reply(entries: int) -> bytes:
+    """
+    Build a query-block like reply with the given amount of devices
+    """
+    devices = [ ]
+    for i in range(entries):
+        devices.append({
+            "device": f"drive{i}",
+            "locked": False,
+            "removable": True,
+            "type": "unknown",
+            "inserted": {
+                "file": f"iso/image-{i}.iso",
+                "ro": True,
+                "drv": "raw",
+                "encrypted": False,
+                "image": { "filename": f"iso/image-{i}.iso", "format": "raw", "virtual-size": 700 * 1024 * 1024 }
+            }
+        })
+
+    return (json.dumps({ "return": devices }) + "\r\n").encode("utf-8")
+
+def legacy_decode(chunks: list):
+    buffer = b""
+    for data in chunks:
+        buffer += data
+        try:
+            return json.loads(buffer.decode("utf-8"))
+        except json.JSONDecodeError:
+            pass
+
+    return None
+
+def stream_decode(chunks: list):
+    decoder = QMPStreamDecoder()
+    for data in chunks:
+        msgs = decoder.feed(data)
+        if(msgs):
+            return msgs[0]
+
+    return None
+
+def measure(func, chunks: list, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(chunks)
+
+    return (time.perf_counter() - start) / rounds
+
+def main():
+    print("{:>10} {:>12} {:>14} {:>14} {:>10}".format("entries", "bytes", "legacy (ms)", "stream (ms)", "speedup"))
+
+    for entries in [ 10, 100, 1000, 5000 ]:
+        reply = make_reply(entries)
+        chunks = [ reply[i:i + CHUNK_SIZE] for i in range(0, len(reply), CHUNK_SIZE) ]
+        rounds = max(1, 2000 // entries)
+
+        assert legacy_decode(chunks) == stream_decode(chunks)
+
+        legacy = measure(legacy_decode, chunks, rounds)
+        stream = measure(stream_decode, chunks, rounds)
+
+        print("{:>10} {:>12} {:>14.3f} {:>14.3f} {:>9.1f}x".format(
+            entries, len(reply), legacy * 1000, stream * 1000, legacy / stream))
+
+if(__name__ == "__main__"):
+    main()
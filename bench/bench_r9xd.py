@@ -0,0 +1,324 @@
+#
+# Load test of r9xd itself, without KVM or a Windows 98 image.
+#
+# Runs the real VMManager and r9x_web_providers endpoints in a
+# scratch directory against bench/fake_qemu.py and reports
+# throughput and latency percentiles of authentication, QMP round
+# trips, media listing, logging and start/kill cycles. Endpoints are
+# called in-process from a thread pool, the HTTP layer is covered by
+# bench_http.py.
+#
+# Usage: python3 bench/bench_r9xd.py [--requests N] [--concurrency C]
+#                                    [--cycles K] [--latency-ms L]
+#                                    [--media M] [--only NAME]
+#
+import os
+import sys
+import json
+import time
+import io
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "src"))
+
+FAKE_QEMU = os.path.join(BENCH_DIR, "fake_qemu.py")
+
+#
+# Telemetry interval (seconds) of the /metrics check
+#
+METRICS_INTERVAL = 0.2
+
+BENCH_USER = "bench"
+BENCH_PASS = "bench"
+
+#
+# Everything a configured VM needs, written instead of running
+# setup (which needs qemu-img). The fake never opens the disk.
+#
+VM_CONF = {
+    "disk_size": 1024,
+    "ram_size": 128,
+    "display": "1920x1080",
+    "iso": None,
+    "floppy": None,
+    "cpuset": None,
+    "golden": None,
+    "cluster_size": None,
+    "preallocation": None,
+    "headless": True,
+    "profile": "default",
+    "launch": { }
+}
+
+class Bench():
+
+    def __init__(self, args):
+        """
+        Prepares the scratch directory and the daemon state
+        """
+        self.args = args
+        self.metrics_ok = False
+        self.workdir = tempfile.mkdtemp(prefix="r9xd-bench-")
+        os.chdir(self.workdir)
+
+        for kind, ext in [ ("iso", "iso"), ("floppy", "img") ]:
+            os.mkdir(kind)
+            for i in range(args.media):
+                with open(os.path.join(kind, f"bench{i}.{ext}"), "wb") as f:
+                    f.write(os.urandom(4096))
+
+        with open("vm.json", "w") as f:
+            f.write(json.dumps(VM_CONF))
+
+        os.environ["FAKE_QEMU_LATENCY_MS"] = str(args.latency_ms)
+
+        import state
+        from log import log
+        from web import endpoints
+        from web.batch import CapturedResponse
+        from media import catalog
+        from vm.registry import VMRegistry
+        from vm.telemetry import TelemetrySampler
+
+        log.CONFIG_OPTIONS["NO_TERM"] = True
+        log.disable_debug_level()
+
+        self.log = log
+        self.providers = endpoints.r9x_web_providers
+        self.post_providers = self.providers.get_post_providers()
+        self.CapturedResponse = CapturedResponse
+
+        state.VMS = VMRegistry(FAKE_QEMU, os.path.join(self.workdir, "qmp.sock"),
+                os.path.join(self.workdir, "vms"), self.workdir)
+        self.vmm = state.VMS.get("default")
+        state.TELEMETRY = TelemetrySampler(state.VMS, METRICS_INTERVAL)
+        self.state = state
+
+        self.catalogs = [ catalog.get_catalog("iso"), catalog.get_catalog("floppy") ]
+        for media_catalog in self.catalogs:
+            media_catalog.start()
+
+        self.providers.setup_usermgr(os.path.join(self.workdir, "users.conf"))
+        self.authkey = self.login()
+
+    def login(self):
+        """
+        Create the bench user and get an authkey, None if the
+        usermanager can't create users (auth is then skipped)
+        """
+        usermgr = self.providers.usermgr
+        try:
+            if(usermgr.get_user(BENCH_USER) is None):
+                usermgr.add_user(BENCH_USER, BENCH_PASS)
+        except Exception:
+            return None
+
+        status, payload = self.call("auth", { "user": BENCH_USER, "pass": BENCH_PASS })
+        return payload if status == "SUCCESS" else None
+
+    def wait_for_hashing(self, timeout: float = 60):
+        """
+        Let the catalogs checksum all media before measuring
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if(all(entry["checksum"] is not None for media_catalog in self.catalogs
+                    for entry in list(media_catalog.entries.values()))):
+                return
+
+            time.sleep(0.05)
+
+    def call(self, name: str, data: dict):
+        """
+        Run an endpoint like a request would, returns (status, payload)
+        """
+        endpoint = self.post_providers[name]
+        data = dict(data)
+
+        if(name != "auth"):
+            if(self.authkey is not None):
+                data["authkey"] = self.authkey
+            else:
+                endpoint = getattr(endpoint, "__wrapped__", endpoint)
+
+        response = self.CapturedResponse()
+        endpoint(response, { }, data)
+        return (response.status.name if response.status is not None else None), response.payload
+
+    def check_metrics(self) -> bool:
+        """
+        /metrics must serve samples of the running VM after one
+        telemetry interval
+        """
+        class RawResponse():
+            def __init__(self):
+                self.code = None
+                self.wfile = io.BytesIO()
+
+            def send_response(self, code):
+                self.code = code
+
+            def send_header(self, key, value):
+                pass
+
+            def end_headers(self):
+                pass
+
+            def send_web_response(self, status, payload):
+                self.code = status.name
+
+        self.state.TELEMETRY.start()
+        time.sleep(METRICS_INTERVAL * 1.5)
+
+        form_data = { "authkey": self.authkey } if self.authkey is not None else { }
+        endpoint = self.providers.get_get_providers()["metrics"]
+        if(self.authkey is None):
+            endpoint = getattr(endpoint, "__wrapped__", endpoint)
+
+        response = RawResponse()
+        endpoint(response, form_data)
+        return response.code == 200 and b'vm="default"' in response.wfile.getvalue()
+
+    def scenarios(self) -> list:
+        """
+        (name, endpoint, data factory taking the request index)
+        """
+        media = self.args.media
+        scenarios = [
+            ("authkey", "authstats", lambda i: { }),
+            ("vminfo", "vminfo", lambda i: { }),
+            ("reset", "reset", lambda i: { }),
+            ("setiso", "setiso", lambda i: { "iso": f"bench{i % media}.iso" }),
+            ("batch", "batch", lambda i: { "pipeline": True, "operations": [
+                { "op": "setiso", "iso": f"bench{i % media}.iso" },
+                { "op": "setfloppy", "floppy": f"bench{i % media}.img" },
+                { "op": "ejectiso" },
+                { "op": "ejectfloppy" }
+            ] }),
+            ("files", "files", lambda i: { }),
+            ("files-page", "files", lambda i: { "kind": "iso", "limit": 50 }),
+            ("logs", "logs", lambda i: { "limit": 200 })
+        ]
+
+        if(self.authkey is not None):
+            scenarios.insert(0, ("auth", "auth", lambda i: { "user": BENCH_USER, "pass": BENCH_PASS }))
+
+        return scenarios
+
+    def load(self, endpoint: str, factory) -> dict:
+        """
+        Run args.requests calls over args.concurrency threads
+        """
+        def request(i: int):
+            start = time.perf_counter()
+            status, payload = self.call(endpoint, factory(i))
+            return time.perf_counter() - start, status == "SUCCESS"
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            results = list(pool.map(request, range(self.args.requests)))
+        elapsed = time.perf_counter() - start
+
+        return self.summarize([ latency for latency, ok in results ], elapsed,
+                sum(1 for latency, ok in results if not ok))
+
+    def start_kill_cycles(self) -> dict:
+        """
+        Cold start and kill the VM through the endpoints, one at a time
+        """
+        latencies = [ ]
+        failures = 0
+
+        start = time.perf_counter()
+        for i in range(self.args.cycles):
+            cycle_start = time.perf_counter()
+            status, payload = self.call("start", { "coldboot": True })
+            if(status != "SUCCESS"):
+                failures += 1
+
+            self.call("kill", { })
+            if(self.vmm.qemu_process is not None):
+                self.vmm.qemu_process.wait()
+
+            latencies.append(time.perf_counter() - cycle_start)
+        elapsed = time.perf_counter() - start
+
+        return self.summarize(latencies, elapsed, failures)
+
+    def summarize(self, latencies: list, elapsed: float, failures: int) -> dict:
+        latencies.sort()
+        return {
+            "calls": len(latencies),
+            "failed": failures,
+            "rps": len(latencies) / elapsed,
+            "p50_ms": latencies[len(latencies) // 2] * 1000,
+            "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000
+        }
+
+    def run(self) -> list:
+        results = [ ]
+        only = self.args.only
+
+        self.wait_for_hashing()
+        status, payload = self.call("start", { "coldboot": True })
+        if(status != "SUCCESS"):
+            raise RuntimeError(f"Fake VM did not start: {payload}")
+
+        try:
+            self.metrics_ok = self.check_metrics()
+
+            for name, endpoint, factory in self.scenarios():
+                if(only is None or name in only):
+                    results.append((name, self.load(endpoint, factory)))
+        finally:
+            self.call("kill", { })
+            self.vmm.qemu_process.wait()
+
+        if(only is None or "startkill" in only):
+            results.append(("startkill", self.start_kill_cycles()))
+
+        return results
+
+    def cleanup(self):
+        os.chdir("/")
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--cycles", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--media", type=int, default=200)
+    parser.add_argument("--only", action="append")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        bench = Bench(args)
+        try:
+            results = bench.run()
+        finally:
+            # let the background writer finish before stdout is restored
+            bench.log.flush()
+            bench.cleanup()
+
+    print(f"/metrics check: {'ok' if bench.metrics_ok else 'FAILED, no samples after one interval'}")
+    if(bench.authkey is None):
+        print("usermanager can't create users, authenticated endpoints ran without auth")
+
+    print("{:<11} {:>7} {:>7} {:>10} {:>10} {:>10}".format("scenario", "calls", "failed", "calls/s", "p50 ms", "p99 ms"))
+    for name, result in results:
+        print("{:<11} {:>7} {:>7} {:>10.0f} {:>10.2f} {:>10.2f}".format(
+                name, result["calls"], result["failed"], result["rps"], result["p50_ms"], result["p99_ms"]))
+
+    if(not bench.metrics_ok):
+        sys.exit(1)
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+#
+# Stand-in for qemu-system-i386 used by the benchmarks.
+#
+# Accepts the command line r9xd builds, opens the -qmp unix socket
+# and speaks enough QMP for r9xd: greeting, capability negotiation,
+# query-status, query-block, query-blockstats, query-cpus-fast,
+# media changes, reset, stop/cont, quit, dirty bitmaps and backup
+# jobs, including the events QEMU sends for them. No guest runs.
+#
+# Tuning through the environment (r9xd owns the command line):
+#   FAKE_QEMU_LATENCY_MS         delay before every reply (default 0)
+#   FAKE_QEMU_BOOT_MS            delay before the socket opens (default 0)
+#   FAKE_QEMU_EVENT_INTERVAL_MS  emit an RTC_CHANGE event periodically (default off)
+#
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+DEVICES = [ "win98", "iso", "floppy" ]
+REMOVABLE = [ "iso", "floppy" ]
+
+#
+# Seconds a backup job takes
+#
+BACKUP_JOB_TIME = 0.2
+
+def env_ms(name: str) -> float:
+    return float(os.environ.get(name, 0)) / 1000
+
+class FakeQEMU():
+
+    def __init__(self, argv: list):
+        """
+        State of the fake machine, parsed from the QEMU argv
+        """
+        qmp = argv[argv.index("-qmp") + 1]
+        self.socket_path = qmp.split(",")[0].split(":", 1)[1]
+
+        self.running = "-S" not in argv
+        self.media = { device: None for device in DEVICES }
+        for arg in argv:
+            if(arg.startswith("id=win98,")):
+                options = dict(option.split("=", 1) for option in arg.split(",") if "=" in option)
+                self.media["win98"] = options.get("file")
+        self.tray_open = { device: False for device in DEVICES }
+        self.stats = { device: 0 for device in DEVICES }
+        self.bitmaps = { }
+        self.jobs = { }
+
+        self.latency = env_ms("FAKE_QEMU_LATENCY_MS")
+        self.boot_delay = env_ms("FAKE_QEMU_BOOT_MS")
+        self.event_interval = env_ms("FAKE_QEMU_EVENT_INTERVAL_MS")
+
+        self.lock = threading.Lock()
+        self.clients = [ ]
+
+    def event(self, name: str, data: dict = None) -> dict:
+        now = time.time()
+        msg = {
+            "event": name,
+            "timestamp": { "seconds": int(now), "microseconds": int((now % 1) * 1000000) }
+        }
+
+        if(data is not None):
+            msg["data"] = data
+
+        return msg
+
+    def error(self, cls: str, desc: str) -> dict:
+        return { "error": { "class": cls, "desc": desc } }
+
+    def query_block(self) -> list:
+        devices = [ ]
+        for device in DEVICES:
+            entry = {
+                "device": device,
+                "locked": False,
+                "removable": device in REMOVABLE,
+                "type": "unknown"
+            }
+
+            if(device in REMOVABLE):
+                entry["tray_open"] = self.tray_open[device]
+
+            if(self.media[device] is not None):
+                entry["inserted"] = {
+                    "dirty-bitmaps": [ {
+                        "name": name, "recording": True, "persistent": persistent,
+                        "busy": False, "count": 0, "granularity": 65536
+                    } for name, persistent in self.bitmaps.items() ] if device == "win98" else [ ],
+                    "file": self.media[device],
+                    "ro": device != "win98",
+                    "drv": "qcow2" if device == "win98" else "raw",
+                    "image": { "filename": self.media[device], "format": "raw" }
+                }
+
+            devices.append(entry)
+
+        return devices
+
+    def bitmap_action(self, action: str, args: dict):
+        """
+        Dirty bitmap commands, returns an error or None
+        """
+        name = args.get("name")
+        if(action == "block-dirty-bitmap-add"):
+            if(name in self.bitmaps):
+                return self.error("GenericError", f"Bitmap already exists: {name}")
+            self.bitmaps[name] = args.get("persistent", False)
+        elif(name not in self.bitmaps):
+            return self.error("GenericError", f"Dirty bitmap '{name}' not found")
+        elif(action == "block-dirty-bitmap-remove"):
+            del self.bitmaps[name]
+
+        return None
+
+    def start_backup(self, args: dict):
+        """
+        Start a drive-backup job, returns an error or None. The job
+        writes a small target and completes after BACKUP_JOB_TIME.
+        """
+        job_id = args.get("job-id", args.get("device"))
+        if(job_id in self.jobs):
+            return self.error("GenericError", f"Job ID '{job_id}' already in use")
+
+        if(args.get("sync") == "incremental" and args.get("bitmap") not in self.bitmaps):
+            return self.error("GenericError", f"Dirty bitmap '{args.get('bitmap')}' not found")
+
+        if(args.get("mode") == "existing" and not os.path.exists(args["target"])):
+            return self.error("GenericError", f"Could not open '{args['target']}'")
+
+        with open(args["target"], "ab") as f:
+            f.write(os.urandom(4096))
+
+        self.jobs[job_id] = time.monotonic()
+
+        def complete():
+            time.sleep(BACKUP_JOB_TIME)
+            with self.lock:
+                del self.jobs[job_id]
+            self.broadcast(self.event("BLOCK_JOB_COMPLETED", {
+                "type": "backup", "device": job_id, "len": 4096, "offset": 4096, "speed": 0
+            }))
+
+        threading.Thread(target=complete, daemon=True).start()
+        return None
+
+    def execute(self, msg: dict):
+        """
+        Run a command, returns (reply, events to send after it)
+        """
+        command = msg.get("execute")
+        args = msg.get("arguments", { })
+        events = [ ]
+
+        with self.lock:
+            if(command == "qmp_capabilities"):
+                reply = { "return": { } }
+
+            elif(command == "query-status"):
+                reply = { "return": {
+                    "status": "running" if self.running else "paused",
+                    "running": self.running,
+                    "singlestep": False
+                } }
+
+            elif(command == "query-block"):
+                reply = { "return": self.query_block() }
+
+            elif(command == "query-blockstats"):
+                for device in DEVICES:
+                    self.stats[device] += 4096
+
+                reply = { "return": [ {
+                    "device": device,
+                    "stats": {
+                        "rd_bytes": self.stats[device], "wr_bytes": self.stats[device] // 2,
+                        "rd_operations": self.stats[device] // 512, "wr_operations": self.stats[device] // 1024
+                    }
+                } for device in DEVICES ] }
+
+            elif(command == "query-cpus-fast"):
+                reply = { "return": [ { "cpu-index": 0, "thread-id": os.getpid(), "target": "i386" } ] }
+
+            elif(command == "blockdev-change-medium"):
+                device = args.get("device", args.get("id"))
+                if(device not in REMOVABLE):
+                    reply = self.error("DeviceNotFound", f"Device '{device}' not found")
+                else:
+                    self.media[device] = args.get("filename")
+                    reply = { "return": { } }
+                    events += [
+                        self.event("DEVICE_TRAY_MOVED", { "device": device, "tray-open": True }),
+                        self.event("DEVICE_TRAY_MOVED", { "device": device, "tray-open": False })
+                    ]
+
+            elif(command == "eject"):
+                device = args.get("device", args.get("id"))
+                if(device not in REMOVABLE):
+                    reply = self.error("DeviceNotFound", f"Device '{device}' not found")
+                else:
+                    self.media[device] = None
+                    reply = { "return": { } }
+                    events.append(self.event("DEVICE_TRAY_MOVED", { "device": device, "tray-open": True }))
+
+            elif(command in [ "block-dirty-bitmap-add", "block-dirty-bitmap-clear", "block-dirty-bitmap-remove" ]):
+                reply = self.bitmap_action(command, args) or { "return": { } }
+
+            elif(command == "drive-backup"):
+                reply = self.start_backup(args) or { "return": { } }
+
+            elif(command == "transaction"):
+                reply = { "return": { } }
+                for action in args.get("actions", [ ]):
+                    if(action["type"] == "drive-backup"):
+                        error = self.start_backup(action["data"])
+                    else:
+                        error = self.bitmap_action(action["type"], action["data"])
+
+                    if(error is not None):
+                        reply = error
+                        break
+
+            elif(command == "query-block-jobs"):
+                reply = { "return": [ {
+                    "device": job_id, "type": "backup", "len": 4096,
+                    "offset": min(4096, int((time.monotonic() - started) / BACKUP_JOB_TIME * 4096)),
+                    "busy": True, "paused": False, "speed": 0, "ready": False, "status": "running"
+                } for job_id, started in self.jobs.items() ] }
+
+            elif(command == "system_reset"):
+                reply = { "return": { } }
+                events.append(self.event("RESET", { "guest": False, "reason": "host-qmp-system-reset" }))
+
+            elif(command == "stop"):
+                self.running = False
+                reply = { "return": { } }
+                events.append(self.event("STOP"))
+
+            elif(command == "cont"):
+                self.running = True
+                reply = { "return": { } }
+                events.append(self.event("RESUME"))
+
+            elif(command == "quit"):
+                reply = { "return": { } }
+                events.append(self.event("SHUTDOWN", { "guest": False, "reason": "host-qmp-quit" }))
+
+            else:
+                reply = self.error("CommandNotFound", f"The command {command} has not been found")
+
+        if("id" in msg):
+            reply["id"] = msg["id"]
+
+        return reply, events
+
+    def send(self, conn: socket.socket, *msgs):
+        data = b"".join(json.dumps(msg).encode("utf-8") + b"\r\n" for msg in msgs)
+        try:
+            conn.sendall(data)
+        except OSError:
+            pass
+
+    def broadcast(self, *msgs):
+        with self.lock:
+            clients = list(self.clients)
+
+        for conn in clients:
+            self.send(conn, *msgs)
+
+    def handle(self, conn: socket.socket):
+        """
+        Serve a QMP client, commands are answered in order
+        """
+        self.send(conn, { "QMP": {
+            "version": { "qemu": { "major": 8, "minor": 2, "micro": 0 }, "package": "fake" },
+            "capabilities": [ "oob" ]
+        } })
+
+        with self.lock:
+            self.clients.append(conn)
+
+        buffer = b""
+        try:
+            while True:
+                data = conn.recv(65536)
+                if(not data):
+                    break
+
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    if(not line.strip()):
+                        continue
+
+                    try:
+                        msg = json.loads(line)
+                    except ValueError:
+                        self.send(conn, self.error("GenericError", "JSON parse error"))
+                        continue
+
+                    if(self.latency):
+                        time.sleep(self.latency)
+
+                    reply, events = self.execute(msg)
+                    self.send(conn, reply)
+                    if(events):
+                        self.broadcast(*events)
+
+                    if(msg.get("execute") == "quit"):
+                        os._exit(0)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.clients.remove(conn)
+            conn.close()
+
+    def tick(self):
+        while True:
+            time.sleep(self.event_interval)
+            self.broadcast(self.event("RTC_CHANGE", { "offset": 0 }))
+
+    def serve(self):
+        if(self.boot_delay):
+            time.sleep(self.boot_delay)
+
+        if(os.path.exists(self.socket_path)):
+            os.unlink(self.socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(4)
+
+        if(self.event_interval):
+            threading.Thread(target=self.tick, daemon=True).start()
+
+        while True:
+            conn, addr = server.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+if(__name__ == "__main__"):
+    try:
+        FakeQEMU(sys.argv).serve()
+    except KeyboardInterrupt:
+        pass
@@ -1,5 +1,11 @@
 import os
-import inspect
+import sys
+import time
+import queue
+import atexit
+import threading
+
+from collections import deque
 
 HEADER = '\033[95m'
 NORMAL = '\033[94m'
@@ -29,16 +35,67 @@ CONFIG_OPTIONS = {
     "DEBUG_LOG": False
 }
 
+#
+# level name -> color of the module column
+#
+LEVEL_COLORS = {
+    "WARN": WARNING,
+    "ERROR": FAIL,
+    "INFO": OKGREEN,
+    "WEB": OKCYAN,
+    "DEBUG": OKCYAN
+}
+
+#
+# (level, module) -> preformatted line prefix
+#
+PREFIX_CACHE = { }
+
+#
+# Records waiting for the background writer. If the writer
+# falls behind, new records are dropped and counted.
+#
+QUEUE_SIZE = 10000
+LOG_QUEUE = queue.Queue(maxsize=QUEUE_SIZE)
+WRITE_BATCH = 256
+STATS = {
+    "dropped": 0
+}
+STATS_LOCK = threading.Lock()
+
+#
+# Ring buffer of the most recent structured log records
+#
+RING_SIZE = 2000
+RING = deque(maxlen=RING_SIZE)
+RING_LOCK = threading.Lock()
+NEXT_SEQ = 1
+
+WRITER = None
+
 #
 # checks the environment for TERM variable and
 # disables color log if no TERm is available.
 #
 def initialize():
+    PREFIX_CACHE.clear()
     if("TERM" in os.environ):
         CONFIG_OPTIONS["NO_TERM"] = False
     else:
         print("No terminal available. Disabling log color.")
-initialize()
+
+    start_writer()
+
+#
+# start the background log writer (once)
+#
+def start_writer():
+    global WRITER
+    if(WRITER is not None):
+        return
+
+    WRITER = threading.Thread(target=writer_loop, name="log-writer", daemon=True)
+    WRITER.start()
 
 #
 # Disable debug log messages
@@ -64,64 +121,157 @@ def register_output_provider(callback):
 def unregister_output_provider(callback):
     OUTPUT_PROVIDERS.remove(callback)
 
-def warn(log):
-    frame = inspect.stack()[1]
-    module = inspect.getmodule(frame[0]).__name__
-
-    for output_prov in OUTPUT_PROVIDERS:
-        output_prov(module, "WARN", log)
+#
+# build (and cache) the line prefix for a level and module
+#
+def get_prefix(level, module):
+    prefix = PREFIX_CACHE.get((level, module))
+    if(prefix is not None):
+        return prefix
 
     if(CONFIG_OPTIONS["NO_TERM"]):
-        print("[WARN] {}: {} ".format(module, log))
+        prefix = "[{}] {}: ".format(level, module)
     else:
-        print("{}{:<8}{}{}{:<24}{} {}".format(BOLD, "[WARN]", ENDC, WARNING, module, ENDC, log))
+        prefix = "{}{:<8}{}{}{:<24}{} ".format(BOLD, f"[{level}]", ENDC, LEVEL_COLORS[level], module, ENDC)
 
-def error(log):
-    frame = inspect.stack()[1]
-    module = inspect.getmodule(frame[0]).__name__
-
-    for output_prov in OUTPUT_PROVIDERS:
-        output_prov(module, "ERROR", log)
+    PREFIX_CACHE[(level, module)] = prefix
+    return prefix
 
+#
+# format a record as output line
+#
+def format_record(record):
     if(CONFIG_OPTIONS["NO_TERM"]):
-        print("[ERROR] {}: {} ".format(module, log))
-    else:
-        print("{}{:<8}{}{}{:<24}{} {}".format(BOLD, "[ERROR]", ENDC, FAIL, module, ENDC, log))
+        return "{}{} \n".format(get_prefix(record["level"], record["module"]), record["message"])
 
-def info(log):
-    frame = inspect.stack()[1]
-    module = inspect.getmodule(frame[0]).__name__
+    return "{}{}\n".format(get_prefix(record["level"], record["module"]), record["message"])
 
-    for output_prov in OUTPUT_PROVIDERS:
-        output_prov(module, "INFO", log)
+#
+# background writer: drains the queue in batches, calls the
+# output providers and writes all lines of a batch at once
+#
+def writer_loop():
+    while True:
+        batch = [ LOG_QUEUE.get() ]
+        while len(batch) < WRITE_BATCH:
+            try:
+                batch.append(LOG_QUEUE.get_nowait())
+            except queue.Empty:
+                break
 
-    if(CONFIG_OPTIONS["NO_TERM"]):
-        print("[INFO] {}: {} ".format(module, log))
-    else:
-        print("{}{:<8}{}{}{:<24}{} {}".format(BOLD, "[INFO]", ENDC, OKGREEN, module, ENDC, log))
+        lines = [ ]
+        for record in batch:
+            for output_prov in OUTPUT_PROVIDERS:
+                try:
+                    output_prov(record["module"], record["level"], record["message"])
+                except Exception:
+                    pass
 
-def web_log(log):
-    frame = inspect.stack()[1]
-    module = inspect.getmodule(frame[0]).__name__
+            if(record["level"] != "DEBUG" or CONFIG_OPTIONS["DEBUG_LOG"]):
+                lines.append(format_record(record))
 
-    for output_prov in OUTPUT_PROVIDERS:
-        output_prov(module, "WEB", log)   
+        try:
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+        except Exception:
+            pass
 
-    if(CONFIG_OPTIONS["NO_TERM"]):
-        print("[WEB] {}: {} ".format(module, log))
-    else:
-        print("{}{:<8}{}{}{:<24}{} {}".format(BOLD, "[WEB]", ENDC, OKCYAN, module, ENDC, log))
+        for record in batch:
+            LOG_QUEUE.task_done()
 
-def debug(log):
-    frame = inspect.stack()[1]
-    module = inspect.getmodule(frame[0]).__name__
+#
+# wait until all queued records are written
+#
+def flush():
+    if(WRITER is not None):
+        LOG_QUEUE.join()
+
+atexit.register(flush)
+
+#
+# write a log message. The calling module is taken from the
+# frame two levels up (caller of warn/error/info/...), which is
+# a lot cheaper than building the stack with inspect.
+#
+# The record is stored in the ring buffer and queued for the
+# background writer, the caller never waits for output.
+#
+def write_log(level, log):
+    global NEXT_SEQ
+    module = sys._getframe(2).f_globals.get("__name__", "?")
+
+    with RING_LOCK:
+        record = {
+            "seq": NEXT_SEQ,
+            "timestamp": time.time(),
+            "level": level,
+            "module": module,
+            "message": str(log)
+        }
+        NEXT_SEQ += 1
+        RING.append(record)
+
+    try:
+        LOG_QUEUE.put_nowait(record)
+    except queue.Full:
+        with STATS_LOCK:
+            STATS["dropped"] += 1
+
+#
+# get records from the ring buffer, oldest first. The cursor is
+# the seq to pass as since to get the records that follow.
+#
+# levels: list of levels to include, or None for all
+# module: only records of modules starting with this, or None
+# since: only records with a sequence number above this
+# limit: at most this many records (> 0)
+#
+def get_records(levels = None, module = None, since = 0, limit = 200):
+    with RING_LOCK:
+        records = list(RING)
+        cursor = NEXT_SEQ - 1
+
+    result = [ ]
+    for record in records:
+        if(record["seq"] <= since):
+            continue
+
+        if(levels is not None and record["level"] not in levels):
+            continue
+
+        if(module is not None and not record["module"].startswith(module)):
+            continue
+
+        result.append(record)
 
-    for output_prov in OUTPUT_PROVIDERS:
-        output_prov(module, "DEBUG", log)
+    # cut off: continue right after the last record returned
+    if(len(result) > limit):
+        result = result[:limit]
+        cursor = result[-1]["seq"]
 
-    if(CONFIG_OPTIONS["DEBUG_LOG"]):
-        if(CONFIG_OPTIONS["NO_TERM"]):
-            print("[DEBUG] {}: {} ".format(module, log))
-        else:
-            print("{}{:<8}{}{}{:<24}{} {}".format(BOLD, "[DEBUG]", ENDC, OKCYAN, module, ENDC, log))
+    return {
+        "cursor": cursor,
+        "records": result,
+        "dropped": STATS["dropped"]
+    }
+
+def warn(log):
+    write_log("WARN", log)
+
+def error(log):
+    write_log("ERROR", log)
 
+def info(log):
+    write_log("INFO", log)
+
+def web_log(log):
+    write_log("WEB", log)
+
+def debug(log):
+    # nothing to do, skip the frame lookup
+    if(not CONFIG_OPTIONS["DEBUG_LOG"] and not OUTPUT_PROVIDERS):
+        return
+
+    write_log("DEBUG", log)
+
+initialize()
@@ -3,29 +3,23 @@ import json
 import os
 
 from web import endpoints
+from web.aioserver import AsyncWebServer
 from branchweb import webserver
 from qmp.qmp import QMP
 from log import log
-from vm.manager import VMManager
+from media import catalog
+import state
 
 R9XD_CODENAME="Black Mesa Inbound"
 R9XD_VERSION=0.1
 
-CONF = {
-    "host": "0.0.0.0",
-    "port": 8080,
-    "qemu-bin": "qemu-system-i386",
-    "qmp-socket": "/tmp/qmpsock"
-}
-VMM = VMManager(CONF['qemu-bin'], CONF['qmp-socket'])
-
 def main():
     log.initialize()
     print(f"r9xd {R9XD_VERSION}, ({R9XD_CODENAME})")
     print("Copyright (c) zimsneexh (https://zsxh.eu)\n")
 
     log.info("Starting webserver..")
-    log.info(f"Listening on 'http://{CONF['host']}:{CONF['port']}'")
+    log.info(f"Listening on 'http://{state.CONF['host']}:{state.CONF['port']}'")
     
     endpoints.r9x_web_providers.setup_usermgr("users.conf")
     webserver.WEB_CONFIG["logger_function_debug"] = log.debug
@@ -37,7 +31,25 @@ def main():
     webserver.web_server.register_post_endpoints(
         endpoints.r9x_web_providers.get_post_providers())
     
-    webserver.start_web_server(CONF['host'], CONF['port'])
+    catalog.get_catalog("iso").start()
+    catalog.get_catalog("floppy").start()
+
+    if(state.POOL is not None):
+        state.POOL.start()
+
+    if(state.TELEMETRY is not None):
+        state.TELEMETRY.start()
+
+    state.MAINTENANCE.start()
+
+    if(state.BACKUPS is not None):
+        state.BACKUPS.start()
+
+    if(state.CONF['async-server']):
+        AsyncWebServer(endpoints.r9x_web_providers.get_get_providers(),
+                endpoints.r9x_web_providers.get_post_providers(), state.VMS).serve(state.CONF['host'], state.CONF['port'])
+    else:
+        webserver.start_web_server(state.CONF['host'], state.CONF['port'])
 
 if(__name__ == "__main__"):
     try:
@@ -0,0 +1,380 @@
+import os
+import stat
+import time
+import threading
+
+from media.inotify import Inotify
+from media import inotify
+from media.store import STORE
+from log import log
+
+#
+# Seconds between full rescans. Network mounts don't deliver
+# inotify events for remote changes, so this always runs.
+#
+RESCAN_INTERVAL = 60
+
+#
+# Seconds between rescans if inotify is not available
+#
+RESCAN_INTERVAL_NO_INOTIFY = 10
+
+#
+# Sizes of standard floppy disk images
+#
+FLOPPY_SIZES = [ 163840, 184320, 327680, 368640, 737280, 1228800, 1474560, 1720320, 2949120 ]
+
+WATCH_MASK = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | \
+        inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR
+
+#
+# media directory -> catalog
+#
+CATALOGS = { }
+CATALOGS_LOCK = threading.Lock()
+
+#
+# get (or create) the catalog of a media directory
+#
+def get_catalog(directory: str):
+    with CATALOGS_LOCK:
+        catalog = CATALOGS.get(directory)
+        if(catalog is None):
+            catalog = MediaCatalog(directory)
+            CATALOGS[directory] = catalog
+
+        return catalog
+
+#
+# check if a filename is a plain name inside the media directory
+#
+def valid_name(name: str) -> bool:
+    return bool(name) and "/" not in name and "\0" not in name and not name.startswith(".")
+
+#
+# detect the image type from size and header
+#
+def detect_type(path: str, size: int) -> str:
+    try:
+        with open(path, "rb") as f:
+            f.seek(0x8001)
+            magic = f.read(5)
+
+            if(magic == b"CD001"):
+                return "iso9660"
+
+            if(magic in [ b"BEA01", b"NSR02", b"NSR03" ]):
+                return "udf"
+
+            if(size in FLOPPY_SIZES):
+                return "floppy"
+
+            f.seek(510)
+            if(f.read(2) == b"\x55\xaa"):
+                return "disk"
+
+    except OSError:
+        pass
+
+    return "unknown"
+
+class MediaCatalog():
+
+    def __init__(self, directory: str, hash_files: bool = True):
+        """
+        In-memory index of a media directory (iso/ or floppy/).
+
+        Kept up to date incrementally through inotify, with periodic
+        full rescans as fallback. Every change bumps the generation,
+        so clients can cheaply check if their listing is outdated.
+
+        :param hash_files: Compute sha256 checksums (and deduplicate)
+                           in the background
+        """
+        self.directory = directory
+        self.hash_files = hash_files
+        self.lock = threading.Lock()
+        self.entries = { }
+        self.checksums = { }
+        self.generation = 0
+        self.inotify = None
+        self.hash_event = threading.Event()
+
+    def start(self):
+        """
+        Initial scan and start of the watcher threads
+        """
+        if(not os.path.exists(self.directory)):
+            os.mkdir(self.directory)
+
+        self.rescan()
+
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(self.directory, WATCH_MASK)
+            threading.Thread(target=self.watch_loop, name=f"media-watch-{self.directory}", daemon=True).start()
+        except OSError as ex:
+            log.warn(f"inotify unavailable for '{self.directory}', rescanning periodically: {ex}")
+            self.inotify = None
+
+        threading.Thread(target=self.rescan_loop, name=f"media-rescan-{self.directory}", daemon=True).start()
+
+        if(self.hash_files):
+            threading.Thread(target=self.hash_loop, name=f"media-hash-{self.directory}", daemon=True).start()
+
+        log.info(f"Media catalog '{self.directory}' ready: {len(self.entries)} file(s)")
+
+    def make_entry(self, name: str, st: os.stat_result, old: dict = None) -> dict:
+        """
+        Build the catalog entry of a file. Type and checksum of
+        an unchanged file are taken over from the old entry.
+        """
+        if(old is not None and old["size"] == st.st_size and old["mtime"] == st.st_mtime):
+            return old
+
+        return {
+            "name": name,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "type": detect_type(os.path.join(self.directory, name), st.st_size),
+            "checksum": None
+        }
+
+    def rescan(self):
+        """
+        Full rescan of the directory
+        """
+        entries = { }
+        try:
+            with os.scandir(self.directory) as it:
+                for dirent in it:
+                    if(not valid_name(dirent.name) or not dirent.is_file()):
+                        continue
+
+                    try:
+                        st = dirent.stat()
+                    except OSError:
+                        continue
+
+                    with self.lock:
+                        old = self.entries.get(dirent.name)
+
+                    entries[dirent.name] = self.make_entry(dirent.name, st, old)
+
+        except OSError as ex:
+            log.error(f"Could not scan media directory '{self.directory}': {ex}")
+            return
+
+        with self.lock:
+            changed = entries.keys() != self.entries.keys() or \
+                    any(entries[name] is not self.entries[name] for name in entries)
+
+            for name in self.entries.keys() - entries.keys():
+                STORE.forget(self.directory, name)
+
+            for name, entry in self.entries.items():
+                if(entries.get(name) is not entry):
+                    self.unindex(entry)
+
+            self.entries = entries
+            if(changed):
+                self.generation += 1
+
+        if(changed):
+            self.hash_event.set()
+
+    def update_file(self, name: str):
+        """
+        Update (or drop) a single file after an inotify event
+        """
+        if(not valid_name(name)):
+            return
+
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            st = None
+
+        with self.lock:
+            old = self.entries.get(name)
+
+        if(st is None or not stat.S_ISREG(st.st_mode)):
+            entry = None
+        else:
+            entry = self.make_entry(name, st, old)
+
+        with self.lock:
+            if(entry is old):
+                # the file was written or touched, give a failed checksum another try
+                if(old is None or old["checksum"] is not False):
+                    return
+
+                old["checksum"] = None
+
+            elif(old is not None):
+                self.unindex(old)
+
+            if(entry is None):
+                self.entries.pop(name, None)
+                STORE.forget(self.directory, name)
+            else:
+                self.entries[name] = entry
+
+            self.generation += 1
+
+        self.hash_event.set()
+
+    def watch_loop(self):
+        while True:
+            try:
+                events = self.inotify.read_events()
+            except OSError as ex:
+                log.error(f"inotify read failed for '{self.directory}': {ex}")
+                self.inotify = None
+                return
+
+            for wd, mask, name in events:
+                if(mask & inotify.IN_Q_OVERFLOW):
+                    self.rescan()
+                elif(mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_IGNORED)):
+                    log.warn(f"Media directory '{self.directory}' went away, rescanning periodically")
+                    self.inotify.close()
+                    self.inotify = None
+                    return
+                elif(name):
+                    self.update_file(name)
+
+    def rescan_loop(self):
+        while True:
+            time.sleep(RESCAN_INTERVAL if self.inotify is not None else RESCAN_INTERVAL_NO_INOTIFY)
+            self.rescan()
+
+    def hash_loop(self):
+        """
+        Compute missing checksums, one file at a time
+        """
+        while True:
+            self.hash_event.wait()
+            self.hash_event.clear()
+
+            try:
+                self.hash_pending()
+            except Exception as ex:
+                log.error(f"Hashing media in '{self.directory}' failed: {ex}")
+
+    def hash_pending(self):
+        """
+        Hash all entries without a checksum
+        """
+        while True:
+            with self.lock:
+                pending = [ entry for entry in self.entries.values() if entry["checksum"] is None ]
+
+            # the hash cache is written once per pass, not per file
+            if(not pending):
+                STORE.save()
+                break
+
+            entry = pending[0]
+            try:
+                checksum = self.compute_checksum(entry["name"])
+            except Exception as ex:
+                log.error(f"Could not hash '{entry['name']}' in '{self.directory}': {ex}")
+                checksum = None
+
+            with self.lock:
+                # file changed or vanished while hashing, retried on its next change
+                if(checksum is None):
+                    entry["checksum"] = False
+                    continue
+
+                if(self.entries.get(entry["name"]) is entry):
+                    entry["checksum"] = checksum
+                    self.checksums.setdefault(checksum, set()).add(entry["name"])
+                    self.generation += 1
+
+    def unindex(self, entry: dict):
+        """
+        Drop an entry from the checksum index, the lock is held
+        """
+        names = self.checksums.get(entry["checksum"])
+        if(names is not None):
+            names.discard(entry["name"])
+            if(not names):
+                del self.checksums[entry["checksum"]]
+
+    def compute_checksum(self, name: str):
+        """
+        sha256 of a media file, None if it could not be read.
+        The file is deduplicated against the media store on the way.
+        """
+        return STORE.ingest(self.directory, name)
+
+    def contains(self, name: str) -> bool:
+        """
+        Check if a file is in the catalog. Unknown names are
+        stat'ed once, in case the watcher did not catch up yet.
+        """
+        with self.lock:
+            if(name in self.entries):
+                return True
+
+        if(not valid_name(name)):
+            return False
+
+        self.update_file(name)
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name: str):
+        """
+        Get the entry of a file or None
+        """
+        with self.lock:
+            return self.entries.get(name)
+
+    def find_by_checksum(self, checksum: str):
+        """
+        Get the name of a file with the given sha256, or None
+        """
+        with self.lock:
+            names = self.checksums.get(checksum)
+            return min(names) if names else None
+
+    def names(self) -> list:
+        """
+        Get all file names, sorted
+        """
+        with self.lock:
+            return sorted(self.entries.keys())
+
+    def get_generation(self) -> int:
+        with self.lock:
+            return self.generation
+
+    def list(self, offset: int = 0, limit: int = 100, search: str = None, media_type: str = None) -> dict:
+        """
+        Get a page of the catalog, sorted by name
+
+        :param search: Case insensitive substring of the name
+        :param media_type: Only entries of this type
+        """
+        with self.lock:
+            entries = list(self.entries.values())
+            generation = self.generation
+
+        if(search):
+            search = search.lower()
+            entries = [ entry for entry in entries if search in entry["name"].lower() ]
+
+        if(media_type):
+            entries = [ entry for entry in entries if entry["type"] == media_type ]
+
+        entries.sort(key=lambda entry: entry["name"])
+
+        return {
+            "generation": generation,
+            "total": len(entries),
+            "offset": offset,
+            "entries": [ dict(entry, checksum=entry["checksum"] or None) for entry in entries[offset:offset + limit] ]
+        }
@@ -0,0 +1,73 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+class Inotify():
+
+    def __init__(self):
+        """
+        Minimal ctypes binding to the Linux inotify API.
+        Raises OSError if inotify is not available.
+        """
+        libc_name = ctypes.util.find_library("c")
+        if(libc_name is None):
+            raise OSError("libc not found")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if(not hasattr(self.libc, "inotify_init1")):
+            raise OSError("inotify not supported")
+
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if(self.fd < 0):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """
+        Watch path for the events in mask, returns the watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if(wd < 0):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+
+        return wd
+
+    def read_events(self) -> list:
+        """
+        Block until events are available
+
+        Returns a list of (wd, mask, name) tuples
+        """
+        data = os.read(self.fd, 65536)
+        events = [ ]
+
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b"\0").decode("utf-8", errors="surrogateescape")
+            pos += length
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
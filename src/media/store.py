@@ -0,0 +1,317 @@
+import os
+import re
+import json
+import mmap
+import time
+import errno
+import hashlib
+import threading
+
+from log import log
+
+#
+# Content addressed object store, objects are hardlinked
+# into the media directories under their names
+#
+STORE_DIR = "store"
+OBJECT_DIR = os.path.join(STORE_DIR, "objects")
+HASH_CACHE_FILE = os.path.join(STORE_DIR, "hashcache.json")
+
+HASH_WINDOW = 4 * 1024 * 1024
+
+#
+# Media directories deduplicated by hardlink. Floppies are attached
+# writable, a shared inode would carry guest writes into every copy.
+#
+DEDUP_DIRECTORIES = [ "iso" ]
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+#
+# check if a string looks like a sha256 digest
+#
+def is_digest(value: str) -> bool:
+    return isinstance(value, str) and SHA256_PATTERN.match(value) is not None
+
+class MediaStore():
+
+    def __init__(self):
+        """
+        Deduplicating store for media images.
+
+        Files are hashed once in a streaming pass over an mmap and
+        the digest is cached by (device, inode, size, mtime), so a
+        file is never hashed twice. The cache is written in batches
+        by save(), which drops entries of files that are gone or
+        changed. Identical ISO images are replaced
+        by hardlinks to a single object in store/objects, floppies
+        are only indexed.
+        """
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.hash_cache = { }
+        self.cache_paths = { }
+        self.dirty = False
+        self.names = { }
+        self.loaded = False
+
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.hash_seconds = 0.0
+        self.cache_hits = 0
+
+    def load(self):
+        """
+        Load the persisted hash cache (once)
+        """
+        with self.lock:
+            if(self.loaded):
+                return
+
+            self.loaded = True
+            if(os.path.exists(HASH_CACHE_FILE)):
+                try:
+                    with open(HASH_CACHE_FILE, "r") as f:
+                        cache = json.loads(f.read())
+
+                    # key -> [ digest, path ], or just the digest (older format)
+                    for key, value in cache.items():
+                        if(isinstance(value, list)):
+                            self.hash_cache[key], self.cache_paths[key] = value
+                        else:
+                            self.hash_cache[key] = value
+                except Exception as ex:
+                    log.warn(f"Could not load hash cache: {ex}")
+
+    def is_current(self, key: str, digest: str, path: str) -> bool:
+        """
+        Check if a cache entry still describes a file, under its
+        recorded path or as store object
+        """
+        for candidate in [ path, self.object_path(digest) ]:
+            try:
+                if(candidate is not None and self.cache_key(os.stat(candidate)) == key):
+                    return True
+            except OSError:
+                pass
+
+        return False
+
+    def save(self):
+        """
+        Persist the hash cache if it changed, dropping the entries
+        of files that were removed or changed meanwhile
+        """
+        with self.lock:
+            if(not self.dirty):
+                return
+
+            self.dirty = False
+            entries = [ (key, digest, self.cache_paths.get(key)) for key, digest in self.hash_cache.items() ]
+
+        stale = [ key for key, digest, path in entries if not self.is_current(key, digest, path) ]
+        cache = { key: [ digest, path ] for key, digest, path in entries if key not in stale }
+
+        with self.lock:
+            for key in stale:
+                self.hash_cache.pop(key, None)
+                self.cache_paths.pop(key, None)
+
+        os.makedirs(STORE_DIR, exist_ok=True)
+
+        # both catalogs save and share the temporary file
+        with self.save_lock:
+            tmp_file = f"{HASH_CACHE_FILE}.tmp"
+            with open(tmp_file, "w+") as f:
+                f.write(json.dumps(cache))
+
+            os.replace(tmp_file, HASH_CACHE_FILE)
+
+    def cache_key(self, st: os.stat_result) -> str:
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def hash_file(self, path: str):
+        """
+        Get the sha256 of a file, None if it could not be read
+        """
+        self.load()
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        key = self.cache_key(st)
+        with self.lock:
+            digest = self.hash_cache.get(key)
+            if(digest is not None):
+                self.cache_hits += 1
+                if(self.cache_paths.get(key) != path):
+                    self.cache_paths[key] = path
+                    self.dirty = True
+                return digest
+
+        start = time.monotonic()
+        sha = hashlib.sha256()
+
+        try:
+            with open(path, "rb") as f:
+                if(st.st_size > 0):
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        if(hasattr(mm, "madvise")):
+                            mm.madvise(mmap.MADV_SEQUENTIAL)
+
+                        view = memoryview(mm)
+                        try:
+                            for pos in range(0, len(view), HASH_WINDOW):
+                                sha.update(view[pos:pos + HASH_WINDOW])
+                        finally:
+                            view.release()
+
+        except (OSError, ValueError) as ex:
+            log.warn(f"Could not hash '{path}': {ex}")
+            return None
+
+        digest = sha.hexdigest()
+        with self.lock:
+            self.hash_cache[key] = digest
+            self.cache_paths[key] = path
+            self.dirty = True
+            self.files_hashed += 1
+            self.bytes_hashed += st.st_size
+            self.hash_seconds += time.monotonic() - start
+
+        return digest
+
+    def remember(self, path: str, digest: str):
+        """
+        Record the digest of a file that was hashed elsewhere
+        (e.g. while it was uploaded)
+        """
+        self.load()
+        st = os.stat(path)
+
+        key = self.cache_key(st)
+        with self.lock:
+            self.hash_cache[key] = digest
+            self.cache_paths[key] = path
+            self.dirty = True
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(OBJECT_DIR, digest[:2], digest)
+
+    def ingest(self, directory: str, name: str):
+        """
+        Hash a media file and deduplicate it against the store.
+
+        The first file with a digest becomes the object (by hardlink),
+        later identical files are replaced by a hardlink to it. Files
+        outside DEDUP_DIRECTORIES are hashed and indexed only.
+
+        Returns the digest or None
+        """
+        path = os.path.join(directory, name)
+        digest = self.hash_file(path)
+        if(digest is None):
+            return None
+
+        if(os.path.basename(os.path.normpath(directory)) in DEDUP_DIRECTORIES):
+            self.link(path, directory, name, digest)
+
+        with self.lock:
+            self.names.setdefault(digest, set()).add((directory, name))
+
+        return digest
+
+    def link(self, path: str, directory: str, name: str, digest: str):
+        """
+        Hardlink a file into the store or replace it by a
+        hardlink to the identical object
+        """
+        obj = self.object_path(digest)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+
+        try:
+            if(not os.path.exists(obj)):
+                os.link(path, obj)
+            elif(not os.path.samefile(path, obj)):
+                tmp_path = os.path.join(directory, f".{name}.link")
+                os.link(obj, tmp_path)
+                os.replace(tmp_path, path)
+                log.info(f"Deduplicated '{path}' ({digest[:12]})")
+
+        except OSError as ex:
+            # e.g. store on another filesystem, only index the name
+            if(ex.errno != errno.EXDEV):
+                log.warn(f"Could not link '{path}' into store: {ex}")
+
+    def forget(self, directory: str, name: str):
+        """
+        Drop a name from the index (file was removed), its cache
+        entry goes with the next save
+        """
+        with self.lock:
+            for names in self.names.values():
+                names.discard((directory, name))
+
+            self.dirty = True
+
+    def is_shared(self, path: str) -> bool:
+        """
+        Check if a file shares its data with other media names,
+        the store's own link doesn't count
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        links = st.st_nlink
+        with self.lock:
+            digest = self.hash_cache.get(self.cache_key(st))
+
+        if(digest is not None):
+            try:
+                if(os.path.samefile(path, self.object_path(digest))):
+                    links -= 1
+            except OSError:
+                pass
+
+        return links > 1
+
+    def get_stats(self) -> dict:
+        """
+        Get disk usage and hashing cost
+        """
+        with self.lock:
+            names = { digest: set(entries) for digest, entries in self.names.items() }
+
+        logical = 0
+        inodes = { }
+        for entries in names.values():
+            for directory, name in entries:
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+
+                logical += st.st_size
+                inodes[(st.st_dev, st.st_ino)] = st.st_size
+
+        physical = sum(inodes.values())
+
+        with self.lock:
+            return {
+                "digests": len(names),
+                "names": sum(len(entries) for entries in names.values()),
+                "logical_bytes": logical,
+                "physical_bytes": physical,
+                "saved_bytes": logical - physical,
+                "files_hashed": self.files_hashed,
+                "bytes_hashed": self.bytes_hashed,
+                "hash_seconds": round(self.hash_seconds, 3),
+                "hash_mb_per_s": round(self.bytes_hashed / self.hash_seconds / 1024 / 1024, 1) if self.hash_seconds else None,
+                "cache_hits": self.cache_hits
+            }
+
+STORE = MediaStore()
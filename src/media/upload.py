@@ -0,0 +1,183 @@
+import os
+import re
+import base64
+import hashlib
+import threading
+
+from media import catalog
+from media.store import STORE
+from log import log
+
+#
+# Largest accepted chunk (decoded) per request, and its base64
+# length. An encoded chunk has to fit the HTTP body limit
+# (aioserver.MAX_BODY_SIZE).
+#
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_ENCODED_CHUNK_SIZE = 4 * ((MAX_CHUNK_SIZE + 2) // 3)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class Upload():
+
+    def __init__(self, directory: str, name: str, total_size: int, restart: bool = False):
+        """
+        State of a single resumable upload. Data is written to a
+        hidden part file next to the target, hashed on the way.
+
+        :param restart: Discard the part file instead of resuming it
+        """
+        self.directory = directory
+        self.name = name
+        self.total_size = total_size
+        self.part_path = os.path.join(directory, f".{name}.part")
+        self.lock = threading.Lock()
+        self.sha = hashlib.sha256()
+        self.offset = 0
+
+        # a part file of another upload of this name can't be resumed
+        if(os.path.exists(self.part_path) and (restart or os.path.getsize(self.part_path) > total_size)):
+            log.info(f"Discarding partial upload of '{name}', restarting at 0")
+            os.unlink(self.part_path)
+
+        # resume after a restart: rebuild the hash state from disk
+        if(os.path.exists(self.part_path)):
+            with open(self.part_path, "rb") as f:
+                while True:
+                    chunk = f.read(HASH_CHUNK_SIZE)
+                    if(not chunk):
+                        break
+                    self.sha.update(chunk)
+                    self.offset += len(chunk)
+
+class UploadManager():
+
+    def __init__(self):
+        """
+        Tracks all running uploads by (directory, name)
+        """
+        self.lock = threading.Lock()
+        self.uploads = { }
+
+    def get_upload(self, directory: str, name: str, total_size: int) -> Upload:
+        """
+        Get the running upload or start (or resume) one
+        """
+        with self.lock:
+            upload = self.uploads.get((directory, name))
+            if(upload is None or upload.total_size != total_size):
+                # a new total size means a different file, start over
+                upload = Upload(directory, name, total_size, upload is not None)
+                self.uploads[(directory, name)] = upload
+
+            return upload
+
+    def write_chunk(self, directory: str, name: str, total_size: int, offset: int, data: str, checksum: str = None) -> dict:
+        """
+        Append a base64 encoded chunk at offset. The upload is
+        moved into place once total_size bytes are written and the
+        sha256 matches checksum (if given).
+
+        Returns a dict with the current offset, whether the upload
+        is complete and an error message (or None)
+        """
+        if(not catalog.valid_name(name)):
+            return self.result(0, False, "Invalid file name")
+
+        if(os.path.exists(os.path.join(directory, name))):
+            return self.result(0, False, "File already exists")
+
+        if(checksum is not None and not SHA256_PATTERN.match(checksum)):
+            return self.result(0, False, "Invalid sha256 checksum")
+
+        upload = self.get_upload(directory, name, total_size)
+
+        with upload.lock:
+            # status request, or client is out of sync: tell it where to resume
+            if(data is None or offset != upload.offset):
+                err = None if data is None else f"Offset mismatch, resume at {upload.offset}"
+                return self.result(upload.offset, False, err)
+
+            if(not isinstance(data, str)):
+                return self.result(upload.offset, False, "Invalid base64 data")
+
+            # reject before decoding, an oversized chunk is never held twice
+            if(len(data) > MAX_ENCODED_CHUNK_SIZE):
+                return self.result(upload.offset, False, f"Chunk larger than {MAX_CHUNK_SIZE} bytes")
+
+            try:
+                chunk = base64.b64decode(data, validate=True)
+            except Exception:
+                return self.result(upload.offset, False, "Invalid base64 data")
+
+            if(len(chunk) > MAX_CHUNK_SIZE):
+                return self.result(upload.offset, False, f"Chunk larger than {MAX_CHUNK_SIZE} bytes")
+
+            if(upload.offset + len(chunk) > total_size):
+                return self.result(upload.offset, False, "Chunk exceeds total size")
+
+            with open(upload.part_path, "ab") as f:
+                f.write(chunk)
+
+            upload.sha.update(chunk)
+            upload.offset += len(chunk)
+
+            if(upload.offset < total_size):
+                return self.result(upload.offset, False, None)
+
+            return self.finish(upload, checksum)
+
+    def finish(self, upload: Upload, checksum: str) -> dict:
+        """
+        Verify and atomically move a complete upload into place
+        """
+        with self.lock:
+            self.uploads.pop((upload.directory, upload.name), None)
+
+        digest = upload.sha.hexdigest()
+        if(checksum is not None and digest != checksum):
+            os.unlink(upload.part_path)
+            log.warn(f"Upload '{upload.name}' failed checksum verification")
+            return self.result(0, False, f"Checksum mismatch: got {digest}")
+
+        with open(upload.part_path, "rb+") as f:
+            os.fsync(f.fileno())
+
+        path = os.path.join(upload.directory, upload.name)
+        os.replace(upload.part_path, path)
+
+        # already hashed while writing, don't hash it again
+        STORE.remember(path, digest)
+        log.info(f"Upload of '{upload.name}' ({upload.total_size} bytes) to '{upload.directory}' complete")
+
+        result = self.result(upload.offset, True, None)
+        result["sha256"] = digest
+        return result
+
+    def cancel(self, directory: str, name: str) -> bool:
+        """
+        Abort an upload and delete its part file
+        """
+        if(not catalog.valid_name(name)):
+            return False
+
+        with self.lock:
+            self.uploads.pop((directory, name), None)
+
+        part_path = os.path.join(directory, f".{name}.part")
+        if(not os.path.exists(part_path)):
+            return False
+
+        os.unlink(part_path)
+        return True
+
+    def result(self, offset: int, complete: bool, error: str) -> dict:
+        return {
+            "offset": offset,
+            "complete": complete,
+            "error": error
+        }
+
+UPLOADS = UploadManager()
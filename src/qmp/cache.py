@@ -0,0 +1,109 @@
+import time
+import threading
+
+from qmp.qmp import QMP_TIMEOUT
+
+#
+# Read-only queries that may be served from the cache, with the
+# max age in seconds of an entry that no event invalidated
+#
+CACHEABLE_QUERIES = {
+    "query-block": 30,
+    "query-status": 30,
+
+    # counters change without events, only dedupes bursts
+    "query-blockstats": 1
+}
+
+#
+# QMP event -> queries whose results it changes
+#
+INVALIDATING_EVENTS = {
+    "DEVICE_TRAY_MOVED": [ "query-block" ],
+    "DEVICE_DELETED": [ "query-block" ],
+    "BLOCK_IO_ERROR": [ "query-block", "query-status", "query-blockstats" ],
+    "BLOCK_JOB_COMPLETED": [ "query-block", "query-blockstats" ],
+    "BLOCK_JOB_CANCELLED": [ "query-block", "query-blockstats" ],
+    "RESET": [ "query-block", "query-status" ],
+    "STOP": [ "query-status" ],
+    "RESUME": [ "query-status" ],
+    "SHUTDOWN": [ "query-status" ],
+    "SUSPEND": [ "query-status" ],
+    "WAKEUP": [ "query-status" ],
+    "GUEST_PANICKED": [ "query-status" ],
+    "MIGRATION": [ "query-status" ]
+}
+
+class QMPQueryCache():
+
+    def __init__(self):
+        """
+        Cache of read-only QMP query results.
+
+        Entries are dropped by the QMP events that change them,
+        by r9xd's own state changing commands and after a max age.
+        Each query has a generation that is bumped on invalidation,
+        so a response racing an invalidation is never stored.
+        """
+        self.lock = threading.Lock()
+        self.entries = { }
+        self.generations = { }
+
+        self.hits = { }
+        self.misses = { }
+        self.invalidations = 0
+
+    def query(self, qmp, command: str, timeout: float = QMP_TIMEOUT):
+        """
+        Execute a query through the cache, returns the response or None
+        """
+        if(command not in CACHEABLE_QUERIES):
+            return qmp.execute_qmp_command({ "execute": command }, timeout)
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(command)
+            if(entry is not None and now - entry[0] < CACHEABLE_QUERIES[command]):
+                self.hits[command] = self.hits.get(command, 0) + 1
+                return entry[1]
+
+            self.misses[command] = self.misses.get(command, 0) + 1
+            generation = self.generations.get(command, 0)
+
+        resp = qmp.execute_qmp_command({ "execute": command }, timeout)
+
+        if(resp is not None and "return" in resp):
+            with self.lock:
+                if(self.generations.get(command, 0) == generation):
+                    self.entries[command] = (now, resp)
+
+        return resp
+
+    def invalidate(self, *commands):
+        """
+        Drop the given queries, or everything if none are given
+        """
+        with self.lock:
+            for command in commands or list(CACHEABLE_QUERIES.keys()):
+                self.entries.pop(command, None)
+                self.generations[command] = self.generations.get(command, 0) + 1
+
+            self.invalidations += 1
+
+    def on_event(self, event: dict):
+        """
+        Invalidate the queries affected by a QMP event
+        """
+        commands = INVALIDATING_EVENTS.get(event.get("event"))
+        if(commands is not None):
+            self.invalidate(*commands)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "saved_round_trips": sum(self.hits.values()),
+                "invalidations": self.invalidations,
+                "cached": sorted(self.entries.keys())
+            }
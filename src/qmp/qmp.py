@@ -1,67 +1,317 @@
 import json
 import socket
+import itertools
+import threading
+
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+from log import log
+
+class QMPStreamDecoder():
+
+    def __init__(self):
+        """
+        Incremental decoder for the newline delimited QMP stream.
+
+        Received bytes are kept in a persistent buffer, only complete
+        lines are decoded and leftover bytes wait for the next feed().
+        """
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.json_decoder = json.JSONDecoder()
+
+    def feed(self, data: bytes) -> list:
+        """
+        Feed received bytes into the decoder
+
+        Returns a list of all messages completed by this chunk
+        """
+        self.buffer += data
+        messages = [ ]
+
+        start = 0
+        while True:
+            newline = self.buffer.find(b"\n", self.scan_pos)
+
+            # No complete line left, keep the rest
+            if(newline == -1):
+                break
+
+            messages.extend(self.decode_line(bytes(self.buffer[start:newline])))
+            start = newline + 1
+            self.scan_pos = start
+
+        if(start > 0):
+            del self.buffer[:start]
+
+        # Everything left in the buffer has already been scanned
+        self.scan_pos = len(self.buffer)
+        return messages
+
+    def decode_line(self, line: bytes) -> list:
+        """
+        Decode all json objects contained in a single line
+        """
+        text = line.decode("utf-8", errors="replace")
+        messages = [ ]
+
+        pos = 0
+        end = len(text)
+        while pos < end:
+            # skip whitespace (including the \r of \r\n)
+            while pos < end and text[pos].isspace():
+                pos += 1
+
+            if(pos >= end):
+                break
+
+            try:
+                msg, pos = self.json_decoder.raw_decode(text, pos)
+            except json.JSONDecodeError as ex:
+                log.warn(f"Dropping malformed QMP message: {ex}")
+                break
+
+            messages.append(msg)
+
+        return messages
+
+    def reset(self):
+        """
+        Drop all buffered bytes
+        """
+        self.buffer.clear()
+        self.scan_pos = 0
+
+#
+# Default time in seconds to wait for a command reply
+#
+QMP_TIMEOUT = 10
 
 class QMP():
-    
-    def __init__(self, path):
+
+    def __init__(self, path, sock: socket.socket = None):
         """
         Init QMP connection to
 
+        After negotiation a dedicated reader thread owns the receiving
+        side of the socket. Commands are tagged with an id and their
+        replies resolve the matching future, so any number of threads
+        can share (and pipeline over) one QMP connection.
+
         :param path: The QEMU unix socket path
+        :param sock: Already connected socket to use instead of path
         """
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect(path)
-    
-        hello_msg = self.receive_qmp_message()
-
-        self.send_qmp_message({
-                "execute": "qmp_capabilities"
-            }) 
-       
-        capabilities = self.receive_qmp_message()
-        if(capabilities['return'] != { }):
+        self.decoder = QMPStreamDecoder()
+        self.replies = deque()
+        self.events = deque(maxlen=256)
+        self.event_handlers = [ ]
+
+        self.send_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = { }
+        self.ids = itertools.count(1)
+        self.reader = None
+        self.connected = False
+
+        if(sock is None):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+
+        self.sock = sock
+        self.sock.settimeout(QMP_TIMEOUT)
+
+        try:
+            hello_msg = self.receive_qmp_message()
+
+            self.send_qmp_message({
+                    "execute": "qmp_capabilities"
+                })
+
+            capabilities = self.receive_qmp_message()
+        except OSError as ex:
+            log.error(f"QMP negotiation failed: {ex}")
+            capabilities = None
+
+        if(capabilities is None or capabilities.get('return') != { }):
             self.destroy()
             return
 
+        self.sock.settimeout(None)
+        self.connected = True
+        self.reader = threading.Thread(target=self.reader_loop, name="qmp-reader", daemon=True)
+        self.reader.start()
+
     def receive_qmp_message(self):
         """
         Get a QMP message from QEMU
-        
+
+        Only used during negotiation, afterwards the reader
+        thread is the only consumer of the socket.
+
         Returns a json object (resp) or None
         """
-        buffer = b""
+        while not self.replies:
+            data = self.sock.recv(65536)
 
+            # Socket closed
+            if not data:
+                self.decoder.reset()
+                return None
+
+            for msg in self.decoder.feed(data):
+                if("event" in msg):
+                    self.events.append(msg)
+                else:
+                    self.replies.append(msg)
+
+        return self.replies.popleft()
+
+    def reader_loop(self):
+        """
+        Receive messages and dispatch replies and events
+        until the socket is closed
+        """
         while True:
-            data = self.sock.recv(4096)
-            
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                data = b""
+
             # Socket closed
             if not data:
                 break
 
-            buffer += data
+            for msg in self.decoder.feed(data):
+                if("event" in msg):
+                    self.dispatch_event(msg)
+                    continue
+
+                with self.pending_lock:
+                    future = self.pending.pop(msg.get("id"), None)
+
+                if(future is None):
+                    log.debug(f"Discarding unmatched QMP reply: {msg}")
+                    continue
+
+                future.set_result(msg)
+
+        self.fail_pending()
+
+    def dispatch_event(self, event):
+        """
+        Queue an async event and notify all event handlers
+        """
+        self.events.append(event)
+
+        for handler in list(self.event_handlers):
             try:
-                return json.loads(buffer.decode("utf-8"))
+                handler(event)
+            except Exception as ex:
+                log.error(f"QMP event handler failed: {ex}")
+
+    def fail_pending(self):
+        """
+        Mark the connection closed and resolve all
+        outstanding futures with None
+        """
+        with self.pending_lock:
+            self.connected = False
+            pending = self.pending
+            self.pending = { }
+
+        for future in pending.values():
+            if(not future.done()):
+                future.set_result(None)
+
+    def register_event_handler(self, callback):
+        """
+        Register callback(event) for QMP async events.
+        Called from the reader thread.
+        """
+        self.event_handlers.append(callback)
 
-            # Not a full json object yet
-            except json.JSONDecodeError:
-                pass
-       
-        return None
+    def unregister_event_handler(self, callback):
+        """
+        Unregister QMP event handler
+        """
+        self.event_handlers.remove(callback)
+
+    def get_events(self) -> list:
+        """
+        Get and clear all queued QMP events
+        """
+        events = list(self.events)
+        self.events.clear()
+        return events
 
     def send_qmp_message(self, qmp_msg):
         """
         Send a QMP message to the socket
         """
-        msg = json.dumps(qmp_msg)
-        self.sock.send(msg.encode("utf-8"))
-    
-    def execute_qmp_command(self, qmp_msg):
+        msg = json.dumps(qmp_msg) + "\n"
+        with self.send_lock:
+            self.sock.sendall(msg.encode("utf-8"))
+
+    def execute_qmp_command_async(self, qmp_msg) -> Future:
+        """
+        Send QMP message without waiting for the response
+
+        Returns a future resolving to the response, or
+        to None if the connection is closed.
+        """
+        future = Future()
+        msg_id = f"r9xd-{next(self.ids)}"
+        qmp_msg = dict(qmp_msg, id=msg_id)
+        future.qmp_id = msg_id
+
+        # checked under the lock of fail_pending, a future that gets
+        # in is always resolved by it
+        with self.pending_lock:
+            if(not self.connected):
+                future.set_result(None)
+                return future
+
+            self.pending[msg_id] = future
+
+        try:
+            self.send_qmp_message(qmp_msg)
+        except OSError as ex:
+            log.error(f"Could not send QMP message: {ex}")
+            with self.pending_lock:
+                self.pending.pop(msg_id, None)
+            future.set_result(None)
+
+        return future
+
+    def execute_qmp_command(self, qmp_msg, timeout: float = QMP_TIMEOUT):
         """
         Send QMP message and await a response
+
+        Returns a json object (resp) or None on timeout
+        or closed connection
         """
-        self.send_qmp_message(qmp_msg)
-        return self.receive_qmp_message()
+        future = self.execute_qmp_command_async(qmp_msg)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            with self.pending_lock:
+                self.pending.pop(future.qmp_id, None)
+
+            log.warn(f"QMP command '{qmp_msg.get('execute')}' timed out after {timeout}s")
+            return None
 
     def destroy(self):
+        self.connected = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
         self.sock.close()
-        
+
+        if(self.reader is not None and self.reader is not threading.current_thread()):
+            self.reader.join(1)
+
+        self.fail_pending()
+
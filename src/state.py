@@ -0,0 +1,40 @@
+from vm.registry import VMRegistry
+from vm.pool import VMPool
+from vm.telemetry import TelemetrySampler
+from vm.maintenance import MaintenanceWorker
+from vm.backup import BackupScheduler
+
+#
+# Daemon configuration and the objects shared by main and the
+# endpoints. They live here and not in main.py: started as a script,
+# main.py runs as __main__ and "import main" would create a second
+# copy of everything that main() never starts.
+#
+CONF = {
+    "host": "0.0.0.0",
+    "port": 8080,
+    "qemu-bin": "qemu-system-i386",
+    "qmp-socket": "/tmp/qmpsock",
+
+    # serve the endpoints from the asyncio front end instead of branchweb
+    "async-server": False,
+
+    # pre-warmed VM pool, disabled with size 0
+    "pool-size": 0,
+    "pool-template": "default",
+    "pool-boot-time": 60,
+
+    # seconds between resource samples of all VMs, disabled with 0
+    "telemetry-interval": 5,
+
+    # hours between disk checks (and compactions) of stopped VMs, disabled with 0
+    "maintenance-interval": 24,
+
+    # hours between live backups of all running VMs, disabled with 0
+    "backup-interval": 0
+}
+VMS = VMRegistry(CONF['qemu-bin'], CONF['qmp-socket'])
+POOL = VMPool(VMS, CONF['pool-template'], CONF['pool-size'], CONF['pool-boot-time']) if CONF['pool-size'] > 0 else None
+TELEMETRY = TelemetrySampler(VMS, CONF['telemetry-interval']) if CONF['telemetry-interval'] > 0 else None
+MAINTENANCE = MaintenanceWorker(VMS, CONF['maintenance-interval'])
+BACKUPS = BackupScheduler(VMS, CONF['backup-interval']) if CONF['backup-interval'] > 0 else None
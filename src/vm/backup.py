@@ -0,0 +1,491 @@
+import os
+import json
+import time
+import threading
+
+from vm import images
+from log import log
+
+#
+# Backups of a VM, relative to the VM directory
+#
+BACKUP_DIR = "backups"
+BACKUP_INDEX = "backups.json"
+
+#
+# Persistent dirty bitmap on the win98 drive tracking the
+# clusters written since the last backup
+#
+BITMAP_NAME = "r9xd-backup"
+BACKUP_DEVICE = "win98"
+
+#
+# Retention: number of chains (a full backup and its incrementals)
+# kept, and incrementals after which "auto" starts a new chain
+#
+RETAIN_CHAINS = 2
+MAX_INCREMENTALS = 13
+
+#
+# Hours between scheduled backups of all running VMs, 0 disables
+#
+BACKUP_INTERVAL = 24
+
+#
+# Seconds the scheduler waits for a backup job before moving on
+# to the next VM
+#
+SCHEDULED_JOB_TIMEOUT = 6 * 3600
+
+BACKUP_KINDS = [ "auto", "full", "incremental" ]
+
+class BackupManager():
+
+    def __init__(self, vmm):
+        """
+        Online backups of a running VM through QMP block jobs.
+
+        A full backup (drive-backup sync=full) is started together
+        with (re)creating a persistent dirty bitmap on the win98
+        drive, in one transaction. Incrementals (sync=incremental)
+        only copy the clusters the bitmap marked since, into a qcow2
+        backed by the previous backup, so every backup is a restorable
+        chain. QEMU clears the bitmap when an incremental succeeds.
+
+        If the bitmap is lost (unclean QEMU exit, disk compaction or
+        restore) the next "auto" backup is a full one.
+        """
+        self.vmm = vmm
+        self.lock = threading.Lock()
+        self.backup_dir = os.path.join(vmm.vm_dir, BACKUP_DIR)
+        self.index_path = os.path.join(self.backup_dir, BACKUP_INDEX)
+        self.index = None
+        self.job = None
+        self.restore_status = None
+
+    def job_id(self) -> str:
+        return f"r9xd-backup-{self.vmm.vm_id}"
+
+    def load(self) -> dict:
+        """
+        Backup index of this VM, loaded once
+        """
+        if(self.index is None):
+            self.index = { "bitmap_valid": False, "backups": [ ] }
+            if(os.path.exists(self.index_path)):
+                try:
+                    with open(self.index_path, "r") as f:
+                        self.index = json.loads(f.read())
+                except Exception as ex:
+                    log.warn(f"Could not load backup index '{self.index_path}': {ex}")
+
+        return self.index
+
+    def save(self):
+        os.makedirs(self.backup_dir, exist_ok=True)
+
+        tmp_file = f"{self.index_path}.tmp"
+        with open(tmp_file, "w+") as f:
+            f.write(json.dumps(self.index))
+
+        os.replace(tmp_file, self.index_path)
+
+    def get(self, backup_id: int):
+        for entry in self.load()["backups"]:
+            if(entry["id"] == backup_id):
+                return entry
+
+        return None
+
+    def chain_of(self, entry: dict) -> list:
+        """
+        Entries needed to restore entry, oldest first
+        """
+        chain = [ entry ]
+        while chain[0]["parent"] is not None:
+            chain.insert(0, self.get(chain[0]["parent"]))
+
+        return chain
+
+    def bitmap_present(self, q) -> bool:
+        """
+        Check that QEMU has a usable backup bitmap on the drive
+        """
+        resp = q.execute_qmp_command({ "execute": "query-block" })
+        if(resp is None or "return" not in resp):
+            return False
+
+        for device in resp["return"]:
+            if(device.get("device") != BACKUP_DEVICE):
+                continue
+
+            bitmaps = device.get("inserted", { }).get("dirty-bitmaps", device.get("dirty-bitmaps", [ ]))
+            for bitmap in bitmaps:
+                if(bitmap.get("name") == BITMAP_NAME):
+                    return not bitmap.get("inconsistent", False)
+
+        return False
+
+    def backup(self, kind: str = "auto"):
+        """
+        Start a backup block job, returns the new backup entry
+        or None if it could not be started
+        """
+        q = self.vmm.get_qmp()
+        if(q is None or self.vmm.snapshot or kind not in BACKUP_KINDS or self.vmm.disk_busy()):
+            return None
+
+        # QMP events are handled on the reader thread, so the lock is
+        # never held while waiting for a reply. The job is reserved
+        # first and its completion may arrive before it is recorded.
+        with self.lock:
+            self.check_job()
+            if(self.job is not None):
+                log.warn(f"A backup of VM '{self.vmm.vm_id}' is already running")
+                return None
+
+            self.job = { "entry": None, "start": time.monotonic(), "finished": False, "error": None }
+            index = self.load()
+            complete = [ entry for entry in index["backups"] if entry["state"] == "complete" ]
+            parent = complete[-1] if complete else None
+            bitmap_valid = index["bitmap_valid"]
+            backup_id = max([ entry["id"] for entry in index["backups"] ], default=0) + 1
+
+        entry = self.start_backup(q, kind, backup_id, parent, bitmap_valid)
+
+        with self.lock:
+            if(entry is None):
+                self.job = None
+                return None
+
+            self.job["entry"] = entry
+            self.index["backups"].append(entry)
+
+            # the bitmap was reset together with the start of the job
+            if(entry["kind"] == "full"):
+                self.index["bitmap_valid"] = False
+
+            log.info(f"Started {entry['kind']} backup {backup_id} of VM '{self.vmm.vm_id}'")
+            self.vmm.events.publish("BACKUP_STARTED", { "id": backup_id, "kind": entry["kind"] })
+
+            if(self.job["finished"]):
+                self.finish(self.job["error"])
+            else:
+                self.save()
+
+            return dict(entry)
+
+    def start_backup(self, q, kind: str, backup_id: int, parent: dict, bitmap_valid: bool):
+        """
+        Pick the backup kind and start the block job, returns
+        the backup entry or None
+        """
+        can_increment = parent is not None and bitmap_valid and self.bitmap_present(q)
+        if(kind == "incremental" and not can_increment):
+            log.warn(f"No valid backup chain or bitmap for VM '{self.vmm.vm_id}', a full backup is required")
+            return None
+
+        if(kind == "auto"):
+            kind = "incremental" if can_increment and len(self.chain_of(parent)) <= MAX_INCREMENTALS else "full"
+
+        os.makedirs(self.backup_dir, exist_ok=True)
+        target = os.path.abspath(os.path.join(self.backup_dir,
+                f"{backup_id:05d}-{time.strftime('%Y%m%d-%H%M%S')}-{kind}.qcow2"))
+
+        if(kind == "full"):
+            cmd = self.full_backup_command(q, target)
+        else:
+            # the target continues the chain of the previous backup
+            if(images.run_qemu_img([ "create", "-f", "qcow2", "-F", "qcow2", "-b", parent["file"], target ]) is None):
+                return None
+
+            cmd = {
+                "execute": "drive-backup",
+                "arguments": {
+                    "job-id": self.job_id(),
+                    "device": BACKUP_DEVICE,
+                    "target": target,
+                    "format": "qcow2",
+                    "mode": "existing",
+                    "sync": "incremental",
+                    "bitmap": BITMAP_NAME
+                }
+            }
+
+        resp = q.execute_qmp_command(cmd)
+        if(not self.vmm.qmp_succeeded(resp)):
+            if(os.path.exists(target)):
+                os.unlink(target)
+            return None
+
+        return {
+            "id": backup_id,
+            "kind": kind,
+            "parent": parent["id"] if kind == "incremental" else None,
+            "file": target,
+            "created": time.time(),
+            "state": "running",
+            "duration_ms": None,
+            "size": None,
+            "error": None
+        }
+
+    def full_backup_command(self, q, target: str) -> dict:
+        """
+        Transaction (re)setting the bitmap and starting a full backup
+        at the same point in time
+        """
+        if(self.bitmap_present(q)):
+            bitmap_action = {
+                "type": "block-dirty-bitmap-clear",
+                "data": { "node": BACKUP_DEVICE, "name": BITMAP_NAME }
+            }
+        else:
+            # drop a leftover (inconsistent) bitmap first
+            q.execute_qmp_command({
+                "execute": "block-dirty-bitmap-remove",
+                "arguments": { "node": BACKUP_DEVICE, "name": BITMAP_NAME }
+            })
+
+            bitmap_action = {
+                "type": "block-dirty-bitmap-add",
+                "data": { "node": BACKUP_DEVICE, "name": BITMAP_NAME, "persistent": True }
+            }
+
+        return {
+            "execute": "transaction",
+            "arguments": {
+                "actions": [
+                    bitmap_action,
+                    {
+                        "type": "drive-backup",
+                        "data": {
+                            "job-id": self.job_id(),
+                            "device": BACKUP_DEVICE,
+                            "target": target,
+                            "format": "qcow2",
+                            "sync": "full"
+                        }
+                    }
+                ]
+            }
+        }
+
+    def on_event(self, event: dict):
+        """
+        Finish the running backup on its block job events
+        """
+        if(event.get("event") not in [ "BLOCK_JOB_COMPLETED", "BLOCK_JOB_CANCELLED", "BLOCK_JOB_ERROR" ]):
+            return
+
+        data = event.get("data", { })
+        if(data.get("device") != self.job_id()):
+            return
+
+        if(event["event"] == "BLOCK_JOB_ERROR"):
+            # the job stops or retries on its own, completion follows
+            log.warn(f"I/O error during backup of VM '{self.vmm.vm_id}': {data.get('operation')}")
+            return
+
+        if(event["event"] == "BLOCK_JOB_COMPLETED" and "error" not in data):
+            error = None
+        else:
+            error = data.get("error", "Backup job cancelled")
+
+        with self.lock:
+            if(self.job is None):
+                return
+
+            # completed before backup() recorded it
+            if(self.job["entry"] is None):
+                self.job["finished"] = True
+                self.job["error"] = error
+                return
+
+            self.finish(error)
+
+    def check_job(self):
+        """
+        Fail a running backup whose QEMU went away (lock held)
+        """
+        if(self.job is not None and self.job["entry"] is not None and not self.vmm.is_running()):
+            self.finish("VirtualMachine stopped during the backup")
+
+    def finish(self, error: str):
+        """
+        Record the result of the running backup (lock held)
+        """
+        entry = self.job["entry"]
+        entry["duration_ms"] = round((time.monotonic() - self.job["start"]) * 1000, 1)
+        self.job = None
+
+        if(error is None):
+            entry["state"] = "complete"
+            entry["size"] = os.path.getsize(entry["file"])
+            if(entry["kind"] == "full"):
+                self.index["bitmap_valid"] = True
+
+            log.info(f"Backup {entry['id']} of VM '{self.vmm.vm_id}' complete: {entry['size']} bytes in {entry['duration_ms']}ms")
+            self.apply_retention()
+        else:
+            entry["state"] = "failed"
+            entry["error"] = error
+            if(os.path.exists(entry["file"])):
+                os.unlink(entry["file"])
+
+            log.error(f"Backup {entry['id']} of VM '{self.vmm.vm_id}' failed: {error}")
+
+        self.save()
+        self.vmm.events.publish("BACKUP_FINISHED", { "id": entry["id"], "state": entry["state"], "error": entry["error"] })
+
+    def apply_retention(self):
+        """
+        Delete whole chains older than the newest RETAIN_CHAINS
+        and all failed entries (lock held)
+        """
+        backups = self.index["backups"]
+        fulls = [ entry["id"] for entry in backups if entry["kind"] == "full" and entry["state"] == "complete" ]
+        if(len(fulls) <= RETAIN_CHAINS):
+            oldest_kept = None
+        else:
+            oldest_kept = fulls[-RETAIN_CHAINS]
+
+        kept = [ ]
+        for entry in backups:
+            expired = oldest_kept is not None and entry["id"] < oldest_kept
+            if(expired or entry["state"] == "failed"):
+                if(os.path.exists(entry["file"])):
+                    os.unlink(entry["file"])
+                continue
+
+            kept.append(entry)
+
+        if(len(kept) != len(backups)):
+            log.info(f"Removed {len(backups) - len(kept)} expired backup(s) of VM '{self.vmm.vm_id}'")
+
+        self.index["backups"] = kept
+
+    def restore(self, backup_id: int) -> bool:
+        """
+        Replace the disk of the (stopped) VM with the state of a
+        backup, flattening its chain. Runs in the background.
+        """
+        with self.lock:
+            entry = self.get(backup_id)
+            if(entry is None or entry["state"] != "complete"):
+                return False
+
+            if(not self.vmm.claim_disk("restore")):
+                return False
+
+            self.restore_status = {
+                "id": backup_id,
+                "state": "running",
+                "duration_ms": None,
+                "error": None
+            }
+
+        threading.Thread(target=self.restore_worker, args=(entry,), name="backup-restore", daemon=True).start()
+        return True
+
+    def restore_worker(self, entry: dict):
+        start = time.monotonic()
+        disk_path = self.vmm.disk_path
+        tmp_path = f"{disk_path}.restore"
+
+        if(images.run_qemu_img([ "convert", "-O", "qcow2", entry["file"], tmp_path ]) is None):
+            if(os.path.exists(tmp_path)):
+                os.unlink(tmp_path)
+
+            self.restore_status["state"] = "failed"
+            self.restore_status["error"] = "qemu-img convert failed"
+        else:
+            os.replace(tmp_path, disk_path)
+
+            # neither the saved machine state nor the bitmap match the disk anymore
+            self.vmm.discard_saved_state()
+            with self.lock:
+                self.load()["bitmap_valid"] = False
+                self.save()
+
+            self.restore_status["state"] = "complete"
+            log.info(f"Restored VM '{self.vmm.vm_id}' from backup {entry['id']}")
+
+        self.restore_status["duration_ms"] = round((time.monotonic() - start) * 1000, 1)
+        self.vmm.release_disk()
+
+    def get_progress(self):
+        """
+        Progress in percent of the running backup job or None
+        """
+        q = self.vmm.get_qmp()
+        if(q is None):
+            return None
+
+        resp = q.execute_qmp_command({ "execute": "query-block-jobs" })
+        if(resp is None or "return" not in resp):
+            return None
+
+        for job in resp["return"]:
+            if(job.get("device") == self.job_id() and job.get("len")):
+                return round(job["offset"] * 100 / job["len"], 1)
+
+        return None
+
+    def get_status(self) -> dict:
+        with self.lock:
+            self.check_job()
+            index = self.load()
+            running = dict(self.job["entry"]) if self.job is not None and self.job["entry"] is not None else None
+            backups = [ dict(entry) for entry in index["backups"] ]
+            bitmap_valid = index["bitmap_valid"]
+
+        if(running is not None):
+            running["progress"] = self.get_progress()
+
+        return {
+            "running": running,
+            "backups": backups,
+            "bitmap_valid": bitmap_valid,
+            "restore": dict(self.restore_status) if self.restore_status is not None else None
+        }
+
+class BackupScheduler():
+
+    def __init__(self, registry, interval: float = BACKUP_INTERVAL):
+        """
+        Background thread taking an "auto" backup of every running
+        VM, one VM at a time
+        """
+        self.registry = registry
+        self.interval = interval
+
+    def start(self):
+        threading.Thread(target=self.schedule_loop, name="backup-schedule", daemon=True).start()
+        log.info(f"Backups scheduled every {self.interval}h")
+
+    def schedule_loop(self):
+        while True:
+            time.sleep(self.interval * 3600)
+
+            for vm_id, vmm in list(self.registry.vms.items()):
+                try:
+                    self.backup_vm(vm_id, vmm)
+                except Exception as ex:
+                    log.error(f"Scheduled backup of VM '{vm_id}' failed: {ex}")
+
+    def backup_vm(self, vm_id: str, vmm):
+        """
+        Take an "auto" backup and wait (bounded) for it to finish
+        """
+        if(vmm.snapshot or not vmm.is_running() or vmm.backup.backup("auto") is None):
+            return
+
+        # one block job at a time keeps the host disks responsive
+        deadline = time.monotonic() + SCHEDULED_JOB_TIMEOUT
+        while vmm.backup.get_status()["running"] is not None:
+            if(time.monotonic() > deadline):
+                log.error(f"Backup of VM '{vm_id}' still running after {SCHEDULED_JOB_TIMEOUT}s, moving on")
+                return
+
+            time.sleep(1)
@@ -0,0 +1,91 @@
+import time
+import threading
+
+from collections import deque
+
+#
+# Maximum time in seconds a client may wait for new events
+#
+MAX_WAIT = 60
+
+class EventBus():
+
+    def __init__(self, size: int = 1024):
+        """
+        Bounded in-memory event log for VM state changes.
+
+        Every event gets a sequence number, clients keep the last
+        seen number as their cursor and block until something newer
+        is published. Waiting clients do not consume any CPU and
+        slow clients can never grow memory beyond `size` events.
+        """
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.listeners = [ ]
+
+    def publish(self, name: str, data: dict = None):
+        """
+        Publish an event and wake up all waiting clients
+        """
+        with self.cond:
+            self.seq += 1
+            self.events.append({
+                "seq": self.seq,
+                "timestamp": time.time(),
+                "event": name,
+                "data": data if data is not None else { }
+            })
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+
+        for callback in listeners:
+            callback()
+
+    def add_listener(self, callback):
+        """
+        Register callback() to be called after every publish,
+        for waiters that can't block a thread (asyncio)
+        """
+        with self.cond:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.cond:
+            self.listeners.remove(callback)
+
+    def get_cursor(self) -> int:
+        """
+        Get the sequence number of the latest event
+        """
+        with self.cond:
+            return self.seq
+
+    def wait_events(self, cursor: int, timeout: float) -> dict:
+        """
+        Get all events newer than cursor, block up to timeout
+        seconds if there are none yet.
+
+        Returns a dict with the new cursor, the events and the
+        amount of events that were dropped before the client
+        could fetch them.
+        """
+        timeout = max(0, min(timeout, MAX_WAIT))
+
+        with self.cond:
+            # client is ahead of us (daemon restarted), start over
+            if(cursor > self.seq):
+                cursor = 0
+
+            self.cond.wait_for(lambda: self.seq > cursor, timeout)
+
+            events = [ ev for ev in self.events if ev["seq"] > cursor ]
+            missed = 0
+            if(events):
+                missed = events[0]["seq"] - cursor - 1
+
+            return {
+                "cursor": self.seq,
+                "events": events,
+                "missed": missed
+            }
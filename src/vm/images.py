@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import time
+import subprocess
+
+from log import log
+
+QEMU_IMG = "qemu-img"
+
+#
+# Directory of read-only golden images (installed once, shared by all VMs)
+#
+GOLDEN_DIR = "golden"
+
+#
+# Allowed golden image names
+#
+GOLDEN_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+PREALLOCATION_MODES = [ "off", "metadata", "falloc", "full" ]
+
+#
+# runs qemu-img with the given arguments,
+# returns the completed process or None on failure
+#
+def run_qemu_img(args: list):
+    try:
+        proc = subprocess.run([ QEMU_IMG ] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        log.error(f"Could not run '{QEMU_IMG}': not found")
+        return None
+
+    if(proc.returncode != 0):
+        log.error(f"qemu-img {args[0]} failed: {proc.stderr.decode('utf-8', errors='replace').strip()}")
+        return None
+
+    return proc
+
+#
+# checks cluster size and preallocation options,
+# returns an error message or None
+#
+def check_create_options(cluster_size: int = None, preallocation: str = None):
+    if(cluster_size is not None):
+        if(cluster_size < 512 or cluster_size > 2 * 1024 * 1024 or cluster_size & (cluster_size - 1)):
+            return "cluster_size must be a power of two between 512 and 2M"
+
+    if(preallocation is not None and preallocation not in PREALLOCATION_MODES):
+        return f"preallocation must be one of {', '.join(PREALLOCATION_MODES)}"
+
+    return None
+
+#
+# builds the -o option list for qemu-img create
+#
+def create_options(cluster_size: int = None, preallocation: str = None) -> list:
+    opts = [ ]
+    if(cluster_size is not None):
+        opts.append(f"cluster_size={cluster_size}")
+
+    if(preallocation is not None):
+        opts.append(f"preallocation={preallocation}")
+
+    if(not opts):
+        return [ ]
+
+    return [ "-o", ",".join(opts) ]
+
+#
+# creates a fresh, empty qcow2 image
+#
+def create_image(path: str, size_mb: int, cluster_size: int = None, preallocation: str = None) -> bool:
+    args = [ "create", "-f", "qcow2" ] + create_options(cluster_size, preallocation) + [ path, f"{size_mb}M" ]
+    return run_qemu_img(args) is not None
+
+#
+# creates a thin qcow2 overlay on top of a golden image
+#
+def create_overlay(path: str, golden: str, cluster_size: int = None, preallocation: str = None) -> bool:
+    backing = golden_path(golden)
+    if(backing is None):
+        log.error(f"No such golden image: '{golden}'")
+        return False
+
+    start = time.monotonic()
+    args = [ "create", "-f", "qcow2", "-F", "qcow2", "-b", os.path.abspath(backing) ] + \
+            create_options(cluster_size, preallocation) + [ path ]
+
+    if(run_qemu_img(args) is None):
+        return False
+
+    log.info(f"Created overlay '{path}' on golden image '{golden}' in {round((time.monotonic() - start) * 1000, 1)}ms")
+    return True
+
+#
+# get image info from qemu-img or None
+#
+def image_info(path: str):
+    proc = run_qemu_img([ "info", "--output=json", path ])
+    if(proc is None):
+        return None
+
+    return json.loads(proc.stdout.decode("utf-8"))
+
+#
+# get the path of a golden image or None if it does not exist
+#
+def golden_path(name: str):
+    if(not GOLDEN_NAME_PATTERN.match(name)):
+        return None
+
+    path = os.path.join(GOLDEN_DIR, f"{name}.qcow2")
+    if(not os.path.exists(path)):
+        return None
+
+    return path
+
+#
+# list all golden images
+#
+def list_golden() -> dict:
+    if(not os.path.isdir(GOLDEN_DIR)):
+        return { }
+
+    images = { }
+    for entry in os.scandir(GOLDEN_DIR):
+        if(not entry.name.endswith(".qcow2")):
+            continue
+
+        st = entry.stat()
+        images[entry.name[:-len(".qcow2")]] = {
+            "size": st.st_size,
+            "mtime": st.st_mtime
+        }
+
+    return images
+
+#
+# turns a (stopped) VM disk into a read-only golden image.
+# The disk is converted, so any backing chain gets flattened.
+#
+def promote(disk_path: str, name: str) -> bool:
+    if(not GOLDEN_NAME_PATTERN.match(name)):
+        log.error(f"Invalid golden image name: '{name}'")
+        return False
+
+    if(not os.path.exists(GOLDEN_DIR)):
+        os.mkdir(GOLDEN_DIR)
+
+    target = os.path.join(GOLDEN_DIR, f"{name}.qcow2")
+    if(os.path.exists(target)):
+        log.error(f"Golden image '{name}' already exists")
+        return False
+
+    tmp_target = f"{target}.tmp"
+    if(run_qemu_img([ "convert", "-O", "qcow2", disk_path, tmp_target ]) is None):
+        if(os.path.exists(tmp_target)):
+            os.unlink(tmp_target)
+        return False
+
+    os.chmod(tmp_target, 0o444)
+    os.replace(tmp_target, target)
+    log.info(f"Promoted '{disk_path}' to golden image '{name}'")
+    return True
@@ -0,0 +1,308 @@
+import re
+import time
+import threading
+
+from log import log
+
+#
+# Keystrokes sent per input-send-event command while typing text.
+# The emulated PS/2 keyboard has a small scancode queue, more
+# keystrokes per command would be dropped by the guest.
+#
+KEYS_PER_COMMAND = 4
+
+#
+# Seconds between typing commands, time for the guest to drain
+# the keyboard queue
+#
+TYPING_INTERVAL = 0.02
+
+#
+# Seconds a mouse button is held down for a click. Button state
+# is only reported on sync, so press and release can't share a command.
+#
+CLICK_HOLD = 0.05
+
+#
+# Limits of a single request
+#
+MAX_ACTIONS = 1000
+MAX_TEXT_LENGTH = 10000
+MAX_DURATION = 300
+MAX_CLICKS = 100
+MAX_EVENTS = 20000
+
+QCODE_PATTERN = re.compile(r"^[a-z0-9_]{1,20}$")
+
+MOUSE_BUTTONS = [ "left", "middle", "right", "wheel-up", "wheel-down" ]
+
+#
+# Friendly key names -> QEMU qcodes, anything else is used as qcode
+#
+KEY_ALIASES = {
+    "enter": "ret",
+    "return": "ret",
+    "space": "spc",
+    "del": "delete",
+    "escape": "esc",
+    "win": "meta_l",
+    "windows": "meta_l",
+    "menu": "compose",
+    "pageup": "pgup",
+    "pagedown": "pgdn",
+    "ins": "insert",
+    "control": "ctrl"
+}
+
+#
+# Characters of a US keyboard layout -> (qcode, shifted)
+#
+CHAR_KEYS = {
+    " ": ("spc", False), "\n": ("ret", False), "\t": ("tab", False),
+    "-": ("minus", False), "=": ("equal", False), "[": ("bracket_left", False),
+    "]": ("bracket_right", False), "\\": ("backslash", False), ";": ("semicolon", False),
+    "'": ("apostrophe", False), "`": ("grave_accent", False), ",": ("comma", False),
+    ".": ("dot", False), "/": ("slash", False),
+    "!": ("1", True), "@": ("2", True), "#": ("3", True), "$": ("4", True),
+    "%": ("5", True), "^": ("6", True), "&": ("7", True), "*": ("8", True),
+    "(": ("9", True), ")": ("0", True), "_": ("minus", True), "+": ("equal", True),
+    "{": ("bracket_left", True), "}": ("bracket_right", True), "|": ("backslash", True),
+    ":": ("semicolon", True), "\"": ("apostrophe", True), "~": ("grave_accent", True),
+    "<": ("comma", True), ">": ("dot", True), "?": ("slash", True)
+}
+
+#
+# input-send-event key event
+#
+def key_event(qcode: str, down: bool) -> dict:
+    return {
+        "type": "key",
+        "data": {
+            "down": down,
+            "key": { "type": "qcode", "data": qcode }
+        }
+    }
+
+#
+# input-send-event mouse button event
+#
+def button_event(button: str, down: bool) -> dict:
+    return {
+        "type": "btn",
+        "data": { "down": down, "button": button }
+    }
+
+#
+# input-send-event relative mouse motion, one event per axis
+#
+def move_events(dx: int, dy: int) -> list:
+    events = [ ]
+    if(dx):
+        events.append({ "type": "rel", "data": { "axis": "x", "value": dx } })
+    if(dy):
+        events.append({ "type": "rel", "data": { "axis": "y", "value": dy } })
+
+    return events
+
+#
+# resolve a key name to a qcode, None if invalid
+#
+def resolve_key(name: str):
+    if(not isinstance(name, str)):
+        return None
+
+    qcode = KEY_ALIASES.get(name.lower(), name.lower())
+    return qcode if QCODE_PATTERN.match(qcode) else None
+
+#
+# key events typing a single character, None if it can't be typed
+#
+def char_events(char: str):
+    if(char.isascii() and char.isalnum()):
+        qcode, shifted = char.lower(), char.isupper()
+    elif(char in CHAR_KEYS):
+        qcode, shifted = CHAR_KEYS[char]
+    else:
+        return None
+
+    if(shifted):
+        return [ key_event("shift", True), key_event(qcode, True), key_event(qcode, False), key_event("shift", False) ]
+
+    return [ key_event(qcode, True), key_event(qcode, False) ]
+
+#
+# parse a duration in milliseconds to seconds, negative values are 0
+#
+def parse_ms(value) -> float:
+    return max(0.0, float(value)) / 1000
+
+#
+# translate a list of input actions to a plan, raises ValueError
+# or TypeError if they are invalid or exceed the request limits
+#
+def plan_actions(actions: list):
+    if(not isinstance(actions, list) or len(actions) > MAX_ACTIONS):
+        raise ValueError(f"actions must be a list of at most {MAX_ACTIONS} entries")
+
+    plan = InputPlan()
+    for action in actions:
+        if(not isinstance(action, dict)):
+            raise ValueError("Every action must be an object")
+
+        plan.add_action(action)
+
+    if(plan.duration > MAX_DURATION):
+        raise ValueError(f"Input would take longer than {MAX_DURATION} seconds")
+
+    return plan
+
+class InputPlan():
+
+    def __init__(self):
+        """
+        Schedule of input events. Events without a delay between
+        them are merged into a single input-send-event command.
+        """
+        self.steps = [ ]
+        self.duration = 0.0
+        self.events = 0
+
+    def add(self, events: list, delay: float = 0.0):
+        """
+        Queue events, followed by a pause of delay seconds
+        """
+        self.events += len(events)
+        if(self.events > MAX_EVENTS):
+            raise ValueError(f"Input would send more than {MAX_EVENTS} events")
+
+        if(self.steps and self.steps[-1][1] == 0):
+            self.steps[-1][0].extend(events)
+            self.steps[-1][1] = delay
+        else:
+            self.steps.append([ list(events), delay ])
+
+        self.duration += delay
+
+    def add_text(self, text: str):
+        strokes = [ ]
+        for char in text:
+            events = char_events(char)
+            if(events is None):
+                raise ValueError(f"Can't type character {char!r}")
+            strokes.append(events)
+
+        for pos in range(0, len(strokes), KEYS_PER_COMMAND):
+            batch = strokes[pos:pos + KEYS_PER_COMMAND]
+            self.add([ event for events in batch for event in events ], TYPING_INTERVAL)
+
+    def add_action(self, action: dict):
+        """
+        Add a single action of a request, raises ValueError
+        """
+        kind = action.get("type")
+
+        if(kind == "text"):
+            text = action.get("text")
+            if(not isinstance(text, str) or len(text) > MAX_TEXT_LENGTH):
+                raise ValueError(f"text must be a string of at most {MAX_TEXT_LENGTH} characters")
+
+            self.add_text(text)
+
+        elif(kind == "key"):
+            keys = action.get("keys")
+            if(isinstance(keys, str)):
+                keys = [ keys ]
+
+            qcodes = [ resolve_key(key) for key in keys or [ ] ]
+            if(not qcodes or None in qcodes):
+                raise ValueError(f"Invalid keys: {keys}")
+
+            # combos: press in order, release in reverse order
+            hold = parse_ms(action.get("hold_ms", 0))
+            self.add([ key_event(qcode, True) for qcode in qcodes ], hold)
+            self.add([ key_event(qcode, False) for qcode in reversed(qcodes) ], TYPING_INTERVAL)
+
+        elif(kind == "move"):
+            self.add(move_events(int(action.get("dx", 0)), int(action.get("dy", 0))))
+
+        elif(kind == "click"):
+            button = action.get("button", "left")
+            if(button not in MOUSE_BUTTONS):
+                raise ValueError(f"Invalid mouse button: {button}")
+
+            count = int(action.get("count", 1))
+            if(count < 1 or count > MAX_CLICKS):
+                raise ValueError(f"count must be between 1 and {MAX_CLICKS}")
+
+            for i in range(count):
+                self.add([ button_event(button, True) ], CLICK_HOLD)
+                self.add([ button_event(button, False) ], CLICK_HOLD)
+
+        elif(kind in [ "press", "release" ]):
+            button = action.get("button", "left")
+            if(button not in MOUSE_BUTTONS):
+                raise ValueError(f"Invalid mouse button: {button}")
+
+            self.add([ button_event(button, kind == "press") ], CLICK_HOLD)
+
+        elif(kind == "wait"):
+            self.add([ ], parse_ms(action.get("ms", 0)))
+
+        else:
+            raise ValueError(f"Unknown action type: {kind}")
+
+class InputInjector():
+
+    def __init__(self, vmm):
+        """
+        Runs input plans against a VM. Requests are serialized,
+        so concurrent scripts never interleave their keystrokes.
+        """
+        self.vmm = vmm
+        self.lock = threading.Lock()
+
+    def send(self, plan: InputPlan) -> dict:
+        """
+        Send a plan built by plan_actions, blocks until
+        all of its events are delivered.
+
+        Returns a dict with the amount of commands and events sent,
+        the duration and an error message (or None)
+        """
+        with self.lock:
+            start = time.monotonic()
+            commands = 0
+            events = 0
+
+            for step_events, delay in plan.steps:
+                if(step_events):
+                    q = self.vmm.get_qmp()
+                    if(q is None):
+                        return self.result(commands, events, time.monotonic() - start, "VirtualMachine is not running")
+
+                    resp = q.execute_qmp_command({
+                        "execute": "input-send-event",
+                        "arguments": { "events": step_events }
+                    })
+
+                    if(not self.vmm.qmp_succeeded(resp)):
+                        return self.result(commands, events, time.monotonic() - start, "input-send-event failed")
+
+                    commands += 1
+                    events += len(step_events)
+
+                if(delay):
+                    time.sleep(delay)
+
+            duration = time.monotonic() - start
+
+        log.debug(f"Sent {events} input event(s) in {commands} command(s) to VM '{self.vmm.vm_id}'")
+        return self.result(commands, events, duration, None)
+
+    def result(self, commands: int, events: int, duration: float, error: str) -> dict:
+        return {
+            "commands": commands,
+            "events": events,
+            "duration_ms": round(duration * 1000),
+            "error": error
+        }
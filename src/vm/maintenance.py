@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import shutil
+import itertools
+import threading
+import subprocess
+
+from collections import deque
+
+from vm import images
+from log import log
+
+#
+# Hours between scheduled checks of all stopped VMs, 0 disables
+#
+MAINTENANCE_INTERVAL = 24
+
+#
+# A check queues a compaction if at least this much space (bytes)
+# and this fraction of the file can be reclaimed, or if this
+# fraction of the allocated clusters is fragmented
+#
+COMPACT_MIN_RECLAIM = 256 * 1024 * 1024
+COMPACT_MIN_RATIO = 0.2
+COMPACT_FRAGMENTATION = 0.25
+
+#
+# Finished jobs kept for status queries
+#
+JOB_HISTORY_SIZE = 50
+
+JOB_KINDS = [ "check", "compact", "compress" ]
+
+#
+# qemu-img check exit codes with a usable report
+# (0: clean, 2: corruptions, 3: leaked clusters only)
+#
+CHECK_REPORT_CODES = [ 0, 2, 3 ]
+
+#
+# command prefix running qemu-img with idle I/O priority and
+# lowest CPU priority, whatever of it is available on the host
+#
+def throttle_prefix() -> list:
+    prefix = [ ]
+    if(shutil.which("ionice") is not None):
+        prefix += [ "ionice", "-c", "3" ]
+
+    if(shutil.which("nice") is not None):
+        prefix += [ "nice", "-n", "19" ]
+
+    return prefix
+
+#
+# get the space (bytes) a file occupies on disk
+#
+def disk_usage(path: str) -> int:
+    return os.stat(path).st_blocks * 512
+
+class MaintenanceWorker():
+
+    def __init__(self, registry, interval: float = MAINTENANCE_INTERVAL):
+        """
+        Background worker running qemu-img maintenance jobs on the
+        disks of stopped VMs and on golden images, one at a time.
+
+        check:    qemu-img check, queues a compaction if worthwhile
+        compact:  convert into a fresh image (keeping the backing file
+                  of overlays) and swap it in atomically. Clusters the
+                  guest zeroed are dropped and the layout is sequential
+                  again. Space of deleted guest files is only reclaimed
+                  once the guest zeroed it.
+        compress: compressed convert of a golden image
+
+        qemu-img runs with idle I/O priority. While a job works on a
+        disk its VMs can't be started, suspended, backed up or have
+        their media changed.
+
+        :param registry: VMRegistry of all VMs
+        :param interval: Hours between scheduled checks, 0 disables
+        """
+        self.registry = registry
+        self.interval = interval
+
+        self.cond = threading.Condition()
+        self.queue = deque()
+        self.history = deque(maxlen=JOB_HISTORY_SIZE)
+        self.current = None
+        self.ids = itertools.count(1)
+
+        self.bytes_reclaimed = 0
+
+    def start(self):
+        threading.Thread(target=self.work_loop, name="maintenance", daemon=True).start()
+
+        if(self.interval > 0):
+            threading.Thread(target=self.schedule_loop, name="maintenance-schedule", daemon=True).start()
+            log.info(f"Disk maintenance scheduled every {self.interval}h")
+
+    def submit(self, kind: str, vm_id: str = None, golden: str = None, auto_compact: bool = False):
+        """
+        Queue a job for a VM disk (check, compact) or a golden image
+        (check, compress). Returns the job or None if it is invalid
+        or already queued.
+        """
+        if(kind not in JOB_KINDS):
+            return None
+
+        if((vm_id is None) == (golden is None) or (kind == "compress" and golden is None)
+                or (kind == "compact" and vm_id is None)):
+            return None
+
+        job = {
+            "id": next(self.ids),
+            "kind": kind,
+            "vm": vm_id,
+            "golden": golden,
+            "auto_compact": auto_compact,
+            "state": "queued",
+            "progress": None,
+            "queued_at": time.time(),
+            "duration_ms": None,
+            "result": None,
+            "error": None
+        }
+
+        with self.cond:
+            for queued in [ self.current ] + list(self.queue):
+                if(queued is not None and (queued["kind"], queued["vm"], queued["golden"]) == (kind, vm_id, golden)):
+                    return None
+
+            self.queue.append(job)
+            self.cond.notify()
+
+        log.info(f"Queued {kind} of {self.describe(job)}")
+        return job
+
+    def describe(self, job: dict) -> str:
+        return f"VM '{job['vm']}'" if job["vm"] is not None else f"golden image '{job['golden']}'"
+
+    def schedule_loop(self):
+        """
+        Periodically queue a check (with compaction) of every stopped VM
+        """
+        while True:
+            time.sleep(self.interval * 3600)
+
+            for vm_id, vmm in list(self.registry.vms.items()):
+                if(not vmm.snapshot and not vmm.setup_mode and not vmm.is_running()):
+                    self.submit("check", vm_id, auto_compact=True)
+
+    def work_loop(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+
+                job = self.queue.popleft()
+                self.current = job
+
+            job["state"] = "running"
+            start = time.monotonic()
+
+            try:
+                result = self.run_job(job)
+            except Exception as ex:
+                log.error(f"Maintenance job {job['id']} failed: {ex}")
+                result = None
+                job["error"] = job["error"] or str(ex)
+
+            job["duration_ms"] = round((time.monotonic() - start) * 1000, 1)
+            job["result"] = result
+            if(job["state"] == "running"):
+                job["state"] = "failed" if job["error"] is not None else "done"
+
+            log.info(f"Maintenance {job['kind']} of {self.describe(job)}: {job['state']} in {job['duration_ms']}ms")
+
+            with self.cond:
+                self.current = None
+                self.history.append(job)
+
+    def run_job(self, job: dict):
+        if(job["golden"] is not None):
+            path = images.golden_path(job["golden"])
+            if(path is None):
+                job["error"] = f"No such golden image: '{job['golden']}'"
+                return None
+
+            if(job["kind"] == "check"):
+                return self.check(job, path)
+
+            return self.compact(job, path, compress=True)
+
+        users = self.claim(job)
+        if(users is None):
+            return None
+
+        try:
+            disk_path = users[0].disk_path
+            if(job["kind"] == "check"):
+                result = self.check(job, disk_path)
+                if(result is not None and job["auto_compact"] and result["compact"]):
+                    self.submit("compact", job["vm"])
+                return result
+
+            return self.compact(job, disk_path, preallocation=users[0].conf.get("preallocation"))
+        finally:
+            self.release(users)
+
+    def claim(self, job: dict):
+        """
+        Block starting all VMs writing to the disk of the job's VM.
+        Returns them, or None if the disk is in use.
+
+        -snapshot VMs (the pool) only read the disk, they keep the
+        old file open across the swap and don't block a job.
+        """
+        vmm = self.registry.get(job["vm"])
+        if(vmm is None or vmm.setup_mode or vmm.snapshot):
+            job["error"] = f"No such VirtualMachine (or it has no disk of its own): '{job['vm']}'"
+            return None
+
+        disk_path = os.path.realpath(vmm.disk_path)
+        users = [ vmm ] + [ other for other in list(self.registry.vms.values())
+                if other is not vmm and not other.snapshot and os.path.realpath(other.disk_path) == disk_path ]
+
+        claimed = [ ]
+        for user in users:
+            if(not user.claim_disk(job["kind"])):
+                self.release(claimed)
+                job["state"] = "skipped"
+                job["error"] = f"VirtualMachine '{user.vm_id}' is running or its disk is busy"
+                return None
+
+            claimed.append(user)
+
+        return users
+
+    def release(self, users: list):
+        for user in users:
+            user.release_disk()
+
+    def check(self, job: dict, path: str):
+        """
+        qemu-img check, returns the report with the reclaimable space
+        and whether a compaction is worthwhile
+        """
+        info = images.image_info(path)
+        if(info is None):
+            job["error"] = "Could not read image info"
+            return None
+
+        proc = self.run_throttled(job, [ images.QEMU_IMG, "check", "--output=json", path ], False)
+        if(proc is None):
+            return None
+
+        returncode, stdout, stderr = proc
+        if(returncode not in CHECK_REPORT_CODES):
+            job["error"] = f"qemu-img check failed: {stderr}"
+            return None
+
+        report = json.loads(stdout)
+        cluster_size = info.get("cluster-size", 65536)
+        usage = disk_usage(path)
+        allocated = report.get("allocated-clusters", 0)
+        fragmented = report.get("fragmented-clusters", 0)
+        reclaimable = max(0, usage - allocated * cluster_size)
+
+        result = {
+            "corruptions": report.get("corruptions", 0),
+            "leaks": report.get("leaks", 0),
+            "allocated_clusters": allocated,
+            "fragmented_clusters": fragmented,
+            "fragmentation": round(fragmented / allocated, 3) if allocated else 0,
+            "disk_usage": usage,
+            "reclaimable": reclaimable
+        }
+
+        # never rewrite a corrupt image, it needs a human
+        if(result["corruptions"]):
+            log.error(f"Image '{path}' has {result['corruptions']} corruption(s)")
+            result["compact"] = False
+        else:
+            result["compact"] = bool(result["leaks"]) or result["fragmentation"] >= COMPACT_FRAGMENTATION or \
+                    (reclaimable >= COMPACT_MIN_RECLAIM and reclaimable >= usage * COMPACT_MIN_RATIO)
+
+        return result
+
+    def compact(self, job: dict, path: str, compress: bool = False, preallocation: str = None):
+        """
+        Convert into a fresh image next to the original, verify it and
+        atomically replace the original. Returns the space reclaimed.
+        """
+        # preallocated images are meant to be large
+        if(preallocation in [ "falloc", "full" ]):
+            job["state"] = "skipped"
+            job["error"] = f"Image is preallocated ({preallocation})"
+            return None
+
+        info = images.image_info(path)
+        if(info is None):
+            job["error"] = "Could not read image info"
+            return None
+
+        usage = disk_usage(path)
+        st = os.statvfs(os.path.dirname(os.path.abspath(path)))
+        if(st.f_bavail * st.f_frsize < usage):
+            job["error"] = "Not enough free space for a copy of the image"
+            return None
+
+        tmp_path = f"{path}.maintenance"
+        args = [ images.QEMU_IMG, "convert", "-p", "-O", "qcow2" ]
+        if(compress):
+            args += [ "-c" ]
+
+        if(info.get("cluster-size") is not None):
+            args += [ "-o", f"cluster_size={info['cluster-size']}" ]
+
+        # overlays stay thin overlays of the same golden image
+        if(info.get("backing-filename") is not None):
+            args += [ "-B", info["backing-filename"], "-F", info.get("backing-filename-format", "qcow2") ]
+
+        proc = self.run_throttled(job, args + [ path, tmp_path ], True)
+        if(proc is None or proc[0] != 0):
+            if(proc is not None):
+                job["error"] = f"qemu-img convert failed: {proc[2]}"
+
+            if(os.path.exists(tmp_path)):
+                os.unlink(tmp_path)
+            return None
+
+        verify = self.run_throttled(job, [ images.QEMU_IMG, "check", tmp_path ], False)
+        if(verify is None or verify[0] != 0):
+            job["error"] = "Converted image failed the check, keeping the original"
+            os.unlink(tmp_path)
+            return None
+
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+        os.replace(tmp_path, path)
+
+        reclaimed = usage - disk_usage(path)
+        self.bytes_reclaimed += max(0, reclaimed)
+        job["progress"] = 100.0
+
+        return {
+            "disk_usage_before": usage,
+            "disk_usage_after": usage - reclaimed,
+            "reclaimed": reclaimed
+        }
+
+    def run_throttled(self, job: dict, args: list, progress: bool):
+        """
+        Run a qemu-img command with low priority, tracking its
+        progress output (-p). Returns (returncode, stdout, stderr)
+        or None if it could not be started.
+        """
+        try:
+            proc = subprocess.Popen(throttle_prefix() + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            job["error"] = f"Could not run '{images.QEMU_IMG}': not found"
+            return None
+
+        # stderr is drained by a thread, so a chatty qemu-img can't block
+        stderr = [ ]
+        reader = threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True)
+        reader.start()
+
+        stdout = b""
+        if(progress):
+            # progress lines look like "    (42.00/100%)\r"
+            while True:
+                chunk = proc.stdout.read1(4096)
+                if(not chunk):
+                    break
+
+                for line in chunk.split(b"\r"):
+                    line = line.strip()
+                    if(line.startswith(b"(") and b"/100%" in line):
+                        try:
+                            job["progress"] = float(line[1:line.index(b"/")])
+                        except ValueError:
+                            pass
+        else:
+            stdout = proc.stdout.read()
+
+        returncode = proc.wait()
+        reader.join()
+
+        return returncode, stdout.decode("utf-8", errors="replace"), b"".join(stderr).decode("utf-8", errors="replace").strip()
+
+    def get_status(self) -> dict:
+        with self.cond:
+            return {
+                "current": dict(self.current) if self.current is not None else None,
+                "queued": [ dict(job) for job in self.queue ],
+                "history": [ dict(job) for job in self.history ],
+                "bytes_reclaimed": self.bytes_reclaimed
+            }
@@ -2,34 +2,132 @@ import subprocess
 import os
 import time
 import json
+import socket
+import threading
 
-from qmp.qmp import QMP
+from collections import deque
+
+from qmp.qmp import QMP, QMP_TIMEOUT
+from qmp.cache import QMPQueryCache
+from vm.events import EventBus
+from vm.screen import ScreenCapture
+from vm.vnc import VNCProxy
+from vm.input import InputInjector
+from vm.telemetry import VMTelemetry
+from vm.backup import BackupManager
+from vm import profile
+from vm import images
+from media import catalog
+from media import store
 from log import log
 
+#
+# Time in seconds QEMU gets to bring up QMP and the guest
+#
+START_TIMEOUT = 30
+
+#
+# Amount of boot timelines kept for comparison
+#
+BOOT_HISTORY_SIZE = 20
+
+#
+# Per VM files, relative to the VM directory
+#
+CONF_FILE = "vm.json"
+DISK_FILE = "win98.qcow2"
+
+#
+# Saved machine state (RAM + device state) and its metadata
+#
+STATE_FILE = "win98.state"
+STATE_META_FILE = "win98.state.json"
+
+#
+# Time in seconds a state save or restore may take
+#
+STATE_TIMEOUT = 300
+
+def parse_cpuset(cpuset: str) -> set:
+    """
+    Parse a cpuset list like "0-3,6" into a set of CPU numbers
+    """
+    cpus = set()
+    for part in cpuset.split(","):
+        part = part.strip()
+        if("-" in part):
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        elif(part):
+            cpus.add(int(part))
+
+    return cpus
+
 class VMManager():
     
-    def __init__(self, qemu_bin: str, qmp_socket_path: str):
+    def __init__(self, qemu_bin: str, qmp_socket_path: str, vm_id: str = "default", vm_dir: str = ".", snapshot: bool = False):
         """
         Initialize VMManager class
+
+        :param vm_id: Name of the VM in the registry
+        :param vm_dir: Directory holding the disk, config and saved state
+        :param snapshot: Run with -snapshot, disk writes are thrown away
+                         and the saved state is never consumed
         """
         self.qemu_bin = qemu_bin
         self.qmp_socket_path = qmp_socket_path
+        self.vm_id = vm_id
+        self.vm_dir = vm_dir
+        self.snapshot = snapshot
+        self.conf_path = os.path.join(vm_dir, CONF_FILE)
+        self.disk_path = os.path.join(vm_dir, DISK_FILE)
+        self.state_file = os.path.join(vm_dir, STATE_FILE)
+        self.state_meta_file = os.path.join(vm_dir, STATE_META_FILE)
         self.qemu_process = None
         self.qmp = None
         self.cdrom_mode = "SCSI" # default
+        self.events = EventBus()
+        self.screen = ScreenCapture(self)
+        self.vnc = VNCProxy(self)
+        self.input = InputInjector(self)
+        self.telemetry = VMTelemetry(self)
+        self.qmp_cache = QMPQueryCache()
+        self.backup = BackupManager(self)
+        self.maintenance_job = None
+        self.disk_lock = threading.Lock()
+        self.boot_timeline = None
+        self.boot_history = deque(maxlen=BOOT_HISTORY_SIZE)
+        self.state_status = {
+            "phase": "idle",
+            "started_at": None,
+            "duration_ms": None,
+            "progress": None,
+            "error": None
+        }
 
-        if(os.path.exists("vm.json")):
+        if(os.path.exists(self.conf_path)):
             self.setup_mode = False
 
-            with open("vm.json", "r+") as f:
+            with open(self.conf_path, "r+") as f:
                 self.conf = json.loads(f.read())
 
         else:
             self.setup_mode = True
     
-    def setup(self, disk_size_mb, memory_size_mb):
+    def setup(self, disk_size_mb, memory_size_mb, cpuset: str = None, golden: str = None,
+            cluster_size: int = None, preallocation: str = None, headless: bool = False,
+            launch_profile: str = None, launch_options: dict = None) -> bool:
         """
         Initial setup for running a VM
+
+        :param cpuset: CPUs to pin QEMU to, e.g. "0-3,6", or None for all
+        :param golden: Provision the disk as thin overlay of this golden image
+                       instead of creating an empty disk (disk_size_mb is ignored)
+        :param cluster_size: qcow2 cluster size in bytes
+        :param preallocation: qcow2 preallocation mode
+        :param headless: No local display, the screen is served over VNC
+        :param launch_profile: Launch profile name (see vm.profile.PROFILES)
+        :param launch_options: Overrides of single launch profile options
         """
         
         if(not os.path.exists("iso")):
@@ -41,7 +139,16 @@ class VMManager():
         # fetch this:
         # https://github.com/JHRobotics/patcher9x/releases/download/v0.8.50/patcher9x-0.8.50-boot.ima
 
-        os.system(f"qemu-img create -f qcow2 win98.qcow2 {disk_size_mb}M")
+        if(golden is not None):
+            if(not images.create_overlay(self.disk_path, golden, cluster_size, preallocation)):
+                return False
+
+            info = images.image_info(self.disk_path)
+            if(info is not None):
+                disk_size_mb = info["virtual-size"] // (1024 * 1024)
+
+        elif(not images.create_image(self.disk_path, disk_size_mb, cluster_size, preallocation)):
+            return False
         
         # Write VM Config
         self.conf = {
@@ -50,19 +157,121 @@ class VMManager():
                 "display": "1920x1080",
                 "iso": None,
                 "floppy": None,
+                "cpuset": cpuset,
+                "golden": golden,
+                "cluster_size": cluster_size,
+                "preallocation": preallocation,
+                "headless": headless,
+                "profile": launch_profile or profile.DEFAULT_PROFILE,
+                "launch": launch_options or { },
             }
 
-        with open("vm.json", "w+") as f:
+        with open(self.conf_path, "w+") as f:
             f.write(json.dumps(self.conf))
 
         self.setup_mode = False
+        return True
+
+    def reset_to_golden(self) -> bool:
+        """
+        Throw away all changes by swapping in a fresh overlay
+        of the VM's golden image. The VM has to be stopped.
+        """
+        if(self.setup_mode or not self.conf.get("golden") or not self.claim_disk("reset")):
+            return False
+
+        try:
+            tmp_disk = f"{self.disk_path}.new"
+            if(not images.create_overlay(tmp_disk, self.conf["golden"],
+                    self.conf.get("cluster_size"), self.conf.get("preallocation"))):
+                return False
+
+            os.replace(tmp_disk, self.disk_path)
+        finally:
+            self.release_disk()
+
+        # the saved state belongs to the old disk
+        self.discard_saved_state()
+        log.info(f"VM '{self.vm_id}' reset to golden image '{self.conf['golden']}'")
+        return True
+
+    def promote_to_golden(self, name: str) -> bool:
+        """
+        Turn the (stopped) VM disk into a golden image
+        """
+        if(self.setup_mode or not self.claim_disk("promote")):
+            return False
+
+        try:
+            return images.promote(self.disk_path, name)
+        finally:
+            self.release_disk()
+
+    def claim_disk(self, job: str) -> bool:
+        """
+        Reserve the disk of the stopped VM for a job replacing or
+        reading it. Fails if the VM runs or the disk is reserved.
+        """
+        with self.disk_lock:
+            if(self.maintenance_job is not None or self.is_running()):
+                return False
+
+            self.maintenance_job = job
+            return True
+
+    def release_disk(self):
+        self.maintenance_job = None
+
+    def disk_busy(self) -> bool:
+        """
+        Check if a job (or the pool) holds the disk, operations
+        touching the disk or its state refuse meanwhile
+        """
+        job = self.maintenance_job
+        if(job is not None):
+            log.warn(f"Disk of VM '{self.vm_id}' is held ({job}), refusing")
+
+        return job is not None
+
+    def set_launch_profile(self, name: str, options: dict = None) -> bool:
+        """
+        Change the launch profile, takes effect on the next start
+        """
+        if(self.setup_mode):
+            return False
+
+        self.conf["profile"] = name
+        self.conf["launch"] = options or { }
+
+        with open(self.conf_path, "w+") as f:
+            f.write(json.dumps(self.conf))
+
+        return True
 
     def get_vmconf(self):
+        running = self.is_running()
         return {
-                "running": self.is_running(),
+                "id": self.vm_id,
+                "running": running,
+                "status": self.get_status() if running else None,
+                "media": self.get_inserted_media() if running else None,
                 "conf": self.conf
             }
 
+    def get_status(self):
+        """
+        Get the run state reported by QEMU (cached) or None
+        """
+        q = self.get_qmp()
+        if(q is None):
+            return None
+
+        resp = self.qmp_cache.query(q, "query-status")
+        if(resp is None or "return" not in resp):
+            return None
+
+        return resp["return"].get("status")
+
     def is_running(self) -> bool:
         """
         Check if VM is running.
@@ -75,61 +284,452 @@ class VMManager():
 
         return True
 
-    def start(self):
+    def start(self, restore: bool = True):
         """
         Start the VirtualMachine, establish QMP connection
+
+        If a saved machine state exists and restore is set, the VM
+        resumes from it instead of cold booting. A cold boot discards
+        the saved state, as it no longer matches the disk afterwards.
         """
-        if(self.is_running()):
+        if(self.setup_mode):
+            log.warn(f"VM '{self.vm_id}' is not set up yet, not starting")
             return False
 
-        log.info(f"Launching QEMU ({self.qemu_bin})..")
-        
-        # SCSI CD mode
-        if(self.cdrom_mode == "SCSI"):
-            log.info("Starting in SCSI CDRom mode.")
-            self.qemu_process = subprocess.Popen(
-                    [self.qemu_bin,
-                        "-nodefaults", "-rtc", "base=localtime", "-display", "sdl",
-                        "-boot", "menu=on",
-                        "-M", "pc,accel=kvm,hpet=off,usb=off", "-cpu", "host",
-                        "-qmp", f"unix:{self.qmp_socket_path},server,nowait", # QMP Unix socket
-                        "-full-screen",
-                        "-device", "VGA", "-device", "lsi", "-device", "ac97",
-                        "-netdev", "user,id=net0", "-device", "pcnet,rombar=0,netdev=net0",
-                        "-drive", "id=win98,if=none,file=win98.qcow2", "-device", "scsi-hd,drive=win98",
-                        "-drive", "id=iso,if=none,media=cdrom", "-device", "scsi-cd,drive=iso",
-                        "-drive", "id=floppy,if=floppy,format=raw,file=/dev/null",
-                     ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # IDE CD mode
-        else:
-            log.info("Starting in IDE CDRom mode.")
-            self.qemu_process = subprocess.Popen(
-                    [self.qemu_bin,
-                        "-nodefaults", "-rtc", "base=localtime", "-display", "sdl",
-                        "-boot", "menu=on",
-                        "-M", "pc,accel=kvm,hpet=off,usb=off", "-cpu", "host",
-                        "-qmp", f"unix:{self.qmp_socket_path},server,nowait", # QMP Unix socket
-                        "-full-screen",
-                        "-device", "VGA", "-device", "lsi", "-device", "ac97",
-                        "-netdev", "user,id=net0", "-device", "pcnet,rombar=0,netdev=net0",
-                        "-drive", "id=win98,if=none,file=win98.qcow2", "-device", "scsi-hd,drive=win98",
-                        "-drive", "id=iso,if=none,media=cdrom", "-device", "ide-cd,drive=iso",
-                        "-drive", "id=floppy,if=floppy,format=raw,file=/dev/null",
-                     ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        not_ready = True
-        while not_ready:
+        # a disk claimed by maintenance stays claimed until QEMU runs
+        with self.disk_lock:
+            if(self.is_running()):
+                return False
+
+            if(self.maintenance_job is not None):
+                log.warn(f"Disk of VM '{self.vm_id}' is held ({self.maintenance_job}), not starting")
+                return False
+
+            if(self.conf.get("headless")):
+                display_args = self.vnc.get_qemu_args()
+            else:
+                display_args = [ "-display", "sdl", "-full-screen" ]
+
+            extra_args = [ ]
+            if(self.snapshot):
+                extra_args += [ "-snapshot" ]
+
+            state_meta = None
+            if(self.has_saved_state()):
+                if(restore):
+                    state_meta = self.get_saved_state()
+                    self.cdrom_mode = state_meta["cdrom_mode"]
+                    extra_args += [ "-S", "-incoming", f"exec:cat '{os.path.abspath(self.state_file)}'" ]
+                elif(not self.snapshot):
+                    log.info("Cold boot requested, discarding saved machine state.")
+                    self.discard_saved_state()
+
+            log.info(f"Launching QEMU ({self.qemu_bin}) for VM '{self.vm_id}'..")
+            self.begin_boot_timeline()
+
+            # a stale socket from a previous run would look ready immediately
             if(os.path.exists(self.qmp_socket_path)):
-                not_ready = False
-                continue
+                log.debug(f"Removing stale QMP socket '{self.qmp_socket_path}'")
+                os.unlink(self.qmp_socket_path)
 
-            time.sleep(0.1)
+            if(os.path.exists(self.vnc.socket_path)):
+                os.unlink(self.vnc.socket_path)
         
+            log.info(f"Starting in {self.cdrom_mode} CDRom mode.")
+            argv = profile.build_command(self.qemu_bin, self.qmp_socket_path, self.disk_path,
+                    self.conf, self.cdrom_mode, self.snapshot)
+
+            self.qemu_process = subprocess.Popen(argv + display_args + extra_args,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=self.pin_cpus)
+
+        self.record_boot_phase("spawn")
+
+        if(not self.wait_for_qmp()):
+            self.abort_start()
+            return False
+
         log.info(f"QMP connection established to '{self.qmp_socket_path}', PID: {self.qemu_process.pid}")
-        self.qmp = QMP(self.qmp_socket_path)
+        self.qmp_cache.invalidate()
+        self.qmp.register_event_handler(self.on_qmp_event)
+
+        if(state_meta is not None and not self.restore_state(state_meta)):
+            self.finish_boot_timeline("Restoring machine state failed")
+            self.abort_start()
+            if(not self.snapshot):
+                self.discard_saved_state()
+            log.warn("Restoring machine state failed, falling back to cold boot.")
+            return self.start(restore=False)
+
+        threading.Thread(target=self.watch_process, args=(self.qemu_process,),
+                name="qemu-watcher", daemon=True).start()
+
+        self.wait_for_guest_running()
+        self.finish_boot_timeline("ok")
+
+        self.events.publish("VM_STARTED", { "pid": self.qemu_process.pid })
+        return True
+
+    def get_cpuset(self) -> set:
+        """
+        Get the set of CPUs this VM is pinned to or None
+        """
+        if(self.setup_mode or not self.conf.get("cpuset")):
+            return None
+
+        return parse_cpuset(self.conf["cpuset"])
+
+    def pin_cpus(self):
+        """
+        Pin the (forked, not yet exec'd) QEMU process to the configured
+        CPU set. All threads QEMU creates later inherit the affinity.
+        """
+        cpus = self.get_cpuset()
+        if(cpus is not None):
+            os.sched_setaffinity(0, cpus)
+
+    def wait_for_qmp(self) -> bool:
+        """
+        Connect to the QMP socket with exponential backoff until
+        START_TIMEOUT passes or the QEMU process exits.
+        """
+        deadline = time.monotonic() + START_TIMEOUT
+        backoff = 0.005
+
+        while True:
+            if(self.qemu_process.poll() is not None):
+                self.finish_boot_timeline(f"QEMU exited with code {self.qemu_process.returncode}")
+                return False
+
+            if(time.monotonic() > deadline):
+                self.finish_boot_timeline(f"QMP socket not ready after {START_TIMEOUT}s")
+                return False
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.qmp_socket_path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 0.1)
+
+        self.record_boot_phase("socket_ready")
+
+        self.qmp = QMP(self.qmp_socket_path, sock)
+        if(not self.qmp.connected):
+            self.finish_boot_timeline("QMP negotiation failed")
+            return False
+
+        self.record_boot_phase("qmp_negotiated")
         return True
+
+    def wait_for_guest_running(self):
+        """
+        Wait until QEMU reports the guest as running
+        """
+        deadline = time.monotonic() + START_TIMEOUT
+
+        while time.monotonic() < deadline and self.is_running():
+            resp = self.qmp.execute_qmp_command({
+                "execute": "query-status"
+            })
+
+            if(resp is not None and resp.get("return", { }).get("running")):
+                self.record_boot_phase("guest_running")
+                return
+
+            time.sleep(0.05)
+
+        log.warn("Guest did not enter running state.")
+
+    def abort_start(self):
+        """
+        Clean up after a failed start
+        """
+        if(self.qmp is not None):
+            self.qmp.destroy()
+            self.qmp = None
+
+        if(self.qemu_process.poll() is None):
+            self.qemu_process.kill()
+            self.qemu_process.wait()
+
+        stderr = self.qemu_process.stderr.read().decode("utf-8", errors="replace").strip()
+        log.error(f"Failed to start VirtualMachine: {self.boot_timeline['result']}")
+        if(stderr):
+            log.error(f"QEMU: {stderr}")
+
+    def begin_boot_timeline(self):
+        """
+        Start recording a new boot timeline
+        """
+        self.boot_start = time.monotonic()
+        self.boot_timeline = {
+            "started_at": time.time(),
+            "phases": { },
+            "result": None
+        }
+
+    def record_boot_phase(self, phase: str):
+        """
+        Record the time since start of a boot phase in ms
+        """
+        self.boot_timeline["phases"][phase] = round((time.monotonic() - self.boot_start) * 1000, 3)
+
+    def finish_boot_timeline(self, result: str):
+        """
+        Finish the current boot timeline and keep it in the history
+        """
+        if(self.boot_timeline["result"] is not None):
+            return
+
+        self.boot_timeline["result"] = result
+        self.boot_history.append(self.boot_timeline)
+
+    def get_boot_timeline(self) -> dict:
+        """
+        Get the latest boot timeline and the history of previous ones
+        """
+        return {
+            "last": self.boot_timeline,
+            "history": list(self.boot_history)
+        }
+
+    def on_qmp_event(self, event):
+        """
+        Forward QMP async events to the event bus
+        """
+        self.qmp_cache.on_event(event)
+        self.backup.on_event(event)
+        self.events.publish(event["event"], event.get("data"))
+
+    def watch_process(self, process):
+        """
+        Wait for the QEMU process to exit and publish it
+        """
+        returncode = process.wait()
+        log.info(f"QEMU process {process.pid} exited with code {returncode}")
+        self.events.publish("PROCESS_EXIT", {
+                "pid": process.pid,
+                "returncode": returncode
+            })
     
+    def suspend(self) -> bool:
+        """
+        Save the full machine state to disk and stop QEMU.
+        The next start() resumes from the saved state.
+        """
+        q = self.get_qmp()
+        if(q is None or self.snapshot or self.disk_busy()):
+            return False
+
+        log.info("Saving machine state..")
+        self.begin_state_phase("saving")
+        media = self.get_inserted_media()
+        tmp_file = f"{self.state_file}.tmp"
+
+        q.execute_qmp_command({
+            "execute": "stop"
+        })
+
+        # writing to a local file, don't throttle
+        q.execute_qmp_command({
+            "execute": "migrate-set-parameters",
+            "arguments": {
+                "max-bandwidth": 1 << 40
+            }
+        })
+
+        resp = q.execute_qmp_command({
+            "execute": "migrate",
+            "arguments": {
+                "uri": f"exec:cat > '{os.path.abspath(tmp_file)}'"
+            }
+        })
+
+        if(not self.qmp_succeeded(resp) or not self.wait_for_migration(q)):
+            self.finish_state_phase("failed")
+            if(os.path.exists(tmp_file)):
+                os.unlink(tmp_file)
+
+            q.execute_qmp_command({
+                "execute": "cont"
+            })
+            return False
+
+        os.replace(tmp_file, self.state_file)
+        with open(self.state_meta_file, "w+") as f:
+            f.write(json.dumps({
+                "saved_at": time.time(),
+                "size": os.path.getsize(self.state_file),
+                "cdrom_mode": self.cdrom_mode,
+                "media": media
+            }))
+
+        q.execute_qmp_command({
+            "execute": "quit"
+        })
+
+        try:
+            self.qemu_process.wait(START_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.qemu_process.terminate()
+
+        q.destroy()
+        self.finish_state_phase("saved")
+        self.events.publish("STATE_SAVED", { "size": os.path.getsize(self.state_file) })
+        log.info(f"Machine state saved in {self.state_status['duration_ms']}ms, Virtualmachine suspended.")
+        return True
+
+    def restore_state(self, meta: dict) -> bool:
+        """
+        Wait for the incoming migration to finish, resume the guest
+        and insert the media it had when it was saved.
+        """
+        if(self.disk_busy()):
+            return False
+
+        log.info("Restoring machine state..")
+        self.begin_state_phase("restoring")
+
+        if(not self.wait_for_migration(self.qmp)):
+            self.finish_state_phase("failed")
+            return False
+
+        resp = self.qmp.execute_qmp_command({
+            "execute": "cont"
+        })
+        if(not self.qmp_succeeded(resp)):
+            self.finish_state_phase("failed")
+            return False
+
+        for device, filename in meta["media"].items():
+            self.qmp.execute_qmp_command({
+                "execute": "blockdev-change-medium",
+                "arguments": {
+                    "device": device,
+                    "filename": filename
+                }
+            })
+
+        # the guest runs on, the state is stale from now on
+        # (unless the disk is a throwaway snapshot)
+        if(not self.snapshot):
+            self.discard_saved_state()
+
+        self.record_boot_phase("state_restored")
+        self.finish_state_phase("restored")
+        self.events.publish("STATE_RESTORED", { "duration_ms": self.state_status["duration_ms"] })
+        log.info(f"Machine state restored in {self.state_status['duration_ms']}ms.")
+        return True
+
+    def wait_for_migration(self, q: QMP) -> bool:
+        """
+        Poll query-migrate until the migration completed or failed,
+        keeping track of the progress in state_status.
+        """
+        deadline = time.monotonic() + STATE_TIMEOUT
+
+        while time.monotonic() < deadline:
+            resp = q.execute_qmp_command({
+                "execute": "query-migrate"
+            })
+            if(resp is None):
+                return False
+
+            info = resp.get("return", { })
+            status = info.get("status")
+            self.state_status["progress"] = info.get("ram")
+
+            if(status == "completed"):
+                return True
+
+            if(status in [ "failed", "cancelled" ]):
+                self.state_status["error"] = info.get("error-desc", status)
+                return False
+
+            time.sleep(0.05)
+
+        self.state_status["error"] = f"Timed out after {STATE_TIMEOUT}s"
+        return False
+
+    def get_inserted_media(self) -> dict:
+        """
+        Get the images currently inserted in the iso and floppy drives
+        """
+        media = { }
+
+        resp = self.queryblock()
+        if(not resp or "return" not in resp):
+            return media
+
+        for dev in resp["return"]:
+            if(dev.get("device") not in [ "iso", "floppy" ] or "inserted" not in dev):
+                continue
+
+            if(dev["inserted"]["file"] == "/dev/null"):
+                continue
+
+            media[dev["device"]] = dev["inserted"]["file"]
+
+        return media
+
+    def has_saved_state(self) -> bool:
+        """
+        Check if a saved machine state exists
+        """
+        return os.path.exists(self.state_file) and os.path.exists(self.state_meta_file)
+
+    def get_saved_state(self):
+        """
+        Get metadata of the saved machine state or None
+        """
+        if(not self.has_saved_state()):
+            return None
+
+        with open(self.state_meta_file, "r") as f:
+            return json.loads(f.read())
+
+    def discard_saved_state(self):
+        """
+        Delete the saved machine state
+        """
+        for path in [ self.state_file, self.state_meta_file ]:
+            if(os.path.exists(path)):
+                os.unlink(path)
+
+    def begin_state_phase(self, phase: str):
+        """
+        Start tracking a save or restore phase
+        """
+        self.state_start = time.monotonic()
+        self.state_status = {
+            "phase": phase,
+            "started_at": time.time(),
+            "duration_ms": None,
+            "progress": None,
+            "error": None
+        }
+
+    def finish_state_phase(self, phase: str):
+        """
+        Finish the current save or restore phase
+        """
+        self.state_status["phase"] = phase
+        self.state_status["duration_ms"] = round((time.monotonic() - self.state_start) * 1000, 3)
+
+        if(phase == "failed"):
+            log.error(f"Machine state save/restore failed: {self.state_status['error']}")
+
+    def get_state_status(self) -> dict:
+        """
+        Get status of the last save/restore and the saved state
+        """
+        return {
+            "status": self.state_status,
+            "saved_state": self.get_saved_state()
+        }
+
     def kill(self):
         """
         Kill virtualmachine
@@ -149,95 +749,154 @@ class VMManager():
         if(q is None):
             return False
 
-        q.execute_qmp_command({
+        resp = q.execute_qmp_command({
             "execute": "system_reset"
         })
-        return True
+        return self.qmp_succeeded(resp)
     
     
-    def setiso(self, filename) -> bool:
+    def resolve_media(self, directory: str, filename: str):
         """
-        Set ISO image
+        Resolve a media file name or sha256 digest to a
+        file name in directory, or None
         """
-        q = self.get_qmp()
-        if(q is None):
-            return False
+        media_catalog = catalog.get_catalog(directory)
+        if(media_catalog.contains(filename)):
+            return filename
 
-        if(not filename in os.listdir("iso/")):
-            return False
-        
-        q.send_qmp_message({
+        if(store.is_digest(filename)):
+            return media_catalog.find_by_checksum(filename)
+
+        return None
+
+    def change_medium_command(self, device: str, filename: str):
+        """
+        Build the QMP command inserting a media file (by file name
+        or sha256 digest) into the iso or floppy drive, None if
+        there is no such file
+        """
+        filename = self.resolve_media(device, filename)
+        if(filename is None):
+            return None
+
+        arguments = {
+            "device": device,
+            "filename": f"{device}/{filename}"
+        }
+
+        # a floppy linked under another name shares its data, the guest must not write to it
+        if(device == "floppy" and store.STORE.is_shared(f"floppy/{filename}")):
+            arguments["read-only-mode"] = "read-only"
+
+        return {
             "execute": "blockdev-change-medium",
+            "arguments": arguments
+        }
+
+    def eject_command(self, device: str) -> dict:
+        """
+        Build the QMP command ejecting the iso or floppy drive
+        """
+        return {
+            "execute": "eject",
             "arguments": {
-                    "device": "iso",
-                    "filename": f"iso/{filename}"
-                }
-        })
-        return True
+                "device": device,
+                "force": True
+            }
+        }
 
-    def ejectiso(self) -> bool:
+    def execute_media_command(self, command: dict) -> bool:
         """
-        Eject ISO image from CD drive
+        Run a media change command, the cached block state is outdated afterwards
         """
         q = self.get_qmp()
-        if(q is None):
+        if(q is None or self.disk_busy()):
             return False
 
-        q.send_qmp_message({
-                "execute": "eject",
-                "device": "cdrom",
-                "force": "true"
-            })
-        return True
+        resp = q.execute_qmp_command(command)
+        self.qmp_cache.invalidate("query-block")
+        return self.qmp_succeeded(resp)
 
-    def setfloppy(self, filename) -> bool:
+    def execute_pipelined(self, commands: list) -> list:
         """
-        Set ISO image
+        Send several QMP commands without waiting for each reply.
+        QEMU still runs them in order.
+
+        Returns a list with the success of every command
         """
         q = self.get_qmp()
-        if(q is None):
+        if(q is None or self.disk_busy()):
+            return [ False ] * len(commands)
+
+        futures = [ q.execute_qmp_command_async(command) for command in commands ]
+        results = [ ]
+        for future in futures:
+            try:
+                resp = future.result(QMP_TIMEOUT)
+            except TimeoutError:
+                resp = None
+
+            results.append(self.qmp_succeeded(resp))
+
+        self.qmp_cache.invalidate("query-block")
+        return results
+
+    def setiso(self, filename) -> bool:
+        """
+        Set ISO image (by file name or sha256 digest)
+        """
+        command = self.change_medium_command("iso", filename)
+        if(command is None):
             return False
 
-        if(not filename in os.listdir("floppy/")):
+        return self.execute_media_command(command)
+
+    def ejectiso(self) -> bool:
+        """
+        Eject ISO image from CD drive
+        """
+        return self.execute_media_command(self.eject_command("iso"))
+
+    def setfloppy(self, filename) -> bool:
+        """
+        Set floppy image (by file name or sha256 digest)
+        """
+        command = self.change_medium_command("floppy", filename)
+        if(command is None):
             return False
 
-        q.send_qmp_message({
-            "execute": "blockdev-change-medium",
-            "arguments": {
-                    "device": "floppy",
-                    "filename": f"floppy/{filename}"
-                }
-        })
-        return True
+        return self.execute_media_command(command)
 
     def ejectfloppy(self) -> bool:
         """
         Eject floppy image from floppy drive
         """
-        q = self.get_qmp()
-        if(q is None):
-            return False
-
-        q.send_qmp_message({
-                "execute": "eject",
-                "device": "floppy",
-                "force": "true"
-            })
-        return True
+        return self.execute_media_command(self.eject_command("floppy"))
     
     def queryblock(self):
         """
-        Query block devices
+        Query block devices (cached)
         """
         q = self.get_qmp()
         if(q is None):
             return False
 
-        return q.execute_qmp_command({
-            "execute": "query-block"
-        })
+        return self.qmp_cache.query(q, "query-block")
 
 
+    def qmp_succeeded(self, resp) -> bool:
+        """
+        Check if a QMP response is a successful return
+        """
+        if(resp is None):
+            return False
+
+        if("error" in resp):
+            log.warn(f"QMP command failed: {resp['error'].get('desc')}")
+            return False
+
+        return True
+
     def get_qmp(self) -> QMP:
         """
         Get QMP socket object if it exists or None
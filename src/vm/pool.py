@@ -0,0 +1,237 @@
+import os
+import time
+import itertools
+import threading
+
+from collections import deque
+
+from vm.manager import VMManager
+from vm.registry import VMRegistry
+from log import log
+
+#
+# Time in seconds to wait before retrying after a failed warm-up
+#
+RETRY_DELAY = 10
+
+class VMPool():
+
+    def __init__(self, registry: VMRegistry, template_id: str, size: int, boot_time: float = 0):
+        """
+        Pool of pre-warmed VMs, kept at `size` by a background thread.
+
+        Pool VMs run the template VM's disk with -snapshot, so they
+        need no disk of their own and never change the template. If the
+        template has a saved machine state, they are restored from it
+        instead of cold booting. The pool holds the template's disk
+        while it runs VMs on it: the template can't be started, reset,
+        promoted, restored or maintained meanwhile, and the pool can't
+        take a running template.
+
+        :param boot_time: Seconds to give a cold booted guest to reach
+                          its desktop before it counts as warm
+        """
+        self.registry = registry
+        self.template_id = template_id
+        self.size = size
+        self.boot_time = boot_time
+
+        self.cond = threading.Condition()
+        self.ready = deque()
+        self.allocated = { }
+        self.ids = itertools.count(1)
+        self.template = None
+        self.running = False
+        self.thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.last_refill_ms = None
+        self.total_refill_ms = 0
+
+    def start(self):
+        """
+        Start the refill thread
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.refill_loop, name="vm-pool", daemon=True)
+        self.thread.start()
+        log.info(f"VM pool started, target size {self.size} (template '{self.template_id}')")
+
+    def stop(self):
+        """
+        Stop the refill thread and kill all idle VMs
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+            idle = list(self.ready)
+            self.ready.clear()
+
+        for vmm in idle:
+            vmm.kill()
+
+        with self.cond:
+            self.release_template()
+
+    def claim_template(self) -> bool:
+        """
+        Reserve the template's disk for the pool, False if the
+        template is missing, not set up, running or busy
+        """
+        with self.cond:
+            if(self.template is not None):
+                return True
+
+            template = self.registry.get(self.template_id)
+            if(template is None or template.setup_mode or not template.claim_disk("pool")):
+                return False
+
+            self.template = template
+            return True
+
+    def release_template(self):
+        """
+        Give the template's disk back once the pool is stopped and
+        no pool VM uses it anymore (cond held)
+        """
+        if(self.template is not None and not self.running and not self.ready and not self.allocated):
+            self.template.release_disk()
+            self.template = None
+
+    def new_vm(self) -> VMManager:
+        """
+        Create a (not yet started) pool VM
+        """
+        if(not self.claim_template()):
+            return None
+
+        vm_id = f"pool-{next(self.ids)}"
+        return VMManager(self.registry.qemu_bin,
+                os.path.join(self.registry.socket_dir, f"r9xd-{vm_id}.sock"),
+                vm_id, self.template.vm_dir, snapshot=True)
+
+    def warm(self, wait_boot: bool = True) -> VMManager:
+        """
+        Create and boot a pool VM, returns it or None on failure
+
+        :param wait_boot: Wait boot_time for cold booted guests and
+                          count this as a refill
+        """
+        vmm = self.new_vm()
+        if(vmm is None):
+            log.warn(f"Pool template '{self.template_id}' is not set up or in use.")
+            return None
+
+        start = time.monotonic()
+        if(not vmm.start()):
+            return None
+
+        if(not wait_boot):
+            return vmm
+
+        # restored guests are at their desktop already
+        if("state_restored" not in vmm.boot_timeline["phases"]):
+            time.sleep(self.boot_time)
+
+        refill_ms = round((time.monotonic() - start) * 1000, 3)
+        with self.cond:
+            self.refills += 1
+            self.last_refill_ms = refill_ms
+            self.total_refill_ms += refill_ms
+
+        log.info(f"Pool VM '{vmm.vm_id}' warmed in {refill_ms}ms")
+        return vmm
+
+    def refill_loop(self):
+        """
+        Keep the pool filled up to its target size
+        """
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: not self.running or len(self.ready) < self.size)
+                if(not self.running):
+                    return
+
+            vmm = self.warm()
+            if(vmm is None):
+                time.sleep(RETRY_DELAY)
+                continue
+
+            with self.cond:
+                if(not self.running):
+                    vmm.kill()
+                    return
+
+                self.ready.append(vmm)
+
+    def allocate(self) -> VMManager:
+        """
+        Hand out a warm VM, booting one on the spot if the pool
+        is empty. The VM is added to the registry.
+
+        Returns the VM or None if none could be started
+        """
+        vmm = None
+        with self.cond:
+            while self.ready:
+                candidate = self.ready.popleft()
+                if(candidate.is_running()):
+                    vmm = candidate
+                    break
+
+            if(vmm is None):
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            # wake up the refill thread
+            self.cond.notify_all()
+
+        # pool is empty, cold start one for this request
+        if(vmm is None):
+            vmm = self.warm(wait_boot=False)
+            if(vmm is None):
+                return None
+
+        with self.cond:
+            self.allocated[vmm.vm_id] = vmm
+
+        self.registry.register(vmm)
+        log.info(f"Allocated pool VM '{vmm.vm_id}'")
+        return vmm
+
+    def release(self, vm_id: str) -> bool:
+        """
+        Kill an allocated pool VM and remove it from the registry
+        """
+        with self.cond:
+            vmm = self.allocated.pop(vm_id, None)
+
+        if(vmm is None):
+            return False
+
+        vmm.kill()
+        with self.cond:
+            self.release_template()
+
+        self.registry.unregister(vm_id)
+        log.info(f"Released pool VM '{vm_id}'")
+        return True
+
+    def get_stats(self) -> dict:
+        """
+        Get pool size, hit/miss counters and refill latency
+        """
+        with self.cond:
+            return {
+                "target_size": self.size,
+                "ready": len(self.ready),
+                "allocated": list(self.allocated.keys()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refills": self.refills,
+                "last_refill_ms": self.last_refill_ms,
+                "avg_refill_ms": round(self.total_refill_ms / self.refills, 3) if self.refills else None
+            }
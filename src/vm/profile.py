@@ -0,0 +1,186 @@
+import os
+import re
+
+from log import log
+
+#
+# Launch profiles, selected by conf["profile"]. Single options
+# can be overridden per VM in conf["launch"].
+#
+PROFILES = {
+    # QEMU defaults, safe everywhere
+    "default": {
+        "accel": "auto",
+        "smp": 1,
+        "cache": "writeback",
+        "aio": "threads",
+        "discard": "ignore",
+        "l2_cache_size": None,
+        "mem_prealloc": False
+    },
+
+    # host page cache bypassed, io_uring, enough L2 cache for the whole disk
+    "performance": {
+        "accel": "auto",
+        "smp": 1,
+        "cache": "none",
+        "aio": "io_uring",
+        "discard": "unmap",
+        "l2_cache_size": "8M",
+        "mem_prealloc": True
+    },
+
+    # writes may be lost on a host crash, for sessions that are thrown away
+    "throwaway": {
+        "accel": "auto",
+        "smp": 1,
+        "cache": "unsafe",
+        "aio": "threads",
+        "discard": "unmap",
+        "l2_cache_size": "8M",
+        "mem_prealloc": False
+    }
+}
+
+DEFAULT_PROFILE = "default"
+
+CACHE_MODES = [ "none", "writeback", "writethrough", "directsync", "unsafe" ]
+AIO_MODES = [ "threads", "native", "io_uring" ]
+DISCARD_MODES = [ "ignore", "unmap" ]
+ACCEL_MODES = [ "auto", "kvm", "tcg" ]
+
+#
+# qcow2 L2 cache size, bytes with an optional unit
+#
+L2_CACHE_SIZE_PATTERN = re.compile(r"^\d+[KMG]?$")
+
+#
+# CPU model under TCG, "host" needs KVM
+#
+TCG_CPU = "pentium2"
+
+KVM_DEVICE = "/dev/kvm"
+
+#
+# check if KVM can be used by this process
+#
+def kvm_available() -> bool:
+    return os.access(KVM_DEVICE, os.R_OK | os.W_OK)
+
+#
+# get the options of a profile with per VM overrides applied, None if unknown
+#
+def get_options(name: str, overrides: dict = None):
+    profile = PROFILES.get(name or DEFAULT_PROFILE)
+    if(profile is None):
+        return None
+
+    options = dict(profile)
+    options.update(overrides or { })
+    return options
+
+#
+# validate a profile with overrides, returns an error message or None
+#
+def check_options(name: str, overrides: dict = None):
+    if(overrides is not None and not isinstance(overrides, dict)):
+        return "Launch options must be an object"
+
+    options = get_options(name, overrides)
+    if(options is None):
+        return f"No such launch profile: '{name}'"
+
+    unknown = set(options.keys()) - set(PROFILES[DEFAULT_PROFILE].keys())
+    if(unknown):
+        return f"Unknown launch options: {', '.join(sorted(unknown))}"
+
+    if(options["cache"] not in CACHE_MODES):
+        return f"Invalid cache mode, expected one of {', '.join(CACHE_MODES)}"
+
+    if(options["aio"] not in AIO_MODES):
+        return f"Invalid aio mode, expected one of {', '.join(AIO_MODES)}"
+
+    # native aio needs O_DIRECT
+    if(options["aio"] == "native" and options["cache"] not in [ "none", "directsync" ]):
+        return "aio=native requires cache mode 'none' or 'directsync'"
+
+    if(options["discard"] not in DISCARD_MODES):
+        return f"Invalid discard mode, expected one of {', '.join(DISCARD_MODES)}"
+
+    if(options["accel"] not in ACCEL_MODES):
+        return f"Invalid accelerator, expected one of {', '.join(ACCEL_MODES)}"
+
+    # bool is an int subclass
+    if(not isinstance(options["smp"], int) or isinstance(options["smp"], bool) or options["smp"] < 1):
+        return "smp must be a positive integer"
+
+    # the value ends up inside the -drive option string
+    if(options["l2_cache_size"] is not None and (not isinstance(options["l2_cache_size"], str)
+            or L2_CACHE_SIZE_PATTERN.fullmatch(options["l2_cache_size"]) is None)):
+        return "l2_cache_size must be a size like '8M'"
+
+    if(not isinstance(options["mem_prealloc"], bool)):
+        return "mem_prealloc must be a boolean"
+
+    return None
+
+#
+# pick the accelerator, falling back to TCG without KVM
+#
+def resolve_accel(accel: str) -> str:
+    if(accel == "tcg"):
+        return "tcg"
+
+    if(kvm_available()):
+        return "kvm"
+
+    if(accel == "kvm"):
+        log.warn(f"KVM requested but {KVM_DEVICE} is not usable, falling back to TCG")
+    else:
+        log.info(f"{KVM_DEVICE} is not usable, running with TCG")
+
+    return "tcg"
+
+#
+# build the QEMU command line (without display options) of a VM
+#
+def build_command(qemu_bin: str, qmp_socket_path: str, disk_path: str, conf: dict,
+        cdrom_mode: str, snapshot: bool = False) -> list:
+    options = get_options(conf.get("profile"), conf.get("launch"))
+    if(options is None):
+        log.warn(f"Unknown launch profile '{conf.get('profile')}', using '{DEFAULT_PROFILE}'")
+        options = get_options(DEFAULT_PROFILE)
+
+    # writes of snapshot VMs are thrown away, no point in flushing them
+    cache = "unsafe" if snapshot else options["cache"]
+    aio = options["aio"]
+    if(aio == "native" and cache not in [ "none", "directsync" ]):
+        aio = "threads"
+
+    drive = f"id=win98,if=none,format=qcow2,file={disk_path},cache={cache},aio={aio},discard={options['discard']}"
+    if(options["l2_cache_size"]):
+        drive += f",l2-cache-size={options['l2_cache_size']}"
+
+    accel = resolve_accel(options["accel"])
+
+    args = [ qemu_bin,
+        "-nodefaults", "-rtc", "base=localtime",
+        "-boot", "menu=on",
+        "-accel", accel,
+        "-M", "pc,hpet=off,usb=off",
+        "-cpu", "host" if accel == "kvm" else TCG_CPU,
+        "-smp", str(options["smp"]),
+        "-m", f"{conf.get('ram_size', 128)}M",
+        "-qmp", f"unix:{qmp_socket_path},server,nowait", # QMP Unix socket
+        "-device", "VGA", "-device", "lsi", "-device", "ac97",
+        "-netdev", "user,id=net0", "-device", "pcnet,rombar=0,netdev=net0",
+        "-drive", drive, "-device", "scsi-hd,drive=win98",
+        "-drive", "id=iso,if=none,media=cdrom",
+        "-device", "scsi-cd,drive=iso" if cdrom_mode == "SCSI" else "ide-cd,drive=iso",
+        "-drive", "id=floppy,if=floppy,format=raw,file=/dev/null",
+    ]
+
+    if(options["mem_prealloc"]):
+        args += [ "-mem-prealloc" ]
+
+    return args
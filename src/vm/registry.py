@@ -0,0 +1,103 @@
+import os
+import re
+import threading
+
+from vm.manager import VMManager
+from log import log
+
+#
+# Name of the VM that lives in the working directory
+#
+DEFAULT_VM = "default"
+
+#
+# Allowed VM ids, used in paths and socket names
+#
+VM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+class VMRegistry():
+
+    def __init__(self, qemu_bin: str, default_qmp_socket: str, vm_root: str = "vms", socket_dir: str = "/tmp"):
+        """
+        Registry of all VM instances managed by this daemon.
+
+        The default VM keeps its files in the working directory,
+        every other VM gets its own directory below vm_root and
+        its own QMP socket in socket_dir.
+        """
+        self.qemu_bin = qemu_bin
+        self.default_qmp_socket = default_qmp_socket
+        self.vm_root = vm_root
+        self.socket_dir = socket_dir
+        self.lock = threading.Lock()
+        self.vms = { }
+
+        self.vms[DEFAULT_VM] = VMManager(qemu_bin, default_qmp_socket, DEFAULT_VM, ".")
+
+        if(os.path.isdir(vm_root)):
+            for vm_id in sorted(os.listdir(vm_root)):
+                if(VM_ID_PATTERN.match(vm_id) and os.path.isdir(os.path.join(vm_root, vm_id))):
+                    self.vms[vm_id] = self.new_manager(vm_id)
+
+        log.info(f"Loaded {len(self.vms)} VM(s): {', '.join(self.vms.keys())}")
+
+    def new_manager(self, vm_id: str) -> VMManager:
+        """
+        Create the VMManager for a VM below vm_root
+        """
+        return VMManager(self.qemu_bin,
+                os.path.join(self.socket_dir, f"r9xd-{vm_id}.sock"),
+                vm_id, os.path.join(self.vm_root, vm_id))
+
+    def get(self, vm_id: str) -> VMManager:
+        """
+        Get a VM by id or None
+        """
+        return self.vms.get(vm_id)
+
+    def create(self, vm_id: str) -> VMManager:
+        """
+        Create (or get the existing) VM with the given id
+
+        Returns None if the id is invalid
+        """
+        if(not VM_ID_PATTERN.match(vm_id)):
+            return None
+
+        with self.lock:
+            if(vm_id in self.vms):
+                return self.vms[vm_id]
+
+            os.makedirs(os.path.join(self.vm_root, vm_id), exist_ok=True)
+            vmm = self.new_manager(vm_id)
+            self.vms[vm_id] = vmm
+
+        log.info(f"Created VM '{vm_id}'")
+        return vmm
+
+    def register(self, vmm: VMManager):
+        """
+        Add an externally created VM (e.g. from the pool)
+        """
+        with self.lock:
+            self.vms[vmm.vm_id] = vmm
+
+    def unregister(self, vm_id: str):
+        """
+        Drop a VM from the registry
+        """
+        with self.lock:
+            self.vms.pop(vm_id, None)
+
+    def list(self) -> dict:
+        """
+        Get a short status of all VMs
+        """
+        return {
+            vm_id: {
+                "running": vmm.is_running(),
+                "setup": vmm.setup_mode,
+                "cpuset": None if vmm.setup_mode else vmm.conf.get("cpuset")
+            }
+            for vm_id, vmm in list(self.vms.items())
+        }
@@ -0,0 +1,234 @@
+import io
+import os
+import time
+import zlib
+import struct
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from log import log
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+#
+# Seconds a frame is served from the cache, all clients polling
+# within this interval share one screendump
+#
+FRAME_TTL = 1.0
+
+#
+# Threads encoding frames, shared by all VMs
+#
+ENCODE_WORKERS = 2
+
+#
+# Screendump target, next to the QMP socket (pool VMs share
+# their VM directory, but never a socket)
+#
+DUMP_SUFFIX = ".screen.ppm"
+
+#
+# Supported output formats, jpeg needs Pillow
+#
+FORMATS = [ "png", "jpeg" ]
+
+#
+# Widths a screenshot can be scaled to, which bounds the encoded
+# variants of a frame. Requests are rounded down to one of them.
+#
+SCALE_WIDTHS = [ 160, 320, 640, 800, 1024, 1280, 1600 ]
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+ENCODER = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="screen-encode")
+
+#
+# parse a binary (P6) PPM into (width, height, rgb bytes)
+#
+def parse_ppm(data: bytes):
+    fields = [ ]
+    pos = 0
+
+    # magic, width, height, maxval separated by whitespace (and comments)
+    while len(fields) < 4:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+
+        if(data[pos:pos + 1] == b"#"):
+            pos = data.index(b"\n", pos) + 1
+            continue
+
+        end = pos
+        while end < len(data) and not data[end:end + 1].isspace():
+            end += 1
+
+        fields.append(data[pos:end])
+        pos = end
+
+    if(fields[0] != b"P6" or int(fields[3]) != 255):
+        raise ValueError("Unsupported PPM image")
+
+    width = int(fields[1])
+    height = int(fields[2])
+    rgb = data[pos + 1:pos + 1 + width * height * 3]
+    if(len(rgb) != width * height * 3):
+        raise ValueError("Truncated PPM image")
+
+    return width, height, rgb
+
+#
+# nearest neighbour downscale by an integer factor
+#
+def downscale(width: int, height: int, rgb: bytes, factor: int):
+    if(factor <= 1):
+        return width, height, rgb
+
+    stride = width * 3
+    new_width = (width + factor - 1) // factor
+    rows = [ ]
+
+    for y in range(0, height, factor):
+        row = rgb[y * stride:(y + 1) * stride]
+        out = bytearray(new_width * 3)
+        out[0::3] = row[0::3 * factor]
+        out[1::3] = row[1::3 * factor]
+        out[2::3] = row[2::3 * factor]
+        rows.append(bytes(out))
+
+    return new_width, len(rows), b"".join(rows)
+
+#
+# encode raw rgb as png without external dependencies
+#
+def encode_png(width: int, height: int, rgb: bytes) -> bytes:
+    stride = width * 3
+    raw = b"".join(b"\0" + rgb[y * stride:(y + 1) * stride] for y in range(height))
+
+    def chunk(kind: bytes, payload: bytes) -> bytes:
+        return struct.pack(">I", len(payload)) + kind + payload + \
+                struct.pack(">I", zlib.crc32(kind + payload) & 0xffffffff)
+
+    return PNG_SIGNATURE + \
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+            chunk(b"IDAT", zlib.compress(raw, 1)) + \
+            chunk(b"IEND", b"")
+
+#
+# encode a frame, scaled down to at most max_width pixels
+#
+def encode_frame(width: int, height: int, rgb: bytes, fmt: str, max_width: int) -> bytes:
+    if(Image is not None):
+        img = Image.frombytes("RGB", (width, height), rgb)
+        if(max_width and width > max_width):
+            img = img.resize((max_width, max(1, height * max_width // width)), Image.BILINEAR)
+
+        buf = io.BytesIO()
+        if(fmt == "jpeg"):
+            img.save(buf, "JPEG", quality=75)
+        else:
+            img.save(buf, "PNG", compress_level=1)
+
+        return buf.getvalue()
+
+    if(max_width and width > max_width):
+        width, height, rgb = downscale(width, height, rgb, (width + max_width - 1) // max_width)
+
+    return encode_png(width, height, rgb)
+
+#
+# map a requested width to a scale width, None for the full frame
+#
+def scale_width(requested: int, frame_width: int):
+    if(requested is None or requested >= frame_width):
+        return None
+
+    fitting = [ width for width in SCALE_WIDTHS if width <= requested ]
+    width = fitting[-1] if fitting else SCALE_WIDTHS[0]
+    return width if width < frame_width else None
+
+class ScreenCapture():
+
+    def __init__(self, vmm):
+        """
+        Rate limited screenshots of a VM.
+
+        At most one screendump runs per VM and a frame is reused for
+        FRAME_TTL seconds. Every (format, width) variant of a frame is
+        encoded once in the shared worker pool, so the cost does not
+        grow with the number of polling clients.
+        """
+        self.vmm = vmm
+        self.dump_path = os.path.abspath(f"{vmm.qmp_socket_path}{DUMP_SUFFIX}")
+        self.dump_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.frame = None
+        self.frame_time = 0
+        self.encoded = { }
+
+    def supports(self, fmt: str) -> bool:
+        return fmt == "png" or (fmt == "jpeg" and Image is not None)
+
+    def get_frame(self):
+        """
+        Get the current raw frame (width, height, rgb), dumping a new
+        one if the cached frame is too old. None if QEMU is not running.
+        """
+        with self.dump_lock:
+            with self.lock:
+                if(self.frame is not None and time.monotonic() - self.frame_time < FRAME_TTL):
+                    return self.frame
+
+            q = self.vmm.get_qmp()
+            if(q is None):
+                return None
+
+            resp = q.execute_qmp_command({
+                "execute": "screendump",
+                "arguments": {
+                    "filename": self.dump_path
+                }
+            })
+
+            if(not self.vmm.qmp_succeeded(resp)):
+                log.warn(f"screendump failed for VM '{self.vmm.vm_id}': {resp}")
+                return None
+
+            try:
+                with open(self.dump_path, "rb") as f:
+                    frame = parse_ppm(f.read())
+            except (OSError, ValueError) as ex:
+                log.warn(f"Could not read screendump of VM '{self.vmm.vm_id}': {ex}")
+                return None
+
+            with self.lock:
+                self.frame = frame
+                self.frame_time = time.monotonic()
+                self.encoded = { }
+
+            return frame
+
+    def get_image(self, fmt: str = "png", max_width: int = None):
+        """
+        Get the current screen as encoded image bytes, or None.
+        max_width is rounded down to one of SCALE_WIDTHS.
+        """
+        frame = self.get_frame()
+        if(frame is None):
+            return None
+
+        with self.lock:
+            # the frame may have been replaced in the meantime,
+            # encoded variants always belong to the newest one
+            frame = self.frame
+            max_width = scale_width(max_width, frame[0])
+            key = (fmt, max_width)
+            future = self.encoded.get(key)
+            if(future is None):
+                future = ENCODER.submit(encode_frame, *frame, fmt, max_width)
+                self.encoded[key] = future
+
+        return future.result()
@@ -0,0 +1,282 @@
+import os
+import math
+import time
+import threading
+
+from array import array
+
+from log import log
+
+#
+# Default seconds between samples
+#
+SAMPLE_INTERVAL = 5
+
+#
+# Samples kept per VM (1 hour at the default interval)
+#
+HISTORY_SIZE = 720
+
+#
+# Timeout in seconds of the QMP queries of a sample
+#
+QMP_SAMPLE_TIMEOUT = 2
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+#
+# Metrics kept in the history (rates are per second)
+#
+HISTORY_METRICS = [
+    "cpu_percent",
+    "vcpu_percent",
+    "rss_bytes",
+    "threads",
+    "io_read_bytes_per_s",
+    "io_write_bytes_per_s",
+    "block_read_bytes_per_s",
+    "block_write_bytes_per_s",
+    "block_read_ops_per_s",
+    "block_write_ops_per_s"
+]
+
+#
+# Prometheus metrics: name -> (raw counter, type, help)
+#
+PROMETHEUS_METRICS = {
+    "r9xd_vm_cpu_seconds_total": ("cpu_seconds", "counter", "CPU time used by the QEMU process"),
+    "r9xd_vm_vcpu_seconds_total": ("vcpu_seconds", "counter", "CPU time used by the vCPU threads"),
+    "r9xd_vm_vcpus": ("vcpus", "gauge", "Number of vCPUs"),
+    "r9xd_vm_rss_bytes": ("rss_bytes", "gauge", "Resident memory of the QEMU process"),
+    "r9xd_vm_threads": ("threads", "gauge", "Threads of the QEMU process"),
+    "r9xd_vm_io_read_bytes_total": ("io_read_bytes", "counter", "Bytes read from storage by the QEMU process"),
+    "r9xd_vm_io_write_bytes_total": ("io_write_bytes", "counter", "Bytes written to storage by the QEMU process"),
+    "r9xd_vm_block_read_bytes_total": ("block_read_bytes", "counter", "Bytes read by the guest from its block devices"),
+    "r9xd_vm_block_write_bytes_total": ("block_write_bytes", "counter", "Bytes written by the guest to its block devices"),
+    "r9xd_vm_block_read_ops_total": ("block_read_ops", "counter", "Read operations of the guest"),
+    "r9xd_vm_block_write_ops_total": ("block_write_ops", "counter", "Write operations of the guest")
+}
+
+#
+# read cpu time (utime + stime, seconds), thread count and rss of a process or thread
+#
+def read_proc_stat(path: str):
+    with open(path, "r") as f:
+        fields = f.read().rpartition(")")[2].split()
+
+    # fields start at field 3 (state) of proc(5)
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[17]), int(fields[21]) * PAGE_SIZE
+
+#
+# read the storage I/O counters of a process, (nan, nan) without permission
+#
+def read_proc_io(pid: int):
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            values = dict(line.split(":", 1) for line in f.read().splitlines())
+
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return math.nan, math.nan
+
+#
+# format a sample value without losing precision on large counters
+#
+def format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+class MetricHistory():
+
+    def __init__(self, metrics: list, size: int = HISTORY_SIZE):
+        """
+        Fixed size ring buffer of samples, one preallocated array
+        of doubles per metric. Missing values are stored as NaN.
+        """
+        self.metrics = metrics
+        self.size = size
+        self.lock = threading.Lock()
+        self.timestamps = array("d", [ 0.0 ]) * size
+        self.values = { metric: array("d", [ math.nan ]) * size for metric in metrics }
+        self.next = 0
+        self.count = 0
+
+    def append(self, timestamp: float, sample: dict):
+        with self.lock:
+            pos = self.next
+            self.timestamps[pos] = timestamp
+            for metric in self.metrics:
+                self.values[metric][pos] = sample.get(metric, math.nan)
+
+            self.next = (pos + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def get(self, since: float = 0, limit: int = None) -> dict:
+        """
+        Get samples newer than since, oldest first, as columns
+        """
+        with self.lock:
+            first = (self.next - self.count) % self.size
+            positions = [ (first + i) % self.size for i in range(self.count) ]
+            positions = [ pos for pos in positions if self.timestamps[pos] > since ]
+            if(limit is not None):
+                positions = positions[-limit:]
+
+            return {
+                "timestamps": [ round(self.timestamps[pos], 3) for pos in positions ],
+                "metrics": {
+                    metric: [ None if math.isnan(values[pos]) else round(values[pos], 2) for pos in positions ]
+                    for metric, values in self.values.items()
+                }
+            }
+
+class VMTelemetry():
+
+    def __init__(self, vmm):
+        """
+        Resource usage of a VM's QEMU process, from /proc and QMP
+        """
+        self.vmm = vmm
+        self.history = MetricHistory(HISTORY_METRICS)
+        self.counters = None
+        self.counters_time = None
+        self.pid = None
+
+    def read_counters(self, pid: int) -> dict:
+        """
+        Read the raw (cumulative) counters of the QEMU process
+        """
+        cpu_seconds, threads, rss_bytes = read_proc_stat(f"/proc/{pid}/stat")
+        io_read, io_write = read_proc_io(pid)
+
+        counters = {
+            "cpu_seconds": cpu_seconds,
+            "threads": threads,
+            "rss_bytes": rss_bytes,
+            "io_read_bytes": io_read,
+            "io_write_bytes": io_write,
+            "vcpus": math.nan,
+            "vcpu_seconds": math.nan,
+            "block_read_bytes": math.nan,
+            "block_write_bytes": math.nan,
+            "block_read_ops": math.nan,
+            "block_write_ops": math.nan
+        }
+
+        q = self.vmm.get_qmp()
+        if(q is None):
+            return counters
+
+        cpus = q.execute_qmp_command({ "execute": "query-cpus-fast" }, QMP_SAMPLE_TIMEOUT)
+        if(cpus is not None and "return" in cpus):
+            vcpu_seconds = 0.0
+            for cpu in cpus["return"]:
+                try:
+                    vcpu_seconds += read_proc_stat(f"/proc/{pid}/task/{cpu['thread-id']}/stat")[0]
+                except (OSError, KeyError):
+                    pass
+
+            counters["vcpus"] = len(cpus["return"])
+            counters["vcpu_seconds"] = vcpu_seconds
+
+        blockstats = self.vmm.qmp_cache.query(q, "query-blockstats", QMP_SAMPLE_TIMEOUT)
+        if(blockstats is not None and "return" in blockstats):
+            stats = [ device.get("stats", { }) for device in blockstats["return"] ]
+            counters["block_read_bytes"] = sum(s.get("rd_bytes", 0) for s in stats)
+            counters["block_write_bytes"] = sum(s.get("wr_bytes", 0) for s in stats)
+            counters["block_read_ops"] = sum(s.get("rd_operations", 0) for s in stats)
+            counters["block_write_ops"] = sum(s.get("wr_operations", 0) for s in stats)
+
+        return counters
+
+    def sample(self):
+        """
+        Take a sample, the first one of a process only sets the baseline
+        """
+        process = self.vmm.qemu_process
+        if(process is None or not self.vmm.is_running()):
+            self.counters = None
+            return
+
+        now = time.time()
+        try:
+            counters = self.read_counters(process.pid)
+        except (OSError, IndexError, ValueError) as ex:
+            log.debug(f"Could not sample VM '{self.vmm.vm_id}': {ex}")
+            return
+
+        previous, previous_time = self.counters, self.counters_time
+        self.counters, self.counters_time = counters, now
+
+        if(previous is None or self.pid != process.pid):
+            self.pid = process.pid
+            return
+
+        elapsed = now - previous_time
+
+        def rate(name: str) -> float:
+            return (counters[name] - previous[name]) / elapsed
+
+        self.history.append(now, {
+            "cpu_percent": rate("cpu_seconds") * 100,
+            "vcpu_percent": rate("vcpu_seconds") * 100,
+            "rss_bytes": counters["rss_bytes"],
+            "threads": counters["threads"],
+            "io_read_bytes_per_s": rate("io_read_bytes"),
+            "io_write_bytes_per_s": rate("io_write_bytes"),
+            "block_read_bytes_per_s": rate("block_read_bytes"),
+            "block_write_bytes_per_s": rate("block_write_bytes"),
+            "block_read_ops_per_s": rate("block_read_ops"),
+            "block_write_ops_per_s": rate("block_write_ops")
+        })
+
+class TelemetrySampler():
+
+    def __init__(self, registry, interval: float = SAMPLE_INTERVAL):
+        """
+        Background thread sampling all VMs of the registry
+        """
+        self.registry = registry
+        self.interval = interval
+        self.last_duration_ms = None
+
+    def start(self):
+        threading.Thread(target=self.sample_loop, name="telemetry", daemon=True).start()
+        log.info(f"Telemetry sampler started, interval {self.interval}s")
+
+    def sample_loop(self):
+        while True:
+            start = time.monotonic()
+            for vm_id, vmm in list(self.registry.vms.items()):
+                # one broken VM must not stop sampling the others
+                try:
+                    vmm.telemetry.sample()
+                except Exception as ex:
+                    log.error(f"Telemetry sample of VM '{vm_id}' failed: {ex}")
+
+            self.last_duration_ms = round((time.monotonic() - start) * 1000, 2)
+            time.sleep(max(0, self.interval - (time.monotonic() - start)))
+
+    def render_prometheus(self) -> str:
+        """
+        Latest counters of all running VMs in the Prometheus text format
+        """
+        counters = { }
+        for vm_id, vmm in list(self.registry.vms.items()):
+            if(vmm.telemetry.counters is not None):
+                counters[vm_id] = vmm.telemetry.counters
+
+        lines = [ ]
+        for name, (counter, kind, description) in PROMETHEUS_METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for vm_id, values in counters.items():
+                if(not math.isnan(values[counter])):
+                    lines.append(f"{name}{{vm=\"{vm_id}\"}} {format_value(values[counter])}")
+
+        if(self.last_duration_ms is not None):
+            lines.append("# HELP r9xd_telemetry_sample_duration_ms Time taken by the last sampling pass")
+            lines.append("# TYPE r9xd_telemetry_sample_duration_ms gauge")
+            lines.append(f"r9xd_telemetry_sample_duration_ms {self.last_duration_ms}")
+
+        return "\n".join(lines) + "\n"
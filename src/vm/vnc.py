@@ -0,0 +1,295 @@
+import os
+import time
+import socket
+import struct
+import threading
+
+from log import log
+
+#
+# QEMU's VNC server socket, next to the QMP socket
+#
+VNC_SOCKET_SUFFIX = ".vnc"
+
+#
+# Framebuffer updates per second a viewer gets by default / at most
+#
+DEFAULT_FPS = 15
+MAX_FPS = 60
+
+#
+# Concurrent viewers per VM
+#
+MAX_VIEWERS = 8
+
+READ_SIZE = 64 * 1024
+
+#
+# RFB client to server message types
+#
+MSG_SET_PIXEL_FORMAT = 0
+MSG_SET_ENCODINGS = 2
+MSG_FRAMEBUFFER_UPDATE_REQUEST = 3
+MSG_KEY_EVENT = 4
+MSG_POINTER_EVENT = 5
+MSG_CLIENT_CUT_TEXT = 6
+
+FIXED_MESSAGE_SIZES = {
+    MSG_SET_PIXEL_FORMAT: 20,
+    MSG_FRAMEBUFFER_UPDATE_REQUEST: 10,
+    MSG_KEY_EVENT: 8,
+    MSG_POINTER_EVENT: 6
+}
+
+SECURITY_NONE = 1
+
+class RFBClientStream():
+
+    def __init__(self):
+        """
+        Splits the client side of an RFB connection into messages.
+
+        Only the handshake and the standard messages are understood,
+        on anything else the stream is passed through unparsed from
+        then on (and no longer throttled).
+        """
+        self.buffer = bytearray()
+        self.handshake = None
+        self.passthrough = False
+
+    def feed(self, data: bytes) -> list:
+        """
+        Returns a list of (message type, bytes), the type is None
+        for handshake and passthrough data
+        """
+        if(self.passthrough):
+            return [ (None, data) ]
+
+        self.buffer += data
+        messages = [ ]
+
+        # ProtocolVersion, security type (3.7+) and ClientInit
+        if(self.handshake is None):
+            if(len(self.buffer) < 12):
+                return messages
+
+            self.handshake = 13 if self.buffer[:12] == b"RFB 003.003\n" else 14
+
+        if(self.handshake):
+            if(len(self.buffer) < self.handshake):
+                return messages
+
+            if(self.handshake == 14 and self.buffer[12] != SECURITY_NONE):
+                self.passthrough = True
+                messages.append((None, bytes(self.buffer)))
+                self.buffer.clear()
+                return messages
+
+            messages.append((None, bytes(self.buffer[:self.handshake])))
+            del self.buffer[:self.handshake]
+            self.handshake = 0
+
+        while self.buffer:
+            msg_type = self.buffer[0]
+            length = FIXED_MESSAGE_SIZES.get(msg_type)
+
+            if(msg_type == MSG_SET_ENCODINGS and len(self.buffer) >= 4):
+                length = 4 + 4 * struct.unpack_from("!H", self.buffer, 2)[0]
+            elif(msg_type == MSG_CLIENT_CUT_TEXT and len(self.buffer) >= 8):
+                length = 8 + struct.unpack_from("!I", self.buffer, 4)[0]
+            elif(msg_type in [ MSG_SET_ENCODINGS, MSG_CLIENT_CUT_TEXT ]):
+                break
+            elif(length is None):
+                self.passthrough = True
+                messages.append((None, bytes(self.buffer)))
+                self.buffer.clear()
+                break
+
+            if(len(self.buffer) < length):
+                break
+
+            messages.append((msg_type, bytes(self.buffer[:length])))
+            del self.buffer[:length]
+
+        return messages
+
+class VNCSession():
+
+    def __init__(self, proxy, ws, fps: int):
+        """
+        One viewer: a WebSocket bridged to its own connection to
+        QEMU's VNC server.
+
+        RFB is pull based, QEMU only sends the rectangles that changed
+        since the last FramebufferUpdateRequest, and only once the
+        client asks again. Incremental requests are held back to
+        at most fps per second, and the server side is only read
+        as fast as the WebSocket accepts data, so a slow viewer just
+        gets fewer (coalesced) updates without affecting others.
+        """
+        self.proxy = proxy
+        self.ws = ws
+        self.interval = 1.0 / fps
+        self.sock = None
+        self.lock = threading.Lock()
+        self.last_request = 0
+        self.pending_request = None
+        self.timer = None
+
+        self.bytes_sent = 0
+        self.requests_forwarded = 0
+        self.requests_delayed = 0
+
+    def run(self):
+        """
+        Proxy until either side closes
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.proxy.socket_path)
+        except OSError as ex:
+            log.warn(f"Could not connect to VNC server of VM '{self.proxy.vmm.vm_id}': {ex}")
+            self.ws.close(1011)
+            return
+
+        threading.Thread(target=self.server_loop, name="vnc-server", daemon=True).start()
+
+        try:
+            self.client_loop()
+        finally:
+            self.close()
+            self.sock.close()
+
+    def client_loop(self):
+        stream = RFBClientStream()
+
+        while True:
+            data = self.ws.recv()
+            if(data is None):
+                return
+
+            for msg_type, msg in stream.feed(data):
+                if(msg_type == MSG_FRAMEBUFFER_UPDATE_REQUEST and msg[1]):
+                    self.request_update(msg)
+                elif(not self.send_server(msg)):
+                    return
+
+    def server_loop(self):
+        while True:
+            try:
+                data = self.sock.recv(READ_SIZE)
+            except OSError:
+                data = b""
+
+            # blocks while the viewer is behind, QEMU coalesces meanwhile
+            if(not data or not self.ws.send(data)):
+                self.close()
+                return
+
+            self.bytes_sent += len(data)
+
+    def send_server(self, data: bytes) -> bool:
+        try:
+            with self.lock:
+                self.sock.sendall(data)
+            return True
+        except OSError:
+            return False
+
+    def request_update(self, msg: bytes):
+        """
+        Forward an incremental update request, or hold it back
+        until the frame interval has passed
+        """
+        with self.lock:
+            wait = self.last_request + self.interval - time.monotonic()
+            if(wait > 0):
+                self.requests_delayed += 1
+                self.pending_request = msg
+                if(self.timer is None):
+                    self.timer = threading.Timer(wait, self.flush_request)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+
+        self.forward_request(msg)
+
+    def flush_request(self):
+        with self.lock:
+            msg = self.pending_request
+            self.pending_request = None
+            self.timer = None
+
+        if(msg is not None):
+            self.forward_request(msg)
+
+    def forward_request(self, msg: bytes):
+        with self.lock:
+            self.last_request = time.monotonic()
+            self.requests_forwarded += 1
+
+        self.send_server(msg)
+
+    def close(self):
+        with self.lock:
+            if(self.timer is not None):
+                self.timer.cancel()
+
+        self.ws.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def get_stats(self) -> dict:
+        return {
+            "fps": round(1.0 / self.interval),
+            "bytes_sent": self.bytes_sent,
+            "requests_forwarded": self.requests_forwarded,
+            "requests_delayed": self.requests_delayed
+        }
+
+class VNCProxy():
+
+    def __init__(self, vmm):
+        """
+        WebSocket access to the VNC server of a headless VM
+        """
+        self.vmm = vmm
+        self.socket_path = os.path.abspath(f"{vmm.qmp_socket_path}{VNC_SOCKET_SUFFIX}")
+        self.lock = threading.Lock()
+        self.sessions = [ ]
+
+    def get_qemu_args(self) -> list:
+        return [ "-display", "none", "-vnc", f"unix:{self.socket_path}" ]
+
+    def serve(self, ws, fps: int = DEFAULT_FPS) -> bool:
+        """
+        Serve a viewer until it disconnects, False if the viewer
+        limit is reached
+        """
+        session = VNCSession(self, ws, max(1, min(fps, MAX_FPS)))
+
+        with self.lock:
+            if(len(self.sessions) >= MAX_VIEWERS):
+                return False
+            self.sessions.append(session)
+
+        log.info(f"VNC viewer connected to VM '{self.vmm.vm_id}' ({len(self.sessions)} total)")
+        try:
+            session.run()
+        finally:
+            with self.lock:
+                self.sessions.remove(session)
+
+            log.info(f"VNC viewer disconnected from VM '{self.vmm.vm_id}'")
+
+        return True
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "viewers": len(self.sessions),
+                "max_viewers": MAX_VIEWERS,
+                "sessions": [ session.get_stats() for session in self.sessions ]
+            }
@@ -0,0 +1,360 @@
+import io
+import os
+import json
+import time
+import socket
+import asyncio
+import threading
+import urllib.parse
+
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+
+from branchweb import webserver
+from log import log
+from web import auth
+from vm import events
+from vm.registry import DEFAULT_VM
+
+#
+# Threads running the (blocking) endpoint functions
+#
+WORKERS = 32
+
+#
+# Limits of a request
+#
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+#
+# Seconds an idle keep-alive connection is held open
+#
+KEEPALIVE_TIMEOUT = 120
+
+CORS_HEADERS = [
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Allow-Methods", "GET, POST, OPTIONS"),
+    ("Access-Control-Allow-Headers", "Content-Type")
+]
+
+class HeaderMap(dict):
+    """
+    Case insensitive request headers
+    """
+    def get(self, key: str, default=None):
+        return super().get(key.lower(), default)
+
+    def __getitem__(self, key: str):
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+class AsyncRequestHandler():
+
+    def __init__(self, command: str, path: str, headers: HeaderMap, client_address):
+        """
+        Stand-in for the request handler endpoints get from branchweb.
+        The response is buffered and written by the event loop once
+        the endpoint returns. Upgraded connections (WebSocket) get a
+        blocking socket instead and write directly.
+        """
+        self.command = command
+        self.path = path
+        self.headers = headers
+        self.client_address = client_address
+        self.status = None
+        self.response_headers = [ ]
+        self.wfile = io.BytesIO()
+        self.rfile = None
+        self.connection = None
+        self.close_connection = False
+
+    def send_response(self, code: int, message: str = None):
+        self.status = (code, message or HTTPStatus(code).phrase)
+
+    def send_header(self, key: str, value: str):
+        self.response_headers.append((key, value))
+
+    def end_headers(self):
+        # upgraded connection: the endpoint owns the socket from here
+        if(self.connection is not None):
+            head = f"HTTP/1.1 {self.status[0]} {self.status[1]}\r\n"
+            head += "".join(f"{key}: {value}\r\n" for key, value in self.response_headers)
+            self.connection.sendall((head + "\r\n").encode("latin-1"))
+
+    def send_web_response(self, status, payload):
+        """
+        Same JSON envelope as branchweb
+        """
+        body = json.dumps({ "status": status.name, "payload": payload }).encode("utf-8")
+
+        self.send_response(status.value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def detach(self, sock: socket.socket):
+        """
+        Hand the raw connection to the endpoint (after an upgrade request)
+        """
+        self.connection = sock
+        self.rfile = sock.makefile("rb")
+        self.wfile = sock.makefile("wb", buffering=0)
+
+class AsyncWebServer():
+
+    def __init__(self, get_providers: dict, post_providers: dict, registry = None, workers: int = WORKERS):
+        """
+        Optional asyncio HTTP front end serving the same endpoint
+        tables as branchweb.
+
+        Connections, keep-alive and request parsing live in the event
+        loop, so idle clients only cost a coroutine. The existing
+        (blocking) endpoints run in a bounded thread pool. Long polls
+        on the event bus are served natively without holding a thread,
+        WebSocket upgrades are handed a dedicated thread.
+
+        :param registry: VMRegistry for the native endpoints
+        """
+        self.registry = registry
+        self.get_providers = get_providers
+        self.post_providers = post_providers
+        self.async_post_providers = {
+            "events": self.events_endpoint
+        } if registry is not None else { }
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="aio-endpoint")
+        self.cors = webserver.WEB_CONFIG.get("send_cors_headers", False)
+        self.connections = 0
+
+    def serve(self, host: str, port: int):
+        """
+        Run the server, blocks forever
+        """
+        asyncio.run(self.run(host, port))
+
+    async def run(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_connection, host, port,
+                limit=MAX_HEADER_SIZE, backlog=1024)
+
+        log.info(f"asyncio web server listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        peer = writer.get_extra_info("peername")
+
+        try:
+            while True:
+                keep_alive = await self.handle_request(reader, writer, peer)
+                if(not keep_alive):
+                    break
+
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            if(not writer.transport.is_closing()):
+                writer.close()
+
+    async def handle_request(self, reader, writer, peer) -> bool:
+        """
+        Read and answer a single request, returns whether the
+        connection stays open
+        """
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+        lines = head.decode("latin-1").split("\r\n")
+
+        method, target, version = lines[0].split(" ", 2)
+        headers = HeaderMap()
+        for line in lines[1:]:
+            if(":" in line):
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+        connection = headers.get("Connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+        length = int(headers.get("Content-Length", 0))
+        if(length > MAX_BODY_SIZE or "chunked" in headers.get("Transfer-Encoding", "")):
+            await self.write_raw(writer, 413, b"", False)
+            return False
+
+        body = await reader.readexactly(length) if length else b""
+
+        url = urllib.parse.urlsplit(target)
+        name = url.path.strip("/")
+        form_data = { key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items() }
+        handler = AsyncRequestHandler(method, url.path, headers, peer)
+
+        if(method == "OPTIONS"):
+            await self.write_raw(writer, 204, b"", keep_alive)
+            return keep_alive
+
+        if(method == "GET" and name in self.get_providers):
+            if("websocket" in headers.get("Upgrade", "").lower()):
+                self.upgrade(writer, handler, self.get_providers[name], form_data)
+                return False
+
+            await self.call_endpoint(self.get_providers[name], handler, form_data)
+
+        elif(method == "POST" and name in self.post_providers):
+            try:
+                post_data = json.loads(body) if body else { }
+            except ValueError:
+                post_data = { key: values[-1] for key, values in urllib.parse.parse_qs(body.decode("utf-8", errors="replace")).items() }
+
+            if(name in self.async_post_providers):
+                await self.async_post_providers[name](handler, form_data, post_data)
+            else:
+                await self.call_endpoint(self.post_providers[name], handler, form_data, post_data)
+
+        else:
+            await self.write_raw(writer, 404, b"", keep_alive)
+            return keep_alive
+
+        if(handler.status is None):
+            handler.send_web_response(webserver.webstatus.SERV_FAILURE, "Endpoint sent no response")
+
+        log.web_log(f"{peer[0] if peer else '-'} {method} /{name} {handler.status[0]}")
+        await self.write_response(writer, handler, keep_alive and not handler.close_connection)
+        return keep_alive and not handler.close_connection
+
+    async def call_endpoint(self, endpoint, handler: AsyncRequestHandler, form_data: dict, post_data: dict = None):
+        """
+        Run a blocking endpoint function in the worker pool
+        """
+        def call():
+            try:
+                if(post_data is None):
+                    endpoint(handler, form_data)
+                else:
+                    endpoint(handler, form_data, post_data)
+            except Exception as ex:
+                log.error(f"Endpoint {endpoint.__name__} failed: {ex}")
+                handler.status = None
+                handler.response_headers = [ ]
+                handler.wfile = io.BytesIO()
+                handler.send_web_response(webserver.webstatus.SERV_FAILURE, "Internal server error")
+
+        await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    def upgrade(self, writer, handler: AsyncRequestHandler, endpoint, form_data: dict):
+        """
+        Take the socket out of the event loop and serve the upgraded
+        connection from its own thread
+        """
+        sock = socket.socket(fileno=os.dup(writer.get_extra_info("socket").fileno()))
+        sock.setblocking(True)
+        writer.transport.abort()
+        handler.detach(sock)
+
+        def run():
+            try:
+                endpoint(handler, form_data)
+            except Exception as ex:
+                log.error(f"Upgraded endpoint {endpoint.__name__} failed: {ex}")
+            finally:
+                sock.close()
+
+        threading.Thread(target=run, name="aio-upgrade", daemon=True).start()
+
+    def render_response(self, handler: AsyncRequestHandler, keep_alive: bool) -> bytes:
+        code, message = handler.status
+        body = handler.wfile.getvalue()
+
+        headers = list(handler.response_headers)
+        if(not any(key.lower() == "content-length" for key, value in headers)):
+            headers.append(("Content-Length", str(len(body))))
+
+        if(self.cors):
+            headers += CORS_HEADERS
+
+        headers.append(("Connection", "keep-alive" if keep_alive else "close"))
+
+        head = f"HTTP/1.1 {code} {message}\r\n" + "".join(f"{key}: {value}\r\n" for key, value in headers)
+        return (head + "\r\n").encode("latin-1") + body
+
+    async def write_response(self, writer, handler: AsyncRequestHandler, keep_alive: bool):
+        writer.write(self.render_response(handler, keep_alive))
+        await writer.drain()
+
+    async def write_raw(self, writer, code: int, body: bytes, keep_alive: bool):
+        handler = AsyncRequestHandler(None, None, HeaderMap(), None)
+        handler.send_response(code)
+        handler.wfile.write(body)
+        await self.write_response(writer, handler, keep_alive)
+
+    def authenticate(self, handler: AsyncRequestHandler, data: dict) -> bool:
+        """
+        Same check as the authenticated decorator, without a thread
+        """
+        start = time.perf_counter_ns()
+        if("authkey" not in data):
+            auth.AUTH_CACHE.record(time.perf_counter_ns() - start, False)
+            handler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+            return False
+
+        user = auth.AUTH_CACHE.resolve(data["authkey"])
+        auth.AUTH_CACHE.record(time.perf_counter_ns() - start, user is not None)
+
+        if(user is None):
+            handler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+            return False
+
+        return True
+
+    # endpoint /events (post), long poll without a thread
+    async def events_endpoint(self, handler: AsyncRequestHandler, form_data: dict, post_data: dict):
+        if(not self.authenticate(handler, post_data)):
+            return
+
+        vm_id = post_data.get("vm", DEFAULT_VM)
+        vmm = self.registry.get(vm_id)
+        if(vmm is None):
+            handler.send_web_response(webserver.webstatus.SERV_FAILURE, f"No such VirtualMachine: '{vm_id}'")
+            return
+
+        try:
+            cursor = int(post_data["cursor"]) if "cursor" in post_data else None
+            timeout = max(0, min(float(post_data.get("timeout", 25)), events.MAX_WAIT))
+        except Exception:
+            handler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse cursor or timeout")
+            return
+
+        # without a cursor the client only gets the current position
+        if(cursor is None):
+            handler.send_web_response(webserver.webstatus.SUCCESS, {
+                    "cursor": vmm.events.get_cursor(),
+                    "events": [ ],
+                    "missed": 0
+                })
+            return
+
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def on_publish():
+            loop.call_soon_threadsafe(wake.set)
+
+        vmm.events.add_listener(on_publish)
+        try:
+            deadline = loop.time() + timeout
+            result = vmm.events.wait_events(cursor, 0)
+
+            while result["cursor"] == cursor and loop.time() < deadline:
+                try:
+                    await asyncio.wait_for(wake.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    pass
+
+                wake.clear()
+                result = vmm.events.wait_events(cursor, 0)
+        finally:
+            vmm.events.remove_listener(on_publish)
+
+        handler.send_web_response(webserver.webstatus.SUCCESS, result)
@@ -0,0 +1,191 @@
+import time
+import functools
+import threading
+
+from branchweb import webserver
+from branchweb.usermanager import usermanager
+from log import log
+
+#
+# Seconds an unused authkey stays in the cache
+#
+CACHE_TTL = 30
+
+#
+# Seconds between sweeps of expired entries and flushes of the
+# coalesced authkey refreshes. Every flush validates all cached
+# keys against the usermanager, so a key it expired or removed is
+# accepted for at most this long.
+#
+SWEEP_INTERVAL = 5
+
+class AuthCache():
+
+    def __init__(self, usermgr: usermanager, ttl: float = CACHE_TTL):
+        """
+        Hash index authkey -> owner in front of the usermanager.
+
+        usermanager.get_key_owner walks all users, this resolves
+        known keys with a single dict lookup. Refreshing a key is
+        only recorded and written back in batches by the sweeper.
+        """
+        self.usermgr = usermgr
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = { }
+        self.pending_refresh = set()
+        self.thread = None
+
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def start(self):
+        """
+        Start the background sweeper
+        """
+        self.thread = threading.Thread(target=self.sweep_loop, name="auth-sweeper", daemon=True)
+        self.thread.start()
+
+    def resolve(self, authkey: str):
+        """
+        Get the owner of an authkey or None
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.index.get(authkey)
+            if(entry is not None and entry[1] > now):
+                self.hits += 1
+                self.pending_refresh.add(authkey)
+                return entry[0]
+
+        user = self.usermgr.get_key_owner(authkey)
+
+        with self.lock:
+            self.misses += 1
+            if(user is None):
+                self.index.pop(authkey, None)
+                return None
+
+            self.index[authkey] = (user, now + self.ttl)
+            self.pending_refresh.add(authkey)
+
+        return user
+
+    def record(self, elapsed_ns: int, success: bool):
+        """
+        Account the time spent on authenticating a request
+        """
+        with self.lock:
+            self.requests += 1
+            self.total_ns += elapsed_ns
+            self.max_ns = max(self.max_ns, elapsed_ns)
+            if(not success):
+                self.failures += 1
+
+    def flush_refreshes(self):
+        """
+        Validate all cached keys and write back the refreshes
+        recorded since the last flush. Keys the usermanager no
+        longer accepts (expired or removed) are evicted, not
+        refreshed, so a late refresh never revives a key.
+        """
+        with self.lock:
+            pending = self.pending_refresh
+            self.pending_refresh = set()
+            cached = list(self.index.keys())
+
+        for authkey in cached:
+            user = self.usermgr.get_key_owner(authkey)
+            key = user.authkeys.get(authkey) if user is not None else None
+            if(key is None):
+                with self.lock:
+                    self.index.pop(authkey, None)
+                continue
+
+            if(authkey in pending):
+                key.refresh()
+
+    def sweep(self):
+        """
+        Evict all expired entries
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [ key for key, entry in self.index.items() if entry[1] <= now ]
+            for key in expired:
+                del self.index[key]
+
+        if(expired):
+            log.debug(f"Evicted {len(expired)} expired authkey(s) from cache")
+
+    def sweep_loop(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            try:
+                self.flush_refreshes()
+                self.sweep()
+            except Exception as ex:
+                log.error(f"Auth cache sweep failed: {ex}")
+
+    def get_stats(self) -> dict:
+        """
+        Get cache counters and the time spent per authentication
+        """
+        with self.lock:
+            return {
+                "cached_keys": len(self.index),
+                "requests": self.requests,
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+                "avg_us": round(self.total_ns / self.requests / 1000, 3) if self.requests else None,
+                "max_us": round(self.max_ns / 1000, 3)
+            }
+
+#
+# global authkey cache, set up by setup()
+#
+AUTH_CACHE: AuthCache = None
+
+#
+# create and start the global authkey cache
+#
+def setup(usermgr: usermanager):
+    global AUTH_CACHE
+    AUTH_CACHE = AuthCache(usermgr)
+    AUTH_CACHE.start()
+
+#
+# endpoint decorator: requires a valid authkey in post_data
+# (or form_data for GET endpoints) before calling the endpoint
+#
+def authenticated(endpoint):
+    @functools.wraps(endpoint)
+    def wrapper(httphandler, form_data, post_data=None):
+        start = time.perf_counter_ns()
+        data = post_data if post_data is not None else form_data
+
+        if("authkey" not in data):
+            AUTH_CACHE.record(time.perf_counter_ns() - start, False)
+            log.debug("Missing request data for authentication: authkey")
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+            return
+
+        user = AUTH_CACHE.resolve(data["authkey"])
+        AUTH_CACHE.record(time.perf_counter_ns() - start, user is not None)
+
+        if(user is None):
+            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+            return
+
+        if(post_data is None):
+            return endpoint(httphandler, form_data)
+
+        return endpoint(httphandler, form_data, post_data)
+
+    return wrapper
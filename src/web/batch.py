@@ -0,0 +1,161 @@
+from branchweb import webserver
+from log import log
+
+#
+# Operations per batch
+#
+MAX_OPERATIONS = 32
+
+#
+# Endpoints that can't run inside a batch
+#
+EXCLUDED_OPERATIONS = [ "auth", "batch", "events", "upload" ]
+
+#
+# Operations that map to a single QMP command and can be
+# pipelined: name -> builder(vmm, data), None if invalid
+#
+PIPELINE_COMMANDS = {
+    "reset": lambda vmm, data: { "execute": "system_reset" },
+    "setiso": lambda vmm, data: vmm.change_medium_command("iso", data["iso"]) if "iso" in data else None,
+    "ejectiso": lambda vmm, data: vmm.eject_command("iso"),
+    "setfloppy": lambda vmm, data: vmm.change_medium_command("floppy", data["floppy"]) if "floppy" in data else None,
+    "ejectfloppy": lambda vmm, data: vmm.eject_command("floppy")
+}
+
+class CapturedResponse():
+
+    def __init__(self):
+        """
+        Request handler stand-in recording the response of an
+        endpoint run inside a batch
+        """
+        self.status = None
+        self.payload = None
+
+    def send_web_response(self, status, payload):
+        self.status = status
+        self.payload = payload
+
+class BatchRunner():
+
+    def __init__(self, providers: dict, get_vm):
+        """
+        Runs a list of endpoint operations for a single, already
+        authenticated request.
+
+        :param providers: Endpoint table (get_post_providers())
+        :param get_vm: Callable resolving a VM id to a VMManager or None
+        """
+        self.providers = providers
+        self.get_vm = get_vm
+
+    def result(self, name: str, status, payload) -> dict:
+        return {
+            "op": name,
+            "status": status.name,
+            "payload": payload
+        }
+
+    def run_operation(self, name: str, data: dict) -> dict:
+        """
+        Run a single operation through its endpoint function
+        """
+        endpoint = self.providers.get(name)
+        if(endpoint is None or name in EXCLUDED_OPERATIONS):
+            return self.result(name, webserver.webstatus.MISSING_DATA, f"Invalid operation: '{name}'")
+
+        # the batch itself is authenticated, skip the per endpoint check
+        endpoint = getattr(endpoint, "__wrapped__", endpoint)
+
+        response = CapturedResponse()
+        try:
+            endpoint(response, { }, data)
+        except Exception as ex:
+            log.error(f"Batch operation '{name}' failed: {ex}")
+            return self.result(name, webserver.webstatus.SERV_FAILURE, "Internal server error")
+
+        if(response.status is None):
+            return self.result(name, webserver.webstatus.SERV_FAILURE, "Operation sent no response")
+
+        return self.result(name, response.status, response.payload)
+
+    def run_pipelined(self, segment: list, stop_on_error: bool) -> list:
+        """
+        Send the QMP commands of consecutive operations on the same
+        VM at once, then collect the replies
+        """
+        vm_id = segment[0][1]["vm"]
+        vmm = self.get_vm(vm_id)
+        if(vmm is None):
+            return [ self.result(name, webserver.webstatus.SERV_FAILURE, f"No such VirtualMachine: '{vm_id}'") for name, data in segment ]
+
+        commands = [ ]
+        for name, data in segment:
+            command = PIPELINE_COMMANDS[name](vmm, data)
+            commands.append((name, command))
+
+            # nothing after an invalid operation may be sent
+            if(command is None and stop_on_error):
+                break
+
+        replies = iter(vmm.execute_pipelined([ command for name, command in commands if command is not None ]))
+
+        results = [ ]
+        failed = False
+        for name, command in commands:
+            if(command is None):
+                result = self.result(name, webserver.webstatus.SERV_FAILURE, "Invalid or missing media file")
+            elif(next(replies)):
+                result = self.result(name, webserver.webstatus.SUCCESS, "OK")
+            else:
+                result = self.result(name, webserver.webstatus.SERV_FAILURE, "QMP command failed")
+
+            # already sent when the failure came back, stop_on_error could not hold it back
+            if(failed and stop_on_error and command is not None):
+                result["after_error"] = True
+
+            failed = failed or result["status"] != webserver.webstatus.SUCCESS.name
+            results.append(result)
+
+        return results
+
+    def run(self, operations: list, vm_id: str, stop_on_error: bool = True, pipeline: bool = False) -> list:
+        """
+        Run all operations in order. With stop_on_error, nothing after
+        the first failed operation runs. With pipeline, consecutive
+        QMP-only operations are sent without waiting for each other
+        (an invalid one still stops the rest from being sent). A QMP
+        command failing there can't stop the commands sent after it,
+        their results are flagged with after_error.
+
+        Returns the list of per operation results
+        """
+        steps = [ ]
+        for operation in operations:
+            data = dict(operation)
+            name = data.pop("op", None)
+            data.setdefault("vm", vm_id)
+            steps.append((name, data))
+
+        results = [ ]
+        pos = 0
+        while pos < len(steps):
+            name, data = steps[pos]
+
+            if(pipeline and name in PIPELINE_COMMANDS):
+                end = pos
+                while end < len(steps) and steps[end][0] in PIPELINE_COMMANDS and steps[end][1]["vm"] == data["vm"]:
+                    end += 1
+
+                step_results = self.run_pipelined(steps[pos:end], stop_on_error)
+                pos = end
+            else:
+                step_results = [ self.run_operation(name, data) ]
+                pos += 1
+
+            results += step_results
+            if(stop_on_error and any(result["status"] != webserver.webstatus.SUCCESS.name for result in step_results)):
+                break
+
+        return results
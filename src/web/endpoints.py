@@ -1,10 +1,26 @@
-import main
+import state
 import os
 
 from branchweb import webserver
 from branchweb.usermanager import usermanager
 from branchweb.usermanager import USER_FILE
 from log import log
+from web import auth
+from web.auth import authenticated
+from web import websocket
+from web import batch
+from vm.registry import DEFAULT_VM
+from vm.manager import parse_cpuset
+from vm import images
+from vm import profile
+from vm import maintenance
+from vm import backup
+from vm import screen
+from vm import vnc
+from vm import input as vm_input
+from media import catalog
+from media.upload import UPLOADS
+from media.store import STORE
 import traceback
 
 class r9x_web_providers():
@@ -13,7 +29,27 @@ class r9x_web_providers():
     @staticmethod
     def setup_usermgr(file: str = USER_FILE):
         r9x_web_providers.usermgr = usermanager(file)
+        auth.setup(r9x_web_providers.usermgr)
     
+    @staticmethod
+    def get_vm(httphandler, post_data, create: bool = False):
+        """
+        Resolve the VM a request targets (post_data["vm"], the
+        default VM if missing). Sends an error response and
+        returns None if there is no such VM.
+        """
+        vm_id = post_data.get("vm", DEFAULT_VM)
+
+        if(create):
+            vmm = state.VMS.create(vm_id)
+        else:
+            vmm = state.VMS.get(vm_id)
+
+        if(vmm is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"No such VirtualMachine: '{vm_id}'")
+
+        return vmm
+
     @staticmethod
     def get_post_providers():
         return {
@@ -30,11 +66,50 @@ class r9x_web_providers():
             "ejectfloppy": r9x_web_providers.ejectfloppy_endpoint,
             "files": r9x_web_providers.file_endpoint,
             "setcdmode": r9x_web_providers.set_cdrommode_endpoint,
+            "events": r9x_web_providers.events_endpoint,
+            "boottimeline": r9x_web_providers.boottimeline_endpoint,
+            "statestatus": r9x_web_providers.statestatus_endpoint,
+            "vms": r9x_web_providers.vms_endpoint,
+            "poolstatus": r9x_web_providers.poolstatus_endpoint,
+            "goldenimages": r9x_web_providers.goldenimages_endpoint,
+            "promotegolden": r9x_web_providers.promotegolden_endpoint,
+            "resetgolden": r9x_web_providers.resetgolden_endpoint,
+            "authstats": r9x_web_providers.authstats_endpoint,
+            "logs": r9x_web_providers.logs_endpoint,
+            "upload": r9x_web_providers.upload_endpoint,
+            "storestats": r9x_web_providers.storestats_endpoint,
+            "vncstatus": r9x_web_providers.vncstatus_endpoint,
+            "sendinput": r9x_web_providers.sendinput_endpoint,
+            "telemetry": r9x_web_providers.telemetry_endpoint,
+            "qmpcache": r9x_web_providers.qmpcache_endpoint,
+            "batch": r9x_web_providers.batch_endpoint,
+            "setprofile": r9x_web_providers.setprofile_endpoint,
+            "maintenance": r9x_web_providers.maintenance_endpoint,
+            "maintenancestatus": r9x_web_providers.maintenancestatus_endpoint,
+            "backup": r9x_web_providers.backup_endpoint,
+            "backupstatus": r9x_web_providers.backupstatus_endpoint,
+            "restorebackup": r9x_web_providers.restorebackup_endpoint,
         }
 
     @staticmethod
     def get_get_providers():
-        return { }
+        return {
+            "screenshot": r9x_web_providers.screenshot_endpoint,
+            "vnc": r9x_web_providers.vnc_endpoint,
+            "metrics": r9x_web_providers.metrics_endpoint,
+        }
+
+    @staticmethod
+    def send_raw_response(httphandler, content_type: str, data: bytes):
+        """
+        Send a non-JSON response body (e.g. an image)
+        """
+        httphandler.send_response(200)
+        httphandler.send_header("Content-Type", content_type)
+        httphandler.send_header("Content-Length", str(len(data)))
+        httphandler.send_header("Cache-Control", "no-store")
+        httphandler.end_headers()
+        httphandler.wfile.write(data)
 
 
     # ENDPOINT /auth (POST)
@@ -69,143 +144,154 @@ class r9x_web_providers():
 
     # ENDPOINT /status (POST)
     @staticmethod
+    @authenticated
     def setupstatus_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-
-        user.authkeys[authkey].refresh()
-
         httphandler.send_web_response(webserver.webstatus.SUCCESS, {
-                "setup": main.VMM.setup_mode
+                "setup": vmm.setup_mode
             })
    
 
     # ENDPOINT /setup (POST)
     @staticmethod
+    @authenticated
     def setup_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        golden = post_data.get("golden")
+
+        try:
+            # overlays inherit the size of their golden image
+            disk_size_mb = None if golden is not None else int(post_data["disk_size_mb"])
+            ram_size_mb = int(post_data["ram_size_mb"])
+            cluster_size = int(post_data["cluster_size"]) if "cluster_size" in post_data else None
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse ram_size, disk_size or cluster_size to int")
             return
 
-        authkey = post_data["authkey"]
+        preallocation = post_data.get("preallocation")
+        err = images.check_create_options(cluster_size, preallocation)
+        if(err is not None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, err)
+            return
 
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+        if(golden is not None and images.golden_path(golden) is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"No such golden image: '{golden}'")
             return
     
-        user.authkeys[authkey].refresh()
-        
-        if(not main.VMM.setup_mode):
+        cpuset = post_data.get("cpuset")
+        if(cpuset is not None):
+            try:
+                parse_cpuset(cpuset)
+            except Exception:
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse cpuset")
+                return
+
+        headless = post_data.get("headless") in [ True, "true" ]
+
+        launch_profile = post_data.get("profile")
+        launch_options = post_data.get("launch")
+        err = profile.check_options(launch_profile, launch_options)
+        if(err is not None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, err)
+            return
+
+        # only a valid request creates the VM (and its directory)
+        vmm = r9x_web_providers.get_vm(httphandler, post_data, create=True)
+        if(vmm is None):
+            return
+
+        if(not vmm.setup_mode):
             httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VirtualMachine is already configured!")
             return
-        
-        try:
-            disk_size_mb = int(post_data["disk_size_mb"])
-            ram_size_mb = int(post_data["ram_size_mb"])
-        except Exception:
-            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse ram_size or disk_size to int")
+
+        if(not vmm.setup(disk_size_mb, ram_size_mb, cpuset, golden, cluster_size, preallocation, headless,
+                launch_profile, launch_options)):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not create VirtualMachine disk.")
             return
-    
-        main.VMM.setup(disk_size_mb, ram_size_mb)
 
         httphandler.send_web_response(webserver.webstatus.SUCCESS, {
-                "setup": main.VMM.setup_mode
+                "setup": vmm.setup_mode
             })
 
 
     # endpoint /vminfo (post)
     @staticmethod
+    @authenticated
     def vminfo_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
-
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-    
-        user.authkeys[authkey].refresh()
         
-        if(main.VMM.setup_mode):
+        if(vmm.setup_mode):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "VirtualMachine is not configured yet.")
         else:
-            httphandler.send_web_response(webserver.webstatus.SUCCESS, main.VMM.get_vmconf())
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.get_vmconf())
 
 
     # endpoint /start (post)
     @staticmethod
+    @authenticated
     def start_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        # allocate a pre-warmed VM
+        if(post_data.get("pool") in [ True, "true" ]):
+            if(state.POOL is None):
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VM pool is disabled.")
+                return
+
+            vmm = state.POOL.allocate()
+            if(vmm is None):
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Failed to start VirtualMachine.")
+            else:
+                httphandler.send_web_response(webserver.webstatus.SUCCESS, { "vm": vmm.vm_id })
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
-    
-        user.authkeys[authkey].refresh()
-        if(main.VMM.start()):
+
+        if(vmm.is_running()):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VM is already running.")
+        elif(vmm.start(restore=post_data.get("coldboot") not in [ True, "true" ])):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "VirtualMachine started.")
         else:
-            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VM is already running.")
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Failed to start VirtualMachine.")
 
 
     # endpoint /kill (post)
     @staticmethod
+    @authenticated
     def kill_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
+        if(post_data.get("suspend") in [ True, "true" ]):
+            if(vmm.suspend()):
+                httphandler.send_web_response(webserver.webstatus.SUCCESS, "VirtualMachine suspended to disk.")
+            else:
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not save VirtualMachine state.")
+            return
 
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+        # pool VMs are released, a fresh one gets warmed up
+        if(state.POOL is not None and state.POOL.release(vmm.vm_id)):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, "Released VirtualMachine.")
             return
-    
-        user.authkeys[authkey].refresh()
-        main.VMM.kill()
+
+        vmm.kill()
         httphandler.send_web_response(webserver.webstatus.SUCCESS, "Killing VirtualMachine.")
 
 
     # endpoint /reset (post)
     @staticmethod
+    @authenticated
     def reset_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-    
-        user.authkeys[authkey].refresh()
-        if(main.VMM.reset()):
+        if(vmm.reset()):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "Resetting VirtualMachine.")
         else:
             httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "QMP connection is not ready!")
@@ -213,26 +299,17 @@ class r9x_web_providers():
 
     # endpoint /setiso (post)
     @staticmethod
+    @authenticated
     def setiso_endpoint(httphandler, form_data, post_data):
         if("iso" not in post_data):
             httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: iso")
             return
 
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-    
-        user.authkeys[authkey].refresh()
-
-        if(main.VMM.setiso(post_data["iso"])):
+        if(vmm.setiso(post_data["iso"])):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "ISO set.")
         else:
             httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not set ISO")
@@ -240,22 +317,13 @@ class r9x_web_providers():
 
     # endpoint /ejectiso (post)
     @staticmethod
+    @authenticated
     def ejectiso_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-    
-        user.authkeys[authkey].refresh()
-
-        if(main.VMM.ejectiso()):
+        if(vmm.ejectiso()):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "ISO image ejected.")
         else:
             httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not eject ISO image.")
@@ -263,49 +331,31 @@ class r9x_web_providers():
 
     # endpoint /setfloppy (post)
     @staticmethod
+    @authenticated
     def setfloppy_endpoint(httphandler, form_data, post_data):
         if("floppy" not in post_data):
             httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: floppy")
             return
 
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
-            return
-
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
-    
-        user.authkeys[authkey].refresh()
 
-        if(main.VMM.setfloppy(post_data["floppy"])):
+        if(vmm.setfloppy(post_data["floppy"])):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "Floppy set.")
         else:
-            httphandler.send_web_response(webserver.webstatus.SUCCESS, "Could not set floppy.")
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not set floppy.")
 
 
     # endpoint /ejectfloppy (post)
     @staticmethod
+    @authenticated
     def ejectfloppy_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-    
-        user.authkeys[authkey].refresh()
-
-        if(main.VMM.ejectiso()):
+        if(vmm.ejectfloppy()):
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "Floppy image ejected.")
         else:
             httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not eject Floppy image.")
@@ -313,55 +363,536 @@ class r9x_web_providers():
 
     # endpoint /files (post)
     @staticmethod
+    @authenticated
     def file_endpoint(httphandler, form_data, post_data):
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        iso_catalog = catalog.get_catalog("iso")
+        floppy_catalog = catalog.get_catalog("floppy")
+
+        # plain listing of both directories
+        if("kind" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, {
+                    "isos": iso_catalog.names(),
+                    "floppy": floppy_catalog.names(),
+                    "generation": {
+                        "iso": iso_catalog.get_generation(),
+                        "floppy": floppy_catalog.get_generation()
+                    }
+                })
+            return
+
+        if(post_data["kind"] not in [ "iso", "floppy" ]):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Invalid kind, expected 'iso' or 'floppy'")
             return
 
-        authkey = post_data["authkey"]
+        media_catalog = catalog.get_catalog(post_data["kind"])
 
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
+        try:
+            generation = int(post_data["generation"]) if "generation" in post_data else None
+            offset = int(post_data.get("offset", 0))
+            limit = int(post_data.get("limit", 100))
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse generation, offset or limit to int")
+            return
+
+        # client listing is still up to date
+        if(generation is not None and generation == media_catalog.get_generation()):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, {
+                    "generation": generation,
+                    "unchanged": True
+                })
             return
-    
-        user.authkeys[authkey].refresh()
-        
-        httphandler.send_web_response(webserver.webstatus.SUCCESS, {
-                "isos": os.listdir("iso/"),
-                "floppy": os.listdir("floppy/")
-            })
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS,
+                media_catalog.list(offset, limit, post_data.get("search"), post_data.get("type")))
 
     @staticmethod
+    @authenticated
     def set_cdrommode_endpoint(httphandler, form_data, post_data):
         if("cdmode" not in post_data):
             httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: cdmode")
             return
 
-        if("authkey" not in post_data):
-            log.debug("Missing request data for authentication: authkey")
-            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data for authentication: Authentication key (authkey)")
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
             return
 
-        authkey = post_data["authkey"]
-
-        user = r9x_web_providers.usermgr.get_key_owner(authkey)
-        if (user is None):
-            httphandler.send_web_response(webserver.webstatus.AUTH_FAILURE, "Invalid authentication key.")
-            return
-    
-        user.authkeys[authkey].refresh()
-
         cdmode = post_data["cdmode"]
 
         if(cdmode == "SCSI"):
-            main.VMM.cdrom_mode = "SCSI"
+            vmm.cdrom_mode = "SCSI"
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "CDRom mode set to 'SCSI'. Kill and restart the VM for the changes to take effect.")
         elif(cdmode == "IDE"):
-            main.VMM.cdrom_mode = "IDE"
+            vmm.cdrom_mode = "IDE"
             httphandler.send_web_response(webserver.webstatus.SUCCESS, "CDRom mode set to 'IDE'. Kill and restart the VM for the changes to take effect.")
         else:
             httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Invalid cdrom mode.")
 
-            
+
+    # endpoint /setprofile (post)
+    @staticmethod
+    @authenticated
+    def setprofile_endpoint(httphandler, form_data, post_data):
+        if("profile" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: profile")
+            return
+
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        err = profile.check_options(post_data["profile"], post_data.get("launch"))
+        if(err is not None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, err)
+            return
+
+        if(not vmm.set_launch_profile(post_data["profile"], post_data.get("launch"))):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VirtualMachine is not configured.")
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, f"Launch profile set to '{post_data['profile']}'. Kill and restart the VM for the changes to take effect.")
+
+
+    # endpoint /events (post)
+    @staticmethod
+    @authenticated
+    def events_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        # without a cursor the client only gets the current position
+        if("cursor" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, {
+                    "cursor": vmm.events.get_cursor(),
+                    "events": [ ],
+                    "missed": 0
+                })
+            return
+
+        try:
+            cursor = int(post_data["cursor"])
+            timeout = float(post_data.get("timeout", 25))
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse cursor or timeout")
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.events.wait_events(cursor, timeout))
+
+
+    # endpoint /boottimeline (post)
+    @staticmethod
+    @authenticated
+    def boottimeline_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.get_boot_timeline())
+
+
+    # endpoint /statestatus (post)
+    @staticmethod
+    @authenticated
+    def statestatus_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.get_state_status())
+
+
+    # endpoint /vms (post)
+    @staticmethod
+    @authenticated
+    def vms_endpoint(httphandler, form_data, post_data):
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, state.VMS.list())
+
+
+    # endpoint /poolstatus (post)
+    @staticmethod
+    @authenticated
+    def poolstatus_endpoint(httphandler, form_data, post_data):
+        if(state.POOL is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VM pool is disabled.")
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, state.POOL.get_stats())
+
+
+    # endpoint /goldenimages (post)
+    @staticmethod
+    @authenticated
+    def goldenimages_endpoint(httphandler, form_data, post_data):
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, images.list_golden())
+
+
+    # endpoint /promotegolden (post)
+    @staticmethod
+    @authenticated
+    def promotegolden_endpoint(httphandler, form_data, post_data):
+        if("name" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: name")
+            return
+
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        if(vmm.promote_to_golden(post_data["name"])):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, "Golden image created.")
+        else:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not create golden image. Is the VM stopped?")
+
+
+    # endpoint /maintenance (post)
+    @staticmethod
+    @authenticated
+    def maintenance_endpoint(httphandler, form_data, post_data):
+        if("job" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: job")
+            return
+
+        if(post_data["job"] not in maintenance.JOB_KINDS):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"Invalid job, expected one of {', '.join(maintenance.JOB_KINDS)}")
+            return
+
+        golden = post_data.get("golden")
+        if(golden is not None):
+            if(images.golden_path(golden) is None):
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"No such golden image: '{golden}'")
+                return
+
+            job = state.MAINTENANCE.submit(post_data["job"], golden=golden)
+        else:
+            vmm = r9x_web_providers.get_vm(httphandler, post_data)
+            if(vmm is None):
+                return
+
+            if(vmm.is_running()):
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VirtualMachine is running, stop it first.")
+                return
+
+            job = state.MAINTENANCE.submit(post_data["job"], vmm.vm_id,
+                    auto_compact=post_data.get("auto_compact") in [ True, "true" ])
+
+        if(job is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Job is invalid for this target or already queued.")
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, dict(job))
+
+
+    # endpoint /maintenancestatus (post)
+    @staticmethod
+    @authenticated
+    def maintenancestatus_endpoint(httphandler, form_data, post_data):
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, state.MAINTENANCE.get_status())
+
+
+    # endpoint /backup (post)
+    @staticmethod
+    @authenticated
+    def backup_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        kind = post_data.get("kind", "auto")
+        if(kind not in backup.BACKUP_KINDS):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"Invalid kind, expected one of {', '.join(backup.BACKUP_KINDS)}")
+            return
+
+        if(not vmm.is_running() or vmm.snapshot):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VirtualMachine is not running or has no disk of its own.")
+            return
+
+        entry = vmm.backup.backup(kind)
+        if(entry is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not start backup. Is another backup running?")
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, entry)
+
+
+    # endpoint /backupstatus (post)
+    @staticmethod
+    @authenticated
+    def backupstatus_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.backup.get_status())
+
+
+    # endpoint /restorebackup (post)
+    @staticmethod
+    @authenticated
+    def restorebackup_endpoint(httphandler, form_data, post_data):
+        if("id" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: id")
+            return
+
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        try:
+            backup_id = int(post_data["id"])
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse id to int")
+            return
+
+        if(vmm.backup.restore(backup_id)):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, "Restoring backup. Check /backupstatus for completion.")
+        else:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not restore backup. Is the VM stopped and the backup complete?")
+
+
+    # endpoint /resetgolden (post)
+    @staticmethod
+    @authenticated
+    def resetgolden_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        if(vmm.reset_to_golden()):
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, "VirtualMachine disk reset to golden image.")
+        else:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not reset disk. Is the VM stopped and based on a golden image?")
+
+
+    # endpoint /authstats (post)
+    @staticmethod
+    @authenticated
+    def authstats_endpoint(httphandler, form_data, post_data):
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, auth.AUTH_CACHE.get_stats())
+
+
+    # endpoint /logs (post)
+    @staticmethod
+    @authenticated
+    def logs_endpoint(httphandler, form_data, post_data):
+        levels = post_data.get("level")
+        if(isinstance(levels, str)):
+            levels = levels.split(",")
+
+        try:
+            since = int(post_data.get("since", 0))
+            limit = int(post_data.get("limit", 200))
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse since or limit to int")
+            return
+
+        if(limit <= 0):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "limit must be a positive integer")
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS,
+                log.get_records(levels, post_data.get("module"), since, limit))
+
+
+    # endpoint /upload (post)
+    @staticmethod
+    @authenticated
+    def upload_endpoint(httphandler, form_data, post_data):
+        if("kind" not in post_data or "name" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: kind, name")
+            return
+
+        if(post_data["kind"] not in [ "iso", "floppy" ]):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Invalid kind, expected 'iso' or 'floppy'")
+            return
+
+        if(post_data.get("cancel") in [ True, "true" ]):
+            if(UPLOADS.cancel(post_data["kind"], post_data["name"])):
+                httphandler.send_web_response(webserver.webstatus.SUCCESS, "Upload cancelled.")
+            else:
+                httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "No such upload.")
+            return
+
+        try:
+            total_size = int(post_data["total_size"])
+            offset = int(post_data.get("offset", 0))
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse total_size or offset to int")
+            return
+
+        result = UPLOADS.write_chunk(post_data["kind"], post_data["name"], total_size, offset,
+                post_data.get("data"), post_data.get("sha256"))
+
+        if(result["error"] is not None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, result)
+        else:
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, result)
+
+
+    # endpoint /storestats (post)
+    @staticmethod
+    @authenticated
+    def storestats_endpoint(httphandler, form_data, post_data):
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, STORE.get_stats())
+
+
+    # endpoint /screenshot (get)
+    @staticmethod
+    @authenticated
+    def screenshot_endpoint(httphandler, form_data):
+        vmm = r9x_web_providers.get_vm(httphandler, form_data)
+        if(vmm is None):
+            return
+
+        fmt = form_data.get("format", "png")
+        if(fmt not in screen.FORMATS or not vmm.screen.supports(fmt)):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"Unsupported image format: '{fmt}'")
+            return
+
+        try:
+            width = int(form_data["width"]) if "width" in form_data else None
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse width to int")
+            return
+
+        if(width is not None and width < 1):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "width must be a positive integer")
+            return
+
+        image = vmm.screen.get_image(fmt, width)
+        if(image is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not take screenshot, is the VM running?")
+            return
+
+        r9x_web_providers.send_raw_response(httphandler, f"image/{fmt}", image)
+
+
+    # endpoint /vnc (get, websocket)
+    @staticmethod
+    @authenticated
+    def vnc_endpoint(httphandler, form_data):
+        vmm = r9x_web_providers.get_vm(httphandler, form_data)
+        if(vmm is None):
+            return
+
+        if(not vmm.is_running() or not vmm.conf.get("headless")):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "VirtualMachine is not running headless.")
+            return
+
+        try:
+            fps = int(form_data.get("fps", vnc.DEFAULT_FPS))
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse fps to int")
+            return
+
+        ws = websocket.upgrade(httphandler)
+        if(ws is None):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Expected a WebSocket upgrade request")
+            return
+
+        if(not vmm.vnc.serve(ws, fps)):
+            ws.close(1013)
+
+
+    # endpoint /vncstatus (post)
+    @staticmethod
+    @authenticated
+    def vncstatus_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.vnc.get_stats())
+
+
+    # endpoint /sendinput (post)
+    @staticmethod
+    @authenticated
+    def sendinput_endpoint(httphandler, form_data, post_data):
+        if("actions" not in post_data):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: actions")
+            return
+
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        try:
+            plan = vm_input.plan_actions(post_data["actions"])
+        except (ValueError, TypeError) as ex:
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, f"Invalid actions: {ex}")
+            return
+
+        result = vmm.input.send(plan)
+
+        if(result["error"] is not None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, result)
+        else:
+            httphandler.send_web_response(webserver.webstatus.SUCCESS, result)
+
+
+    # endpoint /telemetry (post)
+    @staticmethod
+    @authenticated
+    def telemetry_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        try:
+            since = float(post_data.get("since", 0))
+            limit = int(post_data["limit"]) if "limit" in post_data else None
+        except Exception:
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Could not parse since or limit")
+            return
+
+        history = vmm.telemetry.history.get(since, limit)
+        history["interval"] = state.TELEMETRY.interval if state.TELEMETRY is not None else None
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, history)
+
+
+    # endpoint /metrics (get, prometheus)
+    @staticmethod
+    @authenticated
+    def metrics_endpoint(httphandler, form_data):
+        if(state.TELEMETRY is None):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, "Telemetry is disabled.")
+            return
+
+        r9x_web_providers.send_raw_response(httphandler, "text/plain; version=0.0.4",
+                state.TELEMETRY.render_prometheus().encode())
+
+
+    # endpoint /qmpcache (post)
+    @staticmethod
+    @authenticated
+    def qmpcache_endpoint(httphandler, form_data, post_data):
+        vmm = r9x_web_providers.get_vm(httphandler, post_data)
+        if(vmm is None):
+            return
+
+        httphandler.send_web_response(webserver.webstatus.SUCCESS, vmm.qmp_cache.get_stats())
+
+
+    # endpoint /batch (post)
+    @staticmethod
+    @authenticated
+    def batch_endpoint(httphandler, form_data, post_data):
+        operations = post_data.get("operations")
+        if(not isinstance(operations, list) or not all(isinstance(op, dict) for op in operations)):
+            httphandler.send_web_response(webserver.webstatus.MISSING_DATA, "Missing request data: operations")
+            return
+
+        if(len(operations) > batch.MAX_OPERATIONS):
+            httphandler.send_web_response(webserver.webstatus.SERV_FAILURE, f"At most {batch.MAX_OPERATIONS} operations per batch")
+            return
+
+        runner = batch.BatchRunner(r9x_web_providers.get_post_providers(), state.VMS.get)
+        results = runner.run(operations, post_data.get("vm", DEFAULT_VM),
+                post_data.get("stop_on_error", True) not in [ False, "false" ],
+                post_data.get("pipeline") in [ True, "true" ])
+
+        failed = any(result["status"] != webserver.webstatus.SUCCESS.name for result in results)
+        httphandler.send_web_response(webserver.webstatus.SERV_FAILURE if failed else webserver.webstatus.SUCCESS, {
+                "completed": len(results),
+                "results": results
+            })
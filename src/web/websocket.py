@@ -0,0 +1,175 @@
+import base64
+import struct
+import socket
+import hashlib
+import threading
+
+#
+# Key suffix of the opening handshake (RFC 6455)
+#
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+#
+# Largest accepted frame from a client
+#
+MAX_FRAME_SIZE = 1024 * 1024
+
+#
+# Largest accepted message, summed over its continuation frames
+#
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+
+#
+# xor a payload with the 4 byte client mask, as one big integer
+#
+def unmask(payload: bytes, mask: bytes) -> bytes:
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+class WebSocket():
+
+    def __init__(self, sock: socket.socket, rfile):
+        """
+        Server side of an upgraded WebSocket connection.
+        send() blocks until the data is handed to the kernel,
+        which is what throttles a slow client.
+        """
+        self.sock = sock
+        self.rfile = rfile
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def read_exact(self, length: int) -> bytes:
+        data = self.rfile.read(length)
+        if(len(data) != length):
+            raise ConnectionError("WebSocket closed")
+
+        return data
+
+    def recv(self):
+        """
+        Receive the next data message, handling control frames.
+        Returns None once the connection is closed.
+        """
+        message = bytearray()
+
+        while True:
+            try:
+                head, length = struct.unpack("!BB", self.read_exact(2))
+                masked = length & 0x80
+                length &= 0x7f
+
+                if(length == 126):
+                    length = struct.unpack("!H", self.read_exact(2))[0]
+                elif(length == 127):
+                    length = struct.unpack("!Q", self.read_exact(8))[0]
+
+                if(length > MAX_FRAME_SIZE or not masked):
+                    self.close(1002)
+                    return None
+
+                # control frames may be interleaved and don't add to the message
+                if(head & 0x0f < OP_CLOSE and len(message) + length > MAX_MESSAGE_SIZE):
+                    self.close(1009)
+                    return None
+
+                mask = self.read_exact(4)
+                payload = self.read_exact(length)
+            except (OSError, ConnectionError):
+                self.closed = True
+                return None
+
+            payload = unmask(payload, mask)
+
+            opcode = head & 0x0f
+            if(opcode == OP_CLOSE):
+                self.close()
+                return None
+
+            if(opcode == OP_PING):
+                try:
+                    self.send_frame(OP_PONG, payload)
+                except OSError:
+                    self.closed = True
+                    return None
+                continue
+
+            if(opcode == OP_PONG):
+                continue
+
+            message += payload
+            if(head & 0x80):
+                return bytes(message)
+
+    def send_frame(self, opcode: int, payload: bytes):
+        length = len(payload)
+        if(length < 126):
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif(length < 65536):
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+        with self.send_lock:
+            self.sock.sendall(header + payload)
+
+    def send(self, data: bytes) -> bool:
+        """
+        Send a binary message, False if the connection is gone
+        """
+        if(self.closed):
+            return False
+
+        try:
+            self.send_frame(OP_BINARY, data)
+            return True
+        except OSError:
+            self.closed = True
+            return False
+
+    def close(self, code: int = 1000):
+        if(self.closed):
+            return
+
+        self.closed = True
+        try:
+            self.send_frame(OP_CLOSE, struct.pack("!H", code))
+        except OSError:
+            pass
+
+#
+# answer the opening handshake of a GET request on a
+# BaseHTTPRequestHandler, returns the WebSocket or None
+#
+def upgrade(httphandler):
+    headers = httphandler.headers
+    key = headers.get("Sec-WebSocket-Key")
+
+    if(key is None or "websocket" not in headers.get("Upgrade", "").lower()):
+        return None
+
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+    httphandler.send_response(101, "Switching Protocols")
+    httphandler.send_header("Upgrade", "websocket")
+    httphandler.send_header("Connection", "Upgrade")
+    httphandler.send_header("Sec-WebSocket-Accept", accept)
+
+    # noVNC asks for the "binary" subprotocol
+    protocols = [ p.strip() for p in headers.get("Sec-WebSocket-Protocol", "").split(",") ]
+    if("binary" in protocols):
+        httphandler.send_header("Sec-WebSocket-Protocol", "binary")
+
+    httphandler.end_headers()
+    httphandler.wfile.flush()
+    httphandler.close_connection = True
+
+    return WebSocket(httphandler.connection, httphandler.rfile)